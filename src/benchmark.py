@@ -0,0 +1,654 @@
+#!/usr/bin/env python3
+
+"""
+MIT License
+
+Copyright (c) 2021-2022 Marcin Sielski <marcin.sielski@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import camera
+from camera import Gst, GLib
+from gi.repository import GObject
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+
+TOPOLOGIES = {
+	'stream': {'record': 0, 'format': 0},
+	'h264': {'record': 1, 'format': 0},
+	'huffyuv': {'record': 1, 'format': 1}}
+MODES = ('640x480@30', '1280x720@30', '1920x1080@30')
+# NOTE: imx477 builds the same pipeline as imx219.
+MODELS = ('imx219', 'ov9281')
+# relative change tolerated before the result is reported as a regression
+TOLERANCE = {
+	'fps': -0.05, 'cpu': 0.15, 'rss': 0.10, 'latency_p99': 0.25,
+	'drops': 0.0}
+
+
+def software_encoder(name, bitrate, framerate):
+
+	"""
+	Return software H.264 encoder standing in for the hardware encoder
+
+	Args:
+		name (str): name of the element
+		bitrate (int): bitrate in bits per second
+		framerate (int): framerate
+
+	Returns:
+		GstX264Enc: encoder
+	"""
+
+	encoder = Gst.ElementFactory.make('x264enc', name)
+	Gst.util_set_object_arg(encoder, 'tune', 'zerolatency')
+	Gst.util_set_object_arg(encoder, 'speed-preset', 'ultrafast')
+	encoder.set_property('bitrate', max(1, bitrate // 1000))
+	encoder.set_property('key-int-max', framerate)
+	return encoder
+
+
+def encoder_name():
+
+	"""
+	Return name of the encoder of raw frames
+
+	Returns:
+		str: hardware encoder if available, software encoder otherwise
+	"""
+
+	if Gst.ElementFactory.find('v4l2h264enc') is not None:
+		return 'v4l2h264enc'
+	return 'x264enc'
+
+
+class SyntheticSource(Gst.Bin):
+
+	"""
+	Synthetic camera source producing moving test pattern. Exposes properties
+	of the camera source the pipeline touches and, like the camera, encodes
+	H.264 itself when raw frames are not needed.
+	"""
+
+	__gproperties__ = {
+		'bitrate': (
+			int, 'Bitrate', 'Bitrate in bits per second', 0, 2**31 - 1,
+			17000000, GObject.ParamFlags.READWRITE),
+		'keyframe-interval': (
+			int, 'Keyframe interval', 'Keyframe interval in frames', -1,
+			2**31 - 1, -1, GObject.ParamFlags.READWRITE),
+		'inline-headers': (
+			bool, 'Inline headers', 'Insert SPS/PPS into the stream', False,
+			GObject.ParamFlags.READWRITE),
+		'annotation-mode': (
+			int, 'Annotation mode', 'Annotation flags', 0, 2**31 - 1, 0,
+			GObject.ParamFlags.READWRITE),
+		'annotation-text': (
+			str, 'Annotation text', 'Annotation text', '',
+			GObject.ParamFlags.READWRITE),
+		'shutter-speed': (
+			int, 'Shutter speed', 'Shutter speed in microseconds', 0,
+			2**31 - 1, 0, GObject.ParamFlags.READWRITE)}
+
+
+	def __init__(self, encode, framerate):
+
+		"""
+		Initialize Synthetic Source
+
+		Args:
+			encode (bool): True to produce H.264, False to produce raw frames
+			framerate (int): framerate
+		"""
+
+		super().__init__()
+		self.__properties__ = {}
+		self.__test_source__ = Gst.ElementFactory.make(
+			'videotestsrc', 'test-source')
+		self.__test_source__.set_property('is-live', True)
+		Gst.util_set_object_arg(self.__test_source__, 'pattern', 'ball')
+		self.add(self.__test_source__)
+		pad = self.__test_source__.get_static_pad('src')
+		self.__encoder__ = None
+		if encode:
+			self.__encoder__ = software_encoder(
+				'camera-encoder', 17000000, framerate)
+			self.add(self.__encoder__)
+			self.__test_source__.link(self.__encoder__)
+			pad = self.__encoder__.get_static_pad('src')
+		self.add_pad(Gst.GhostPad.new('src', pad))
+
+
+	def get_test_source(self):
+
+		"""
+		Return test source producing frames
+
+		Returns:
+			GstVideoTestSrc: test source
+		"""
+
+		return self.__test_source__
+
+
+	def do_get_property(self, prop):
+
+		"""
+		Return property value
+
+		Args:
+			prop (ParamSpec): property
+
+		Returns:
+			any: property value
+		"""
+
+		return self.__properties__.get(prop.name, prop.default_value)
+
+
+	def do_set_property(self, prop, value):
+
+		"""
+		Set property value
+
+		Args:
+			prop (ParamSpec): property
+			value (any): property value
+		"""
+
+		self.__properties__[prop.name] = value
+		if self.__encoder__ is None:
+			return
+		if prop.name == 'bitrate':
+			self.__encoder__.set_property('bitrate', max(1, value // 1000))
+		if prop.name == 'keyframe-interval' and value > 0:
+			self.__encoder__.set_property('key-int-max', value)
+
+
+class BenchmarkServer(camera.CameraServer):
+
+	"""
+	Camera Server building the real pipeline on the synthetic source
+	"""
+
+	def __get_source__(self):
+
+		"""
+		Return synthetic source
+
+		Returns:
+			SyntheticSource: synthetic source
+		"""
+
+		source = SyntheticSource(not self.__raw__, self.__framerate__)
+		source.set_name('camera-source')
+		return source
+
+
+	def get_source(self):
+
+		"""
+		Return source of the pipeline
+
+		Returns:
+			SyntheticSource: synthetic source
+		"""
+
+		return self.__source__
+
+
+	def get_sink(self):
+
+		"""
+		Return RTP sink of the pipeline
+
+		Returns:
+			GstUDPSink: RTP sink
+		"""
+
+		return self.__sink__
+
+
+class LatencyProbe(object):
+
+	"""
+	Latency Probe matching frames leaving the source with RTP packets
+	reaching the sink by their presentation timestamps
+	"""
+
+	def __init__(self, source, sink):
+
+		"""
+		Initialize Latency Probe
+
+		Args:
+			source (GstPad): pad frames leave the source through
+			sink (GstPad): pad RTP packets reach the sink through
+		"""
+
+		self.__lock__ = threading.Lock()
+		self.__pending__ = collections.OrderedDict()
+		self.reset()
+		source.add_probe(Gst.PadProbeType.BUFFER, self.__on_source__)
+		sink.add_probe(Gst.PadProbeType.BUFFER, self.__on_sink__)
+
+
+	def reset(self):
+
+		"""
+		Start new measurement window
+		"""
+
+		with self.__lock__:
+			self.__frames_in__ = 0
+			self.__frames_out__ = 0
+			self.__latencies__ = []
+
+
+	def __on_source__(self, pad, info):
+
+		"""
+		Remember when the frame left the source
+
+		Args:
+			pad (GstPad): source pad
+			info (GstPadProbeInfo): probe info
+
+		Returns:
+			GstPadProbeReturn: OK to pass the frame
+		"""
+
+		now = time.monotonic()
+		with self.__lock__:
+			self.__frames_in__ += 1
+			self.__pending__[info.get_buffer().pts] = now
+			# frames never reaching the sink are forgotten after a while
+			while len(self.__pending__) > 1000:
+				self.__pending__.popitem(last=False)
+		return Gst.PadProbeReturn.OK
+
+
+	def __on_sink__(self, pad, info):
+
+		"""
+		Record latency of the first RTP packet of the frame
+
+		Args:
+			pad (GstPad): sink pad
+			info (GstPadProbeInfo): probe info
+
+		Returns:
+			GstPadProbeReturn: OK to pass the packet
+		"""
+
+		now = time.monotonic()
+		with self.__lock__:
+			start = self.__pending__.pop(info.get_buffer().pts, None)
+			if start is not None:
+				self.__frames_out__ += 1
+				self.__latencies__.append(now - start)
+		return Gst.PadProbeReturn.OK
+
+
+	def get_results(self, duration):
+
+		"""
+		Return results of the measurement window
+
+		Args:
+			duration (float): duration of the window in seconds
+
+		Returns:
+			dict: fps, dropped frames and latency percentiles in milliseconds
+		"""
+
+		now = time.monotonic()
+		with self.__lock__:
+			# frames younger than a second may still be on their way
+			in_flight = sum(
+				1 for start in self.__pending__.values() if now - start < 1)
+			latencies = sorted(self.__latencies__)
+			results = {
+				'fps': round(self.__frames_out__ / duration, 2),
+				'drops': max(
+					0, self.__frames_in__ - self.__frames_out__ - in_flight)}
+		for name, percentile in (
+			('latency_p50', 0.5), ('latency_p99', 0.99), ('latency_max', 1)
+		):
+			value = None
+			if latencies:
+				value = round(
+					latencies[min(
+						len(latencies) - 1, int(len(latencies) * percentile))] *
+					1000, 2)
+			results[name] = value
+		return results
+
+
+def thread_times():
+
+	"""
+	Return CPU time consumed by the threads of this process
+
+	Returns:
+		dict: CPU time in clock ticks by thread name
+	"""
+
+	times = collections.Counter()
+	for tid in os.listdir('/proc/self/task'):
+		try:
+			with open('/proc/self/task/' + tid + '/comm', 'r') as comm:
+				thread_name = comm.read().strip()
+			with open('/proc/self/task/' + tid + '/stat', 'r') as stat:
+				fields = stat.read().rsplit(')', 1)[1].split()
+		except OSError:
+			continue
+		# utime and stime are 14th and 15th fields of the stat
+		times[thread_name] += int(fields[11]) + int(fields[12])
+	return times
+
+
+def rss():
+
+	"""
+	Return resident set size of this process
+
+	Returns:
+		int: resident set size in KiB
+	"""
+
+	with open('/proc/self/status', 'r') as status:
+		for line in status:
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1])
+	return 0
+
+
+def run_point(point, options, connection):
+
+	"""
+	Benchmark process entry method. Measures a single point of the matrix in
+	a fresh process, so that points do not affect each other.
+
+	Args:
+		point (dict): model, topology, width, height and framerate
+		options (Namespace): command line arguments
+		connection (Connection): connection to send the results over
+	"""
+
+	logging.basicConfig(
+		format="%(asctime)s %(levelname)s: %(message)s",
+		level=getattr(logging, options.debug.upper()))
+	directory = tempfile.mkdtemp(prefix='camera-benchmark-')
+	os.chdir(directory)
+	parameters = {
+		'persistent': 1, 'width': point['width'], 'height': point['height'],
+		'framerate': point['framerate'], 'rtsp': 0, 'stats': '0x00000000'}
+	parameters.update(TOPOLOGIES[point['topology']])
+	with open('camera.json', 'w') as config:
+		json.dump(parameters, config)
+	Gst.init(None)
+	# NOTE: Deferred callbacks of the server run on the default main loop,
+	# which the RTSP Server runs in the service.
+	loop = GLib.MainLoop()
+	loop_thread = threading.Thread(name='Main Loop Thread', target=loop.run)
+	loop_thread.start()
+	# NOTE: Encoder is fixed instead of selected, so that results are
+	# comparable between runs.
+	args = argparse.Namespace(
+		camera_timeout=0, throughput=1, zero_copy=False, camera_number=0,
+		port_offset=options.port_offset, debug=options.debug,
+		model=point['model'], encoder=encoder_name())
+	server = BenchmarkServer(args, camera.TelemetrySampler(), camera.Metrics())
+	server.start()
+	# pipeline may be rebuilt during start, e.g. when recording needs raw
+	# frames
+	probe = LatencyProbe(
+		server.get_source().get_test_source().get_static_pad('src'),
+		server.get_sink().get_static_pad('sink'))
+	time.sleep(options.warmup)
+	probe.reset()
+	start_times = thread_times()
+	start = time.monotonic()
+	time.sleep(options.duration)
+	duration = time.monotonic() - start
+	end_times = thread_times()
+	results = probe.get_results(duration)
+	ticks = os.sysconf('SC_CLK_TCK') * duration / 100
+	cpu = {}
+	for thread_name, value in (end_times - start_times).items():
+		cpu[thread_name] = round(value / ticks, 1)
+	results['cpu'] = round(sum(cpu.values()), 1)
+	results['threads'] = cpu
+	results['rss'] = rss()
+	server.set_persistent(0)
+	server.stop()
+	loop.quit()
+	loop_thread.join()
+	results.update(point)
+	connection.send(results)
+
+
+def key(result):
+
+	"""
+	Return key identifying the point of the matrix
+
+	Args:
+		result (dict): result of the point
+
+	Returns:
+		str: key
+	"""
+
+	return (
+		result['model'] + '/' + result['topology'] + '/' +
+		str(result['width']) + 'x' + str(result['height']) + '@' +
+		str(result['framerate']))
+
+
+def compare(results, baseline):
+
+	"""
+	Compare results with the baseline
+
+	Args:
+		results (list): results of the points
+		baseline (list): baseline results of the points
+
+	Returns:
+		list: regressions as (key, metric, baseline value, value)
+	"""
+
+	regressions = []
+	baseline = dict((key(result), result) for result in baseline)
+	for result in results:
+		reference = baseline.get(key(result))
+		if reference is None:
+			continue
+		for metric, tolerance in TOLERANCE.items():
+			value = result.get(metric)
+			expected = reference.get(metric)
+			if value is None or expected is None:
+				continue
+			limit = expected * (1 + tolerance)
+			if metric == 'drops':
+				# a couple of frames may be lost while the source settles
+				limit = expected + 2
+			if (
+				(tolerance < 0 and value < limit) or
+				(tolerance >= 0 and value > limit)
+			):
+				regressions.append((key(result), metric, expected, value))
+	return regressions
+
+
+def mode(value):
+
+	"""
+	Parse resolution and framerate
+
+	Args:
+		value (str): WIDTHxHEIGHT@FRAMERATE
+
+	Returns:
+		tuple: width, height and framerate
+
+	Raises:
+		ArgumentTypeError: if value is invalid
+	"""
+
+	try:
+		resolution, framerate = value.split('@')
+		width, height = resolution.split('x')
+		return int(width), int(height), int(framerate)
+	except ValueError:
+		raise argparse.ArgumentTypeError(
+			"invalid mode '" + value + "', expected WIDTHxHEIGHT@FRAMERATE")
+
+
+def get_parser():
+
+	"""
+	Parse input arguments
+
+	Returns:
+		parser (ArgumentParser): argument parser
+	"""
+
+	parser = argparse.ArgumentParser(
+		description="Benchmark camera pipelines on the synthetic source")
+	parser.add_argument(
+		'-d', '--debug', type=str, default='WARNING',
+		help="set debug level (WARNING by default)")
+	parser.add_argument(
+		'-m', '--model', type=str, action='append', choices=MODELS,
+		help="benchmark pipeline of the camera model, may be repeated (all "
+		"by default)")
+	parser.add_argument(
+		'-t', '--topology', type=str, action='append', choices=TOPOLOGIES,
+		help="benchmark topology, may be repeated (all by default)")
+	parser.add_argument(
+		'-r', '--mode', type=mode, action='append',
+		help="benchmark resolution and framerate WIDTHxHEIGHT@FRAMERATE, may "
+		"be repeated (" + ', '.join(MODES) + " by default)")
+	parser.add_argument(
+		'-w', '--warmup', type=float, default=3,
+		help="set warm up time in seconds (3 s by default)")
+	parser.add_argument(
+		'-s', '--duration', type=float, default=10,
+		help="set measurement time in seconds (10 s by default)")
+	# NOTE: RTP is sent away from the ports of the running service.
+	parser.add_argument(
+		'-p', '--port_offset', type=int, default=100,
+		help="offset RTP port (100 by default)")
+	parser.add_argument(
+		'-o', '--output', type=str, default='benchmark.json',
+		help="write results to the file (benchmark.json by default)")
+	parser.add_argument(
+		'-b', '--baseline', type=str, default=None,
+		help="compare results with the baseline file and fail on regression")
+	parser.add_argument(
+		'-u', '--update', action='store_true',
+		help="store results as the new baseline")
+	return parser
+
+
+def main():
+
+	"""
+	Benchmark entry method
+	"""
+
+	options = get_parser().parse_args()
+	logging.basicConfig(
+		format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+	models = options.model or MODELS
+	topologies = options.topology or list(TOPOLOGIES)
+	modes = options.mode or [mode(value) for value in MODES]
+	context = multiprocessing.get_context('spawn')
+	results = []
+	for model in models:
+		for topology in topologies:
+			for width, height, framerate in modes:
+				point = {
+					'model': model, 'topology': topology, 'width': width,
+					'height': height, 'framerate': framerate}
+				connection, child_connection = context.Pipe()
+				process = context.Process(
+					target=run_point, args=(point, options, child_connection))
+				process.start()
+				child_connection.close()
+				timeout = options.warmup + options.duration + 60
+				if connection.poll(timeout):
+					result = connection.recv()
+				else:
+					result = dict(point, error='timeout')
+				process.join(10)
+				if process.is_alive():
+					process.terminate()
+				if 'error' not in result and process.exitcode not in (0, None):
+					result['error'] = 'exit code ' + str(process.exitcode)
+				logging.info(key(point) + ": " + json.dumps(
+					dict((name, value) for name, value in result.items()
+					if name != 'threads'), sort_keys=True))
+				results.append(result)
+	report = {
+		'host': platform.node(), 'machine': platform.machine(),
+		'gstreamer': Gst.version_string(), 'encoder': encoder_name(),
+		'results': results}
+	camera.write_atomic(options.output, json.dumps(report, indent=4))
+	failed = [result for result in results if 'error' in result]
+	for result in failed:
+		logging.error(key(result) + " failed: " + result['error'])
+	if options.baseline is None:
+		return len(failed) > 0
+	if options.update:
+		camera.write_atomic(options.baseline, json.dumps(report, indent=4))
+		logging.info("Baseline '" + options.baseline + "' updated")
+		return len(failed) > 0
+	try:
+		with open(options.baseline, 'r') as baseline:
+			baseline = json.load(baseline)
+	except OSError:
+		logging.warning("Baseline '" + options.baseline + "' not found")
+		return len(failed) > 0
+	regressions = compare(results, baseline['results'])
+	for point, metric, expected, value in regressions:
+		logging.error(
+			point + ": " + metric + " regressed from " + str(expected) +
+			" to " + str(value))
+	return len(failed) > 0 or len(regressions) > 0
+
+
+if __name__ == '__main__':
+
+	Gst.init(None)
+	sys.exit(1 if main() else 0)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+"""
+MIT License
+
+Copyright (c) 2021-2022 Marcin Sielski <marcin.sielski@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import argparse
+import array
+import datetime
+import fcntl
+import grp
+import json
+import logging
+import os
+import pwd
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+
+# NOTE: Tags of the VideoCore mailbox property interface, see
+# https://github.com/raspberrypi/firmware/wiki/Mailbox-property-interface
+FIRMWARE = {
+	'get_throttled': (0x00030046, 0),
+	'measure_temp': (0x00030006, 0),
+	'measure_clock_arm': (0x00030047, 3),
+	'measure_clock_core': (0x00030047, 4),
+}
+
+
+class Firmware(object):
+
+	"""
+	Firmware queries issued over the VideoCore mailbox in-process, so that
+	frequent queries do not fork vcgencmd. Results are cached for the time to
+	live, so that concurrent clients share a single query.
+	"""
+
+	# _IOWR(100, 0, char *)
+	IOCTL_MBOX_PROPERTY = 0xC0006400 | (struct.calcsize('P') << 16)
+
+
+	def __init__(self, ttl=1):
+
+		"""
+		Initialize Firmware
+
+		Args:
+			ttl (float): time to live of the cached results in seconds
+		"""
+
+		self.__ttl__ = ttl
+		self.__lock__ = threading.Lock()
+		self.__cache__ = {}
+		self.__mailbox__ = None
+		try:
+			self.__mailbox__ = os.open('/dev/vcio', os.O_RDONLY)
+		except OSError:
+			logging.warning("'/dev/vcio' not available")
+
+
+	def query(self, name):
+
+		"""
+		Query the firmware
+
+		Args:
+			name (str): name of the query, one of FIRMWARE
+
+		Returns:
+			int: value reported by the firmware
+		"""
+
+		if self.__mailbox__ is None:
+			raise OSError("VideoCore mailbox not available")
+		tag, argument = FIRMWARE[name]
+		with self.__lock__:
+			now = time.monotonic()
+			cached = self.__cache__.get(name)
+			if cached is not None and now - cached[0] < self.__ttl__:
+				return cached[1]
+			buffer = array.array(
+				'I', [8 * 4, 0, tag, 8, 0, argument, 0, 0])
+			fcntl.ioctl(
+				self.__mailbox__, self.IOCTL_MBOX_PROPERTY, buffer, True)
+			value = buffer[5] if name == 'get_throttled' else buffer[6]
+			self.__cache__[name] = (now, value)
+			return value
+
+
+	def close(self):
+
+		"""
+		Close the mailbox
+		"""
+
+		if self.__mailbox__ is not None:
+			os.close(self.__mailbox__)
+
+
+class Broker(object):
+
+	"""
+	Broker performing privileged operations on behalf of the camera service
+	"""
+
+	def __init__(self, firmware, hwclock='/etc/fake-hwclock.data'):
+
+		"""
+		Initialize Broker
+
+		Args:
+			firmware (Firmware): firmware queries
+			hwclock (str): path to the file with saved clock
+		"""
+
+		self.__firmware__ = firmware
+		self.__hwclock__ = hwclock
+		self.__lock__ = threading.Lock()
+
+
+	def set_time(self, seconds):
+
+		"""
+		Set system time and save it, so that it survives reboot
+
+		Args:
+			seconds (float): seconds since the epoch
+
+		Returns:
+			bool: True if the clock was saved
+		"""
+
+		with self.__lock__:
+			time.clock_settime(time.CLOCK_REALTIME, float(seconds))
+			logging.info("Time set to " + str(seconds))
+		# NOTE: The clock was set explicitly, so it is saved even if it goes
+		# back in time.
+		return self.save_hwclock(True)
+
+
+	def save_hwclock(self, force=False):
+
+		"""
+		Save system time the same way 'fake-hwclock save' does and flush
+		file system buffers
+
+		Args:
+			force (bool): save even if saved time is later than system time
+
+		Returns:
+			bool: True if the clock was saved
+		"""
+
+		with self.__lock__:
+			now = datetime.datetime.utcnow().replace(microsecond=0)
+			if not force:
+				try:
+					with open(self.__hwclock__, 'r') as file:
+						saved = datetime.datetime.strptime(
+							file.readline().strip(), '%Y-%m-%d %H:%M:%S')
+					if saved > now:
+						logging.warning(
+							"Saved time " + str(saved) + " is later than "
+							"system time " + str(now) + ", not saving")
+						os.sync()
+						return False
+				except (OSError, ValueError):
+					pass
+			path = self.__hwclock__ + '.tmp'
+			with open(path, 'w') as file:
+				file.write(now.strftime('%Y-%m-%d %H:%M:%S') + '\n')
+				file.flush()
+				os.fsync(file.fileno())
+			os.replace(path, self.__hwclock__)
+			os.sync()
+			return True
+
+
+	def query(self, name):
+
+		"""
+		Query the firmware
+
+		Args:
+			name (str): name of the query, one of FIRMWARE
+
+		Returns:
+			int: value reported by the firmware
+		"""
+
+		return self.__firmware__.query(name)
+
+
+	def dispatch(self, method, args):
+
+		"""
+		Dispatch request
+
+		Args:
+			method (str): method name
+			args (list): method arguments
+
+		Returns:
+			object: method result
+		"""
+
+		if method == 'set_time':
+			return self.set_time(*args)
+		if method == 'save_hwclock':
+			return self.save_hwclock(*args)
+		if method in FIRMWARE:
+			return self.query(method)
+		raise ValueError("Unknown method '" + str(method) + "'")
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+
+	"""
+	Broker connection handler exchanging JSON encoded requests and replies,
+	one per line
+	"""
+
+	def handle(self):
+
+		"""
+		Handle requests of the connection until it is closed
+		"""
+
+		credentials = self.request.getsockopt(
+			socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+		pid, uid, gid = struct.unpack('3i', credentials)
+		if uid != 0 and uid not in self.server.uids:
+			logging.warning(
+				"Rejected process " + str(pid) + " of user " + str(uid))
+			return
+		for line in self.rfile:
+			reply = {}
+			try:
+				request = json.loads(line)
+				reply['id'] = request.get('id')
+				reply['result'] = self.server.broker.dispatch(
+					request['method'], request.get('args', []))
+			except Exception as e:
+				logging.error("Request failed: " + str(e))
+				reply['error'] = str(e)
+			self.wfile.write(json.dumps(reply).encode() + b'\n')
+			self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+	"""
+	Broker Server listening on the unix socket
+	"""
+
+	daemon_threads = True
+
+
+	def __init__(self, path, broker, user='pi'):
+
+		"""
+		Initialize Broker Server
+
+		Args:
+			path (str): path to the unix socket
+			broker (Broker): broker
+			user (str): user allowed to connect in addition to root
+		"""
+
+		self.broker = broker
+		entry = pwd.getpwnam(user)
+		self.uids = (entry.pw_uid,)
+		if os.path.exists(path):
+			os.unlink(path)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+		os.chown(path, 0, grp.getgrgid(entry.pw_gid).gr_gid)
+		os.chmod(path, 0o660)
+
+
+def get_parser():
+
+	"""
+	Parse input arguments
+
+	Returns:
+		parser (ArgumentParser): argument parser
+	"""
+
+	parser = argparse.ArgumentParser(
+		description="Perform privileged operations of the camera service: set "
+		"clock, save clock and query firmware, must run as root")
+	parser.add_argument(
+		'-s', '--socket', type=str, default='/run/camera/broker.sock',
+		help="listen on the unix socket (/run/camera/broker.sock by default)")
+	parser.add_argument(
+		'-u', '--user', type=str, default='pi',
+		help="allow the user to connect (pi by default)")
+	parser.add_argument(
+		'-f', '--hwclock', type=str, default='/etc/fake-hwclock.data',
+		help="save clock to the file (/etc/fake-hwclock.data by default)")
+	parser.add_argument(
+		'-t', '--ttl', type=float, default=1,
+		help="cache firmware query results for seconds (1 s by default)")
+	parser.add_argument(
+		'-d', '--debug', type=str, nargs='?', const='DEBUG', default='INFO',
+		help="enable debug level (DEBUG by default): NOTSET, DEBUG, INFO, "
+		"WARNING, ERROR, CRITICAL")
+	return parser
+
+
+def main():
+
+	"""
+	Broker entry method
+	"""
+
+	options = get_parser().parse_args()
+	logging.basicConfig(
+		format="%(asctime)s %(levelname)s: %(message)s",
+		level=getattr(logging, options.debug.upper()))
+	firmware = Firmware(options.ttl)
+	server = BrokerServer(
+		options.socket, Broker(firmware, options.hwclock), options.user)
+	signal.signal(
+		signal.SIGTERM, lambda signum, frame: threading.Thread(
+			target=server.shutdown).start())
+	logging.info("Broker listening on " + options.socket)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+	os.unlink(options.socket)
+	firmware.close()
+	return 0
+
+
+if __name__ == '__main__':
+
+	sys.exit(main())
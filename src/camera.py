@@ -24,40 +24,111 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
+import json
+
+
+CAMERA_CACHE = 'camera-probe.json'
+ENCODER_CACHE = 'encoder-probe.json'
+ZERO_COPY_CACHE = 'zero-copy.json'
+MODELS = ('imx219', 'imx477', 'ov9281', 'v4l2')
+
+
+def camera_probe_key():
+
+	"""
+	Return key identifying hardware and camera firmware the camera was detected
+	with
+
+	Returns:
+		list: device tree model and size and modification time of camera
+			firmware files
+	"""
+
+	key = []
+	try:
+		with open('/proc/device-tree/model', 'rb') as model:
+			key.append(model.read().rstrip(b'\0').decode('utf-8', 'replace'))
+	except OSError:
+		key.append(None)
+	for firmware in ('/boot/start_x.elf', '/boot/start4x.elf'):
+		try:
+			stat = os.stat(firmware)
+			key.append([stat.st_size, int(stat.st_mtime)])
+		except OSError:
+			key.append(None)
+	return key
+
+
+def cached_camera():
+
+	"""
+	Return camera model detected previously on the same hardware and firmware
+
+	Returns:
+		str: camera model, None if detection has to be repeated
+	"""
+
+	try:
+		with open(CAMERA_CACHE, 'r') as cache:
+			probe = json.load(cache)
+		if probe['key'] == camera_probe_key():
+			return probe['model']
+	except (OSError, ValueError, KeyError, TypeError):
+		pass
+	return None
+
+
 # picamera module must be imported before gi module, 
-# otherwise stack corruption occurs.
-import picamera
+# otherwise stack corruption occurs. It is needed only to detect the camera so
+# it is not imported when the detection result is cached, nor required on
+# hosts without camera, e.g. when benchmarking.
+picamera = None
+if cached_camera() is None:
+	try:
+		import picamera
+	except ImportError:
+		pass
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstBase', '1.0')
 gi.require_version('GstRtspServer', '1.0')
+gi.require_version('GstAllocators', '1.0')
 from gi.repository import Gst, GstBase, GstRtspServer, GLib
+from gi.repository import GstAllocators
 from signal import pause
-from subprocess import call
-from os import system
+from subprocess import call, check_output, CalledProcessError
 #from netifaces import ifaddresses
 import threading
 import time
 import falcon
 from wsgiserver import WSGIServer
-import json
 import logging
-import inspect
 from argparse import ArgumentParser, ArgumentTypeError
 import signal
-import os
-import shutil
-import psutil
-from gpiozero import DiskUsage, CPUTemperature
-import subprocess
 import datetime
-import arducam_mipicamera as arducam
 import sys
-#import tracemalloc
-#tracemalloc.start()
+import hashlib
+import hmac
+import http.client
+import socket
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+import collections
+import struct
+import array
+import fcntl
+import bisect
+import math
+import multiprocessing
+import copy
+import tracemalloc
+import gc
+import queue
 
 
 def camera_revision():
+	import arducam_mipicamera as arducam
 	stdout_bk = os.dup(sys.stderr.fileno())
 	pipefd = os.pipe2(0)
 	os.dup2(pipefd[1], sys.stderr.fileno())
@@ -77,570 +148,3879 @@ def camera_revision():
 	return revision
 
 
-def name(obj):
+def detect_camera():
 
 	"""
-	Utility function that adds space before 'Serv' in the name of the object
-
-	Args:
-		obj (any): object
+	Detect camera model. Detection result is cached and reused as long as
+	hardware and camera firmware do not change.
 
 	Returns:
-		str: returns human readable name of name of the specified object
+		str: camera model, None if camera is not available
 	"""
-	
-	return type(obj).__name__.replace("Serv", " Serv")
+
+	model = cached_camera()
+	if model is not None:
+		logging.info("'" + model + "' camera detected (cached)")
+		return model
+	# NOTE: picamera module is not imported yet if the detection was cached
+	# when the process started and has been forgotten since.
+	module = picamera
+	if module is None:
+		try:
+			import picamera as module
+		except ImportError:
+			pass
+	if module is not None:
+		try:
+			with module.PiCamera() as camera:
+				model = camera.revision
+		except module.PiCameraError:
+			pass
+	if model is None:
+		model = camera_revision()
+		if model != 'ov9281':
+			return None
+	logging.info("'" + model + "' camera detected")
+	try:
+		write_atomic(
+			CAMERA_CACHE,
+			json.dumps({'key': camera_probe_key(), 'model': model}))
+	except OSError as e:
+		logging.warning("Unable to cache camera detection: " + str(e))
+	return model
 
 
-class Server(object):
+def forget_camera():
 
 	"""
-	Server Interface
+	Remove cached camera detection so that it is repeated on the next start
+	"""
+
+	try:
+		os.remove(CAMERA_CACHE)
+	except OSError:
+		pass
+
+
+def prewarm_registry(model):
+
+	"""
+	Load GStreamer plugins used by the pipeline of the specified camera so
+	that the pipeline does not wait for them. Must be called after Gst.init().
 
 	Args:
-		object (object): base object
+		model (str): camera model
 	"""
 
+	factories = [
+		'capsfilter', 'tee', 'queue', 'h264parse', 'rtph264pay', 'udpsink',
+		'splitmuxsink', 'mp4mux', 'v4l2h264enc']
+	if model == 'ov9281':
+		factories = factories + ['arducamsrc', 'textoverlay', 'videoconvert']
+	elif model == 'v4l2':
+		factories = factories + ['v4l2src', 'videoconvert']
+	else:
+		factories = factories + ['rpicamsrc']
+	for factory_name in factories:
+		factory = Gst.ElementFactory.find(factory_name)
+		if factory is not None:
+			factory.load()
+	TIMELINE.mark("registry prewarmed")
 
-	def init(self):
+
+class StartupTimeline(object):
+
+	"""
+	Startup timeline measured from the process start and from the boot
+	"""
+
+	def __init__(self):
 
 		"""
-		Initialize the Server
+		Initialize Startup Timeline
 		"""
 
-		pass
+		self.__start__ = time.monotonic()
+		self.__events__ = set()
+		self.__lock__ = threading.Lock()
+		# NOTE: Process start time is taken from the kernel so that the time
+		# spent importing modules is also accounted.
+		try:
+			with open('/proc/uptime', 'r') as uptime:
+				self.__boot__ = float(uptime.read().split()[0])
+			with open('/proc/self/stat', 'r') as stat:
+				fields = stat.read().rsplit(')', 1)[1].split()
+			self.__process__ = \
+				int(fields[19]) / os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+		except (OSError, ValueError, IndexError, KeyError):
+			self.__boot__ = None
+			self.__process__ = None
 
 
-	def start(self):
+	def is_marked(self, event):
 
 		"""
-		Starts execution of the Server
+		Check if event was already marked
+
+		Args:
+			event (str): event
+
+		Returns:
+			bool: True if event was marked, False otherwise
 		"""
 
-		pass
+		return event in self.__events__
 
 
-	def stop(self):
+	def mark(self, event):
 
 		"""
-		Stops execution of the Server
+		Log event on the timeline. Only the first occurrence is logged.
+
+		Args:
+			event (str): event
 		"""
 
-		pass
+		with self.__lock__:
+			if event in self.__events__:
+				return
+			self.__events__.add(event)
+		elapsed = time.monotonic() - self.__start__
+		if self.__boot__ is None:
+			logging.info(
+				"Startup: " + event + " at " + str(round(elapsed, 3)) + " s")
+			return
+		uptime = self.__boot__ + elapsed
+		logging.info(
+			"Startup: " + event + " at " +
+			str(round(uptime - self.__process__, 3)) +
+			" s since process start, " + str(round(uptime, 3)) +
+			" s since boot")
 
 
-	def restart(self):
+TIMELINE = StartupTimeline()
 
-		"""
-		Restarts the Server
-		"""
 
-		self.stop()
-		self.init()
-		self.start()
+def name(obj):
 
+	"""
+	Utility function that adds space before 'Serv' in the name of the object
 
-class RTSPServer(Server):
+	Args:
+		obj (any): object
 
+	Returns:
+		str: returns human readable name of name of the specified object
 	"""
-	Real Time Streaming Protocol (RTSP) Server
+	
+	return type(obj).__name__.replace("Serv", " Serv")
+
+
+def write_atomic(path, data):
+
 	"""
+	Write file so that it contains either old or new content even if power is
+	lost during the write
 
+	Args:
+		path (str): path to the file
+		data (str or bytes): content of the file
+	"""
 
-	def __init__(
-		self, camera_server, address='0.0.0.0', port='8000', path='/pi'):
+	mode = 'wb' if isinstance(data, bytes) else 'w'
+	with open(path + '.tmp', mode) as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(path + '.tmp', path)
+	directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+	try:
+		os.fsync(directory)
+	finally:
+		os.close(directory)
 
-		"""
-		Initialize RTSP Server
 
-		Args:
-			address (str): ip address
-			port (str): port
-			path (str): path
-		"""
+def sd_notify(state):
 
-		self.__address__ = address
-		self.__port__ = port
-		self.__path__ = path
-		self.__camera_server__ = camera_server
-		self.__main_loop__ = GLib.MainLoop()
+	"""
+	Send state to systemd over the notification socket
 
-		server = GstRtspServer.RTSPServer.new()
-		#address = ifaddresses('wlan1')[2][0]['addr']
-		launch_description = (
-			'( udpsrc port=3141 ! application/x-rtp, '
-			'media=video, encoding-name=H264, clock-rate=90000 ! rtph264depay '
-			'! rtph264pay name=pay0 )')
-		server.set_address(self.__address__)
-		server.set_service(self.__port__)
-		server.connect('client-connected', self.client_connected) 
-		factory = GstRtspServer.RTSPMediaFactory.new()
-		factory.set_launch(launch_description)
-		factory.set_shared(True)
-		factory.set_transport_mode(GstRtspServer.RTSPTransportMode.PLAY)
-		mount_points = server.get_mount_points()
-		mount_points.add_factory(self.__path__, factory)
-		server.attach(None)
+	Args:
+		state (str): state, e.g. 'READY=1' or 'WATCHDOG=1'
 
+	Returns:
+		bool: True if state was sent, False if not running under systemd
+	"""
 
-	def client_connected(self, server, client):
+	address = os.environ.get('NOTIFY_SOCKET')
+	if not address:
+		return False
+	if address.startswith('@'):
+		address = '\0' + address[1:]
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+			notify.sendto(state.encode('utf-8'), address)
+	except OSError as e:
+		logging.warning("Unable to notify systemd: " + str(e))
+		return False
+	return True
+
+
+class PersistentFile(object):
+
+	"""
+	File written atomically in the background. Writes that do not change the
+	content are skipped and bursts of writes are coalesced into a single write
+	per interval.
+	"""
+
+	def __init__(self, path, interval=5):
 
 		"""
-		Callback method executed upon client connection
+		Initialize Persistent File
 
 		Args:
-			server (RTSPServer): RTSP server
-			client (RTSPClient): RTSP client
+			path (str): path to the file
+			interval (int): minimum interval between writes in seconds
 		"""
 
-		logging.info(
-			"RTSP Client connected from " + client.get_connection().get_ip())
-		self.__camera_server__.send_keyframe()
+		self.__path__ = path
+		self.__interval__ = interval
+		self.__lock__ = threading.Lock()
+		self.__timer__ = None
+		self.__data__ = None
+		try:
+			with open(self.__path__, 'r') as f:
+				self.__written__ = f.read()
+		except:
+			self.__written__ = None
 
 
-	def start(self):
+	def write(self, data):
 
 		"""
-		Start RTSP Server
+		Schedule write of the content
+
+		Args:
+			data (str): content of the file
 		"""
 
-		logging.info(
-			name(self) + " started at rtsp://" + self.__address__ + ":" + 
-			self.__port__ + self.__path__)
-		self.__main_loop__.run()
+		with self.__lock__:
+			self.__data__ = data
+			if data == self.__written__ or self.__timer__ is not None:
+				return
+			self.__timer__ = threading.Timer(self.__interval__, self.flush)
+			self.__timer__.daemon = True
+			self.__timer__.start()
 
 
-	def stop(self):
+	def flush(self):
 
 		"""
-		Stop RTSP Server
+		Write pending content immediately
 		"""
 
-		self.__main_loop__.quit()
-		logging.info(name(self) + " stopped")
+		with self.__lock__:
+			if self.__timer__ is not None:
+				self.__timer__.cancel()
+				self.__timer__ = None
+			data = self.__data__
+			if data is None or data == self.__written__:
+				return
+			try:
+				write_atomic(self.__path__, data)
+				self.__written__ = data
+				logging.info("Written '" + self.__path__ + "' file")
+			except OSError as e:
+				logging.error(
+					"Unable to write '" + self.__path__ + "' file: " + str(e))
 
 
-class CORSComponent(object):
+class Tracer(object):
 
 	"""
-	Cross-Origin Resource Sharing (CORS) Component as defined at
-	https://falcon.readthedocs.io/en/stable/user/faq.html#how-do-i-implement-cors-with-falcon
+	Tracer that keeps recent events in memory. Events are stored with their
+	format and arguments and are formatted only when they are logged at debug
+	level or dumped, so that tracing is cheap on hot paths.
 	"""
 
-	def process_response(self, req, resp, resource, req_succeeded):
+	BEGIN = 'entry'
+	EVENT = ''
+	END = 'exit'
+
+
+	def __init__(self, size=4096):
 
 		"""
-		Process response from HTTPS Server and add CORS headers
+		Initialize Tracer
 
 		Args:
-			req (Request): request
-			resp (Response): response
-			resource (HTTPSServer): HTTPS Server
-			req_succeeded (bool): indicated if request succeeded
+			size (int): number of recent events to keep
 		"""
 
-		resp.set_header('Access-Control-Allow-Origin', '*')
-
-		if (
-			req_succeeded and 
-			req.method == 'OPTIONS' and 
-			req.get_header('Access-Control-Request-Method')
-		):
-			# NOTE(kgriffs): This is a CORS preflight request. Patch the
-			#   response accordingly.
+		self.__ring__ = collections.deque(maxlen=size)
+		self.__logger__ = logging.getLogger()
 
-			allow = resp.get_header('Allow')
-			resp.delete_header('Allow')
 
-			allow_headers = req.get_header(
-				'Access-Control-Request-Headers',
-				default='*'
-			)
+	def __record__(self, kind, span, message, args):
 
-			resp.set_headers((
-				('Access-Control-Allow-Methods', allow),
-				('Access-Control-Allow-Headers', allow_headers),
-				('Access-Control-Max-Age', '86400'),  # 24 hours
-			))
+		"""
+		Record event in the ring and forward it to the log at debug level
 
+		Args:
+			kind (str): kind of the event
+			span (str): name of the span
+			message (str): message format
+			args (tuple): message arguments
+		"""
 
-class HTTPSServer(WSGIServer):
+		thread = threading.current_thread().name
+		self.__ring__.append(
+			(time.time(), thread, kind, span, message, args))
+		if self.__logger__.isEnabledFor(logging.DEBUG):
+			logging.debug(self.__message__(thread, kind, span, message, args))
 
-	"""
-	HyperText Transfer Protocol Secure (HTTPS) Server
-	"""
 
-	def __init__(
-		self, camera_server, address='0.0.0.0', port=8888, path='/',
-		keyfile='/opt/camera/bin/key.pem', certfile='/opt/camera/bin/cert.pem'):
+	def __message__(self, thread, kind, span, message, args):
 
 		"""
-		Initialize HTTPS Server
+		Format event
 
 		Args:
-			camera_server (CameraServer): camera server
-			address (str): address
-			port (str): port
-			path (str): path
-			keyfile (str): path to keyfile
-			certfile (str): path to certfile
+			thread (str): name of the thread
+			kind (str): kind of the event
+			span (str): name of the span
+			message (str): message format
+			args (tuple): message arguments
+
+		Returns:
+			str: formatted event
 		"""
 
-		self.__camera_server__ = camera_server
-		self.__address__ = address
-		self.__port__ = port
-		self.__path__ = path
-		app = falcon.API(middleware=[CORSComponent()])
-		#app.add_route('/pi', self)
-		app.add_route(path, self)
-		super().__init__(
-			app, host=self.__address__, port=self.__port__, keyfile=keyfile, 
-			certfile=certfile)
+		if message is None:
+			message = kind
+		elif args:
+			message = message % args
+		if kind == Tracer.BEGIN and message != kind:
+			message = kind + ' ' + message
+		return "'" + thread + "'." + span + ": " + message
 
 
-	def start(self):
+	def begin(self, span, message=None, *args):
 
 		"""
-		Start HTTPS Server
+		Record beginning of the span
+
+		Args:
+			span (str): name of the span
+			message (str): optional message format
+			args: message arguments
 		"""
 
-		logging.info(
-			name(self) + " started at https://" + self.__address__ + ":" + 
-			str(self.__port__) + self.__path__)
-		super().start()
+		self.__record__(Tracer.BEGIN, span, message, args)
 
 
-	def stop(self):
+	def event(self, span, message, *args):
 
 		"""
-		Stop HTTPS Server
+		Record event within the span
+
+		Args:
+			span (str): name of the span
+			message (str): message format
+			args: message arguments
 		"""
 
-		super().stop()
-		logging.info(name(self) + " stopped")
+		self.__record__(Tracer.EVENT, span, message, args)
 
 
-	def error_log(self, msg, level, traceback):
+	def end(self, span, message=None, *args):
 
 		"""
-		Log error message
+		Record end of the span
 
 		Args:
-			msg (str): error message
-			level (int): log level
-			traceback (bool): indicate whether to enable backtrace
+			span (str): name of the span
+			message (str): optional message format
+			args: message arguments
 		"""
-  
-		if msg != 'Error in HTTPServer.tick':
-			logging.log(level, msg)
-			if traceback:
-				logging.log(level, logging.traceback.format_exc())
 
+		self.__record__(Tracer.END, span, message, args)
 
-	def on_get(self, req, resp):
+
+	def dump(self, level=logging.ERROR):
 
 		"""
-		Handle HTTP GET request
+		Log recent events and clear the ring
 
 		Args:
-			req (Request): request
-			resp (Response): response
+			level (int): log level to dump events at
 		"""
 
-		logging.info(req.params)
-		resp.status = falcon.HTTP_200
-
-		# Quality
+		events = []
+		while True:
+			try:
+				events.append(self.__ring__.popleft())
+			except IndexError:
+				break
+		logging.log(level, "Trace of " + str(len(events)) + " recent events")
+		for timestamp, thread, kind, span, message, args in events:
+			try:
+				text = self.__message__(thread, kind, span, message, args)
+			except Exception as e:
+				text = "'" + thread + "'." + span + ": " + repr(e)
+			logging.log(
+				level, datetime.datetime.fromtimestamp(timestamp).strftime(
+					'%H:%M:%S.%f') + ' ' + text)
 
-		if 'width' in req.params and 'height' in req.params:
-			self.__camera_server__.set_resolution(int(req.params['width']),
-			int(req.params['height']))
-		if 'framerate' in req.params:
-			self.__camera_server__.set_framerate(int(req.params['framerate']))
-		if 'bitrate_mode' in req.params:
-			self.__camera_server__.set_bitrate_mode(
-				int(req.params['bitrate_mode']))
-		if 'bitrate' in req.params:
-			self.__camera_server__.set_bitrate(int(req.params['bitrate']))
-		if 'sensor_mode' in req.params:
-			self.__camera_server__.set_sensor_mode(
-				int(req.params['sensor_mode']))
 
-		# Effects
+TRACER = Tracer()
 
-		if 'brightness' in req.params:
-			self.__camera_server__.set_brightness(
-				int(req.params['brightness']))
-		if 'contrast' in req.params:
-			self.__camera_server__.set_contrast(int(req.params['contrast']))
-		if 'saturation' in req.params:
-			self.__camera_server__.set_saturation(int(req.params['saturation']))
-		if 'sharpness' in req.params:
-			self.__camera_server__.set_sharpness(int(req.params['sharpness']))
-		if 'drc' in req.params:
-			self.__camera_server__.set_drc(int(req.params['drc']))
-		if 'image_effect' in req.params:
-			self.__camera_server__.set_image_effect(
-				int(req.params['image_effect']))
-		if 'awb_mode' in req.params:
-			self.__camera_server__.set_awb_mode(int(req.params['awb_mode']))
-		if 'awb_gain_blue' in req.params:
-			self.__camera_server__.set_awb_gain_blue(
-				int(req.params['awb_gain_blue']))
-		if 'awb_gain_red' in req.params:
-			self.__camera_server__.set_awb_gain_red(
-				int(req.params['awb_gain_red']))
 
-		# Controls
+class Server(object):
 
-		if 'exposure_mode' in req.params:
-			self.__camera_server__.set_exposure_mode(
-				int(req.params['exposure_mode']))
-		if 'exposure_compensation' in req.params:
-			self.__camera_server__.set_exposure_compensation(
-				int(req.params['exposure_compensation']))
-		if 'metering_mode' in req.params:
-			self.__camera_server__.set_metering_mode(
-				int(req.params['metering_mode']))
-		if 'iso' in req.params:
-			self.__camera_server__.set_iso(int(req.params['iso']))
-		if 'shutter_speed' in req.params:
-			self.__camera_server__.set_shutter_speed(
-				int(req.params['shutter_speed']))
-		if 'video_stabilisation' in req.params:
-			self.__camera_server__.set_video_stabilisation(
-				req.params['video_stabilisation'] == '1')
-		if 'gain' in req.params:
-			self.__camera_server__.set_gain(int(req.params['gain']))
-		if 'awb' in req.params:
-			self.__camera_server__.set_awb(int(req.params['awb']))
+	"""
+	Server Interface
 
-		# Orientation
+	Args:
+		object (object): base object
+	"""
 
-		if 'rotation' in req.params:
-			self.__camera_server__.set_rotation(int(req.params['rotation']))
-		if 'hflip' in req.params:
-			self.__camera_server__.set_hflip(req.params['hflip'] == '1')
-		if 'vflip' in req.params:
-			self.__camera_server__.set_vflip(req.params['vflip'] == '1')
-		if 'video_direction' in req.params:
-			self.__camera_server__.set_video_direction(
-				int(req.params['video_direction']))
 
-		# Controls
+	def init(self):
 
-		if 'logging_level' in req.params:
-			self.__camera_server__.set_logging_level(
-				int(req.params['logging_level']))
-		if 'stats' in req.params:
-			self.__camera_server__.set_stats(int(req.params['stats'],16))
-		if 'rtsp' in req.params:
-			self.__camera_server__.set_rtsp(req.params['rtsp'] == '1')
-		if 'record' in req.params:
-			self.__camera_server__.set_record(req.params['record'] == '1')
-		if 'format' in req.params:
-			self.__camera_server__.set_format(req.params['format'] == '1')
-		if 'max_files' in req.params:
-			self.__camera_server__.set_max_files(int(req.params['max_files']))
-		if 'max_size_bytes' in req.params:
-			self.__camera_server__.set_max_size_bytes(
-				int(req.params['max_size_bytes']))
-		if 'max_size_time' in req.params:
-			self.__camera_server__.set_max_size_time(
-				int(req.params['max_size_time']))
-		if 'persistent' in req.params:
-			self.__camera_server__.set_persistent(int(req.params['persistent']))
-		if 'continuation' in req.params:
-			self.__camera_server__.set_continuation(
-				req.params['continuation'] == '1')
-		if 'media' in req.params:
-			resp.text = (self.__camera_server__.get_media())
-			return
-		if 'restart' in req.params:
-			self.__camera_server__.restart()
-		if 'remove' in req.params:
-			self.__camera_server__.remove(req.params['remove'])
-			resp.text = (self.__camera_server__.get_media())
-			return
-		if 'time' in req.params:
-			self.__camera_server__.set_time(int(req.params['time']))
+		"""
+		Initialize the Server
+		"""
 
-		resp.text = (self.__camera_server__.get_parameters())
+		pass
 
 
-class CameraServer(Server):
-	
-	"""
-	Camera Server
-	"""
+	def start(self):
 
-	def __init__(self, args):
+		"""
+		Starts execution of the Server
+		"""
+
+		pass
+
+
+	def stop(self):
 
 		"""
-		Initialize Camera Server
+		Stops execution of the Server
 		"""
 
-		self.__camera_timeout__ = args.camera_timeout
-		self.__throughput__ = args.throughput
-		self.__default_logging_level__ = getattr(logging, args.debug.upper())
-		self.__error_lock__ = threading.Lock()
-		self.__main_lock__ = threading.Lock()
-		#self.__stats_lock__ = threading.Lock()
-		self.__restart_lock__ = threading.Lock()
-		try:
-			with picamera.PiCamera() as camera:
-				self.__model__ = camera.revision
-		except:
-			self.__model__ = camera_revision()
-		self.__stats_id__ = 0
-		self.__extra_controls__ = 'encode,video_bitrate_mode={},h264_profile=0,\
-			h264_level=11,video_bitrate={},h264_i_frame_period={}'
-		parameters = None
+		pass
 
-		try:
-			with open('camera.json', 'r') as config:
-				parameters = json.load(config)
-		except:
-			logging.warning("'camera.json' not found")
 
-		if parameters is not None and 'persistent' in parameters and \
-			parameters['persistent'] == 1:
+	def restart(self):
 
-			logging.info("Loading parameters from 'camera.json'")
-			
-			# Quality
+		"""
+		Restarts the Server
+		"""
 
-			if 'width' in parameters:
-				self.__width__ = parameters['width']
-			else:
-				if self.__model__ == 'imx219' or self.__model__ == 'imx477':
-					self.__width__ = 800
-				if self.__model__ == 'ov9281':
-					self.__width__ = 1280
-			if 'height' in parameters:
-				self.__height__ = parameters['height']
-			else:
-				if self.__model__ == 'imx219' or self.__model__ == 'imx477':
-					self.__height__ = 608
-				if self.__model__ == 'ov9281':
-					self.__width__ = 800
-			if 'framerate' in parameters:
-				self.__framerate__ = parameters['framerate']
-			else:
-				self.__framerate__ = 30
-			if 'bitrate_mode' in parameters:
-				self.__bitrate_mode__ = parameters['bitrate_mode']
-			else:
-				self.__bitrate_mode__ = 0
-			if 'bitrate' in parameters:
-				self.__bitrate__ = parameters['bitrate']
-			else:
-				self.__bitrate__ = 3000000
-			if 'sensor_mode' in parameters:
-				self.__sensor_mode__ = parameters['sensor_mode']
-			else:
-				self.__sensor_mode__ = 0
+		self.stop()
+		self.init()
+		self.start()
 
-			# Effects	
 
-			if 'brightness' in parameters:
-				self.__brightness__ = parameters['brightness']
-			else:
-				self.__brightness__ = 50
-			if 'contrast' in parameters:
-				self.__contrast__ = parameters['contrast']
-			else:
-				self.__contrast__ = 0
-			if 'saturation' in parameters:
-				self.__saturation__ = parameters['saturation']
-			else:
-				self.__saturation__ = 0
-			if 'sharpness' in parameters:
-				self.__sharpness__ = parameters['sharpness']
-			else:
-				self.sharpness = 0
-			if 'drc' in parameters:
-				self.__drc__ = parameters['drc']
-			else:
-				self.__drc = 0
-			if 'image_effect' in parameters:
-				self.__image_effect__ = parameters['image_effect']
-			else:
-				self.__image_effect__ = 0
-			if 'awb_mode' in parameters:
-				self.__awb_mode__ = parameters['awb_mode']
-			else:
-				self.__awb_mode__ = 1
-			if 'awb_gain_blue' in parameters:
-				self.__awb_gain_blue__ = parameters['awb_gain_blue']
-			else:
-				self.__awb_gain_blue__ = 0
-			if 'awb_gain_red' in parameters:
-				self.__awb_gain_red__ = parameters['awb_gain_red']
-			else:
-				self.__awb_gain_red__ = 0
+class RTSPServer(Server):
 
-			# Settings
+	"""
+	Real Time Streaming Protocol (RTSP) Server
+	"""
 
-			if 'exposure_mode' in parameters:
-				self.__exposure_mode__ = parameters['exposure_mode']
-			else:
-				self.__exposure_mode__ = 1
-			if 'metering_mode' in parameters:
-				self.__metering_mode__ = parameters['metering_mode']
-			else:
-				self.__metering_mode__ = 0
-			if 'exposure_compensation' in parameters:
-				self.__exposure_compensation__ = \
-					parameters['exposure_compensation']
-			else:
-				self.__exposure_compensation__ = 0
-			if 'iso' in parameters:
-				self.__iso__ = parameters['iso']
-			else:
-				self.__iso__ = 0
-			if 'shutter_speed' in parameters:
-				self.__shutter_speed__ = parameters['shutter_speed']
-			else:
-				self.__shutter_speed__ = 0
-			if 'video_stabilisation' in parameters:
-				self.__video_stabilisation__ = \
-					(parameters['video_stabilisation'] == 1)
-			else:
-				self.__video_stabilisation__ = False
-			if 'gain' in parameters:
-				self.__gain__ = parameters['gain']
-			else:
-				self.__gain__ = 1
-			if 'awb' in parameters:
-				self.__awb__ = parameters['awb']
-			else:
-				self.__awb__ = 4
 
-			# Orientation
+	def __init__(
+		self, camera_server, address='0.0.0.0', port='8000', path='/pi',
+		metrics=None, rtp_port=3141):
 
-			if 'rotation' in parameters:
-				self.__rotation__ = parameters['rotation']
-			else:
-				self.__rotation__ = 0
-			if 'hflip' in parameters:
-				self.__hflip__ = (parameters['hflip'] == 1)
-			else:
-				self.__hflip__ = False
-			if 'vflip' in parameters:
-				self.__vflip__ = (parameters['vflip'] == 1)
-			else:
-				self.__vflip__ = False
-			if 'video_direction' in parameters:
-				self.__video_direction__ = parameters['video_direction']
-			else:
-				self.__video_direction__ = 0
-	
-			# Controls
+		"""
+		Initialize RTSP Server
 
-			if 'logging_level' in parameters:
-				self.__logging_level__ = parameters['logging_level']
-			else:
+		Args:
+			address (str): ip address
+			port (str): port
+			path (str): path
+			metrics (Metrics): metrics
+			rtp_port (int): local port RTP packets are received on
+		"""
+
+		self.__metrics__ = metrics
+		self.__address__ = address
+		self.__port__ = port
+		self.__path__ = path
+		self.__camera_server__ = camera_server
+		self.__main_loop__ = GLib.MainLoop()
+
+		server = GstRtspServer.RTSPServer.new()
+		#address = ifaddresses('wlan1')[2][0]['addr']
+		server.set_address(self.__address__)
+		server.set_service(self.__port__)
+		server.connect('client-connected', self.client_connected) 
+		self.__mount_points__ = server.get_mount_points()
+		self.__mount_points__.add_factory(
+			self.__path__, self.__get_factory__(rtp_port))
+		server.attach(None)
+
+
+	def __get_factory__(self, rtp_port):
+
+		"""
+		Return media factory relaying RTP packets received on the local port
+
+		Args:
+			rtp_port (int): local port RTP packets are received on
+
+		Returns:
+			RTSPMediaFactory: media factory
+		"""
+
+		launch_description = (
+			'( udpsrc port=' + str(rtp_port) + ' ! application/x-rtp, '
+			'media=video, encoding-name=H264, clock-rate=90000 ! rtph264depay '
+			'! rtph264pay name=pay0 )')
+		factory = GstRtspServer.RTSPMediaFactory.new()
+		factory.set_launch(launch_description)
+		factory.set_shared(True)
+		factory.set_transport_mode(GstRtspServer.RTSPTransportMode.PLAY)
+		return factory
+
+
+	def add_mount(self, mount_name, rtp_port):
+
+		"""
+		Serve RTP packets received on the local port below the path of the
+		camera, e.g. at /pi/gate
+
+		Args:
+			mount_name (str): name of the mount point
+			rtp_port (int): local port RTP packets are received on
+		"""
+
+		path = self.__path__.rstrip('/') + '/' + mount_name
+		self.__mount_points__.add_factory(path, self.__get_factory__(rtp_port))
+		logging.info("RTSP mount " + path + " added")
+
+
+	def remove_mount(self, mount_name):
+
+		"""
+		Stop serving the mount point
+
+		Args:
+			mount_name (str): name of the mount point
+		"""
+
+		path = self.__path__.rstrip('/') + '/' + mount_name
+		self.__mount_points__.remove_factory(path)
+		logging.info("RTSP mount " + path + " removed")
+
+
+	def client_connected(self, server, client):
+
+		"""
+		Callback method executed upon client connection
+
+		Args:
+			server (RTSPServer): RTSP server
+			client (RTSPClient): RTSP client
+		"""
+
+		logging.info(
+			"RTSP Client connected from " + client.get_connection().get_ip())
+		if self.__metrics__ is not None:
+			self.__metrics__.set_rtsp_clients(1)
+			client.connect('closed', self.client_closed)
+		self.__camera_server__.send_keyframe()
+
+
+	def client_closed(self, client):
+
+		"""
+		Callback method executed upon client disconnection
+
+		Args:
+			client (RTSPClient): RTSP client
+		"""
+
+		self.__metrics__.set_rtsp_clients(-1)
+
+
+	def start(self):
+
+		"""
+		Start RTSP Server
+		"""
+
+		logging.info(
+			name(self) + " started at rtsp://" + self.__address__ + ":" + 
+			self.__port__ + self.__path__)
+		self.__main_loop__.run()
+
+
+	def stop(self):
+
+		"""
+		Stop RTSP Server
+		"""
+
+		self.__main_loop__.quit()
+		logging.info(name(self) + " stopped")
+
+
+class CORSComponent(object):
+
+	"""
+	Cross-Origin Resource Sharing (CORS) Component as defined at
+	https://falcon.readthedocs.io/en/stable/user/faq.html#how-do-i-implement-cors-with-falcon
+	"""
+
+	def process_response(self, req, resp, resource, req_succeeded):
+
+		"""
+		Process response from HTTPS Server and add CORS headers
+
+		Args:
+			req (Request): request
+			resp (Response): response
+			resource (HTTPSServer): HTTPS Server
+			req_succeeded (bool): indicated if request succeeded
+		"""
+
+		resp.set_header('Access-Control-Allow-Origin', '*')
+
+		if (
+			req_succeeded and 
+			req.method == 'OPTIONS' and 
+			req.get_header('Access-Control-Request-Method')
+		):
+			# NOTE(kgriffs): This is a CORS preflight request. Patch the
+			#   response accordingly.
+
+			allow = resp.get_header('Allow')
+			resp.delete_header('Allow')
+
+			allow_headers = req.get_header(
+				'Access-Control-Request-Headers',
+				default='*'
+			)
+
+			resp.set_headers((
+				('Access-Control-Allow-Methods', allow),
+				('Access-Control-Allow-Headers', allow_headers),
+				('Access-Control-Max-Age', '86400'),  # 24 hours
+			))
+
+
+class MetricsComponent(object):
+
+	"""
+	Component measuring latency of the requests handled by HTTPS Server
+	"""
+
+	def __init__(self, metrics):
+
+		"""
+		Initialize Metrics Component
+
+		Args:
+			metrics (Metrics): metrics
+		"""
+
+		self.__metrics__ = metrics
+
+
+	def process_request(self, req, resp):
+
+		"""
+		Process request to HTTPS Server and remember its arrival time
+
+		Args:
+			req (Request): request
+			resp (Response): response
+		"""
+
+		req.context.start = time.monotonic()
+
+
+	def process_response(self, req, resp, resource, req_succeeded):
+
+		"""
+		Process response from HTTPS Server and record request latency
+
+		Args:
+			req (Request): request
+			resp (Response): response
+			resource (HTTPSServer): HTTPS Server
+			req_succeeded (bool): indicated if request succeeded
+		"""
+
+		start = getattr(req.context, 'start', None)
+		if start is not None:
+			self.__metrics__.observe_request(time.monotonic() - start)
+
+
+class CameraComponent(object):
+
+	"""
+	Component routing requests to the camera selected with 'camera' parameter
+	"""
+
+	def __init__(self, cameras):
+
+		"""
+		Initialize Camera Component
+
+		Args:
+			cameras (dict): media processes of the cameras by camera id
+		"""
+
+		self.__cameras__ = cameras
+
+
+	def process_request(self, req, resp):
+
+		"""
+		Select camera for the request
+
+		Args:
+			req (Request): request
+			resp (Response): response
+		"""
+
+		camera_id = req.params.get('camera')
+		if camera_id is None:
+			return
+		if camera_id not in self.__cameras__:
+			raise falcon.HTTPNotFound(
+				description="Camera '" + camera_id + "' not found")
+		media = self.__cameras__[camera_id]
+		req.context.camera_server = media.get_proxy('camera')
+		req.context.history = media.get_proxy('history')
+		req.context.watchdog = media.get_proxy('watchdog')
+		req.context.profiler = media.get_proxy('profiler')
+
+
+class MetricsResource(object):
+
+	"""
+	Resource exposing metrics in the Prometheus text format
+	"""
+
+	def __init__(self, camera_server):
+
+		"""
+		Initialize Metrics Resource
+
+		Args:
+			camera_server (CameraServer): camera server
+		"""
+
+		self.__camera_server__ = camera_server
+
+
+	def on_get(self, req, resp):
+
+		"""
+		Handle HTTP GET request
+
+		Args:
+			req (Request): request
+			resp (Response): response
+		"""
+
+		camera_server = getattr(
+			req.context, 'camera_server', self.__camera_server__)
+		resp.status = falcon.HTTP_200
+		resp.content_type = 'text/plain; version=0.0.4'
+		resp.text = camera_server.get_metrics()
+
+
+class HealthResource(object):
+
+	"""
+	Resource exposing health of the pipeline
+	"""
+
+	def __init__(self, watchdog):
+
+		"""
+		Initialize Health Resource
+
+		Args:
+			watchdog (FlowWatchdog): flow watchdog
+		"""
+
+		self.__watchdog__ = watchdog
+
+
+	def on_get(self, req, resp):
+
+		"""
+		Handle HTTP GET request
+
+		Args:
+			req (Request): request
+			resp (Response): response
+		"""
+
+		watchdog = getattr(req.context, 'watchdog', self.__watchdog__)
+		health = watchdog.get_health()
+		health['stalled'] = [Metrics.BRANCHES[branch]
+			for branch in health['stalled']]
+		if health['status'] == 'ok':
+			resp.status = falcon.HTTP_200
+		else:
+			resp.status = falcon.HTTP_503
+		resp.text = json.dumps(health, sort_keys=True)
+
+
+class HeapResource(object):
+
+	"""
+	Resource exposing heap usage and the top allocation differences since the
+	baseline snapshot
+	"""
+
+	def __init__(self, profiler):
+
+		"""
+		Initialize Heap Resource
+
+		Args:
+			profiler (HeapProfiler): heap profiler
+		"""
+
+		self.__profiler__ = profiler
+
+
+	def on_get(self, req, resp):
+
+		"""
+		Handle HTTP GET request
+
+		Args:
+			req (Request): request
+			resp (Response): response
+		"""
+
+		profiler = getattr(req.context, 'profiler', self.__profiler__)
+		resp.status = falcon.HTTP_200
+		resp.text = profiler.get_heap(
+			int(req.params.get('limit', 10)),
+			req.params.get('baseline', '0') == '1')
+
+
+class HTTPSServer(WSGIServer):
+
+	"""
+	HyperText Transfer Protocol Secure (HTTPS) Server
+	"""
+
+	def __init__(
+		self, camera_server, address='0.0.0.0', port=8888, path='/',
+		keyfile='/opt/camera/bin/key.pem', certfile='/opt/camera/bin/cert.pem',
+		metrics=None, history=None, watchdog=None, cameras=None,
+		profiler=None):
+
+		"""
+		Initialize HTTPS Server
+
+		Args:
+			camera_server (CameraServer): camera server
+			address (str): address
+			port (str): port
+			path (str): path
+			keyfile (str): path to keyfile
+			certfile (str): path to certfile
+			metrics (Metrics): metrics
+			history (TelemetryHistory): telemetry history
+			watchdog (FlowWatchdog): flow watchdog
+			cameras (dict): media processes of the cameras by camera id
+			profiler (HeapProfiler): heap profiler
+		"""
+
+		self.__camera_server__ = camera_server
+		self.__history__ = history
+		self.__cameras__ = cameras
+		self.__address__ = address
+		self.__port__ = port
+		self.__path__ = path
+		middleware = [CORSComponent()]
+		if metrics is not None:
+			middleware.append(MetricsComponent(metrics))
+		if cameras is not None:
+			middleware.append(CameraComponent(cameras))
+		app = falcon.API(middleware=middleware)
+		#app.add_route('/pi', self)
+		app.add_route(path, self)
+		app.add_route('/metrics', MetricsResource(camera_server))
+		if watchdog is not None:
+			app.add_route('/health', HealthResource(watchdog))
+		if profiler is not None:
+			app.add_route('/admin/heap', HeapResource(profiler))
+		super().__init__(
+			app, host=self.__address__, port=self.__port__, keyfile=keyfile, 
+			certfile=certfile)
+
+
+	def start(self):
+
+		"""
+		Start HTTPS Server
+		"""
+
+		logging.info(
+			name(self) + " started at https://" + self.__address__ + ":" + 
+			str(self.__port__) + self.__path__)
+		super().start()
+
+
+	def stop(self):
+
+		"""
+		Stop HTTPS Server
+		"""
+
+		super().stop()
+		logging.info(name(self) + " stopped")
+
+
+	def error_log(self, msg, level, traceback):
+
+		"""
+		Log error message
+
+		Args:
+			msg (str): error message
+			level (int): log level
+			traceback (bool): indicate whether to enable backtrace
+		"""
+  
+		if msg != 'Error in HTTPServer.tick':
+			logging.log(level, msg)
+			if traceback:
+				logging.log(level, logging.traceback.format_exc())
+
+
+	def on_get(self, req, resp):
+
+		"""
+		Handle HTTP GET request
+
+		Args:
+			req (Request): request
+			resp (Response): response
+		"""
+
+		logging.info(req.params)
+		resp.status = falcon.HTTP_200
+		camera_server = getattr(
+			req.context, 'camera_server', self.__camera_server__)
+		history = getattr(req.context, 'history', self.__history__)
+		if 'cameras' in req.params and self.__cameras__ is not None:
+			resp.text = json.dumps(sorted(self.__cameras__))
+			return
+
+		# Quality
+
+		if 'width' in req.params and 'height' in req.params:
+			camera_server.set_resolution(int(req.params['width']),
+			int(req.params['height']))
+		if 'framerate' in req.params:
+			camera_server.set_framerate(int(req.params['framerate']))
+		if 'bitrate_mode' in req.params:
+			camera_server.set_bitrate_mode(
+				int(req.params['bitrate_mode']))
+		if 'bitrate' in req.params:
+			camera_server.set_bitrate(int(req.params['bitrate']))
+		if 'sensor_mode' in req.params:
+			camera_server.set_sensor_mode(
+				int(req.params['sensor_mode']))
+
+		# Effects
+
+		if 'brightness' in req.params:
+			camera_server.set_brightness(
+				int(req.params['brightness']))
+		if 'contrast' in req.params:
+			camera_server.set_contrast(int(req.params['contrast']))
+		if 'saturation' in req.params:
+			camera_server.set_saturation(int(req.params['saturation']))
+		if 'sharpness' in req.params:
+			camera_server.set_sharpness(int(req.params['sharpness']))
+		if 'drc' in req.params:
+			camera_server.set_drc(int(req.params['drc']))
+		if 'image_effect' in req.params:
+			camera_server.set_image_effect(
+				int(req.params['image_effect']))
+		if 'awb_mode' in req.params:
+			camera_server.set_awb_mode(int(req.params['awb_mode']))
+		if 'awb_gain_blue' in req.params:
+			camera_server.set_awb_gain_blue(
+				int(req.params['awb_gain_blue']))
+		if 'awb_gain_red' in req.params:
+			camera_server.set_awb_gain_red(
+				int(req.params['awb_gain_red']))
+
+		# Controls
+
+		if 'exposure_mode' in req.params:
+			camera_server.set_exposure_mode(
+				int(req.params['exposure_mode']))
+		if 'exposure_compensation' in req.params:
+			camera_server.set_exposure_compensation(
+				int(req.params['exposure_compensation']))
+		if 'metering_mode' in req.params:
+			camera_server.set_metering_mode(
+				int(req.params['metering_mode']))
+		if 'iso' in req.params:
+			camera_server.set_iso(int(req.params['iso']))
+		if 'shutter_speed' in req.params:
+			camera_server.set_shutter_speed(
+				int(req.params['shutter_speed']))
+		if 'video_stabilisation' in req.params:
+			camera_server.set_video_stabilisation(
+				req.params['video_stabilisation'] == '1')
+		if 'gain' in req.params:
+			camera_server.set_gain(int(req.params['gain']))
+		if 'awb' in req.params:
+			camera_server.set_awb(int(req.params['awb']))
+
+		# Orientation
+
+		if 'rotation' in req.params:
+			camera_server.set_rotation(int(req.params['rotation']))
+		if 'hflip' in req.params:
+			camera_server.set_hflip(req.params['hflip'] == '1')
+		if 'vflip' in req.params:
+			camera_server.set_vflip(req.params['vflip'] == '1')
+		if 'video_direction' in req.params:
+			camera_server.set_video_direction(
+				int(req.params['video_direction']))
+
+		# Controls
+
+		if 'logging_level' in req.params:
+			camera_server.set_logging_level(
+				int(req.params['logging_level']))
+		if 'stats' in req.params:
+			camera_server.set_stats(int(req.params['stats'],16))
+		if 'rtsp' in req.params:
+			camera_server.set_rtsp(req.params['rtsp'] == '1')
+		if 'record' in req.params:
+			camera_server.set_record(req.params['record'] == '1')
+		if 'format' in req.params:
+			camera_server.set_format(req.params['format'] == '1')
+		if 'max_files' in req.params:
+			camera_server.set_max_files(int(req.params['max_files']))
+		if 'max_size_bytes' in req.params:
+			camera_server.set_max_size_bytes(
+				int(req.params['max_size_bytes']))
+		if 'max_size_time' in req.params:
+			camera_server.set_max_size_time(
+				int(req.params['max_size_time']))
+		if 'timelapse' in req.params:
+			camera_server.set_timelapse(int(req.params['timelapse']))
+		if 'roi' in req.params:
+			camera_server.set_roi(
+				req.params['roi'], int(req.params.get('roi_x', 0)),
+				int(req.params.get('roi_y', 0)),
+				int(req.params.get('roi_width', 0)),
+				int(req.params.get('roi_height', 0)),
+				int(req.params.get('roi_output_width', 0)),
+				int(req.params.get('roi_output_height', 0)),
+				int(req.params.get('roi_bitrate', 0)))
+			camera_server.store()
+			resp.text = (camera_server.get_rois())
+			return
+		if 'remove_roi' in req.params:
+			camera_server.remove_roi(req.params['remove_roi'])
+			camera_server.store()
+			resp.text = (camera_server.get_rois())
+			return
+		if 'rois' in req.params:
+			resp.text = (camera_server.get_rois())
+			return
+		if 'persistent' in req.params:
+			camera_server.set_persistent(int(req.params['persistent']))
+		if 'continuation' in req.params:
+			camera_server.set_continuation(
+				req.params['continuation'] == '1')
+		if 'media' in req.params:
+			resp.text = (camera_server.get_media())
+			return
+		if 'telemetry' in req.params:
+			resp.text = (camera_server.get_telemetry())
+			return
+		if 'history' in req.params and history is not None:
+			resp.text = (history.get_history())
+			return
+		if 'zero_copy' in req.params:
+			resp.text = (camera_server.get_zero_copy())
+			return
+		if 'recovery' in req.params:
+			resp.text = (camera_server.get_recovery())
+			return
+		if 'lifecycle' in req.params:
+			resp.text = (camera_server.get_lifecycle())
+			return
+		if 'encoder' in req.params:
+			resp.text = (camera_server.get_encoder())
+			return
+		if 'restart' in req.params:
+			camera_server.restart()
+		if 'remove' in req.params:
+			camera_server.remove(req.params['remove'])
+			resp.text = (camera_server.get_media())
+			return
+		if 'time' in req.params:
+			if not camera_server.set_time(int(req.params['time'])):
+				raise falcon.HTTPServiceUnavailable(
+					description="Broker is not running, time is not set")
+
+		camera_server.store()
+		resp.text = (camera_server.get_parameters())
+
+
+class Uploader(Server):
+
+	"""
+	Uploader of closed recording fragments to the S3 compatible storage
+	"""
+
+	# NOTE: Timelapse files are not recording fragments and are not subject
+	# to the retention.
+	FRAGMENTS = ('_H264_', '_HYUV_')
+
+
+	def __init__(
+		self, url, access_key, secret_key, region='us-east-1', bandwidth=0,
+		part_size=8388608, state='upload.json'):
+
+		"""
+		Initialize Uploader
+
+		Args:
+			url (str): storage url in form scheme://host[:port]/bucket[/prefix]
+			access_key (str): access key
+			secret_key (str): secret key
+			region (str): region
+			bandwidth (int): bandwidth cap in KiB/s, 0 means unlimited
+			part_size (int): size of the multipart upload part in bytes
+			state (str): path to the file with persistent upload state
+		"""
+
+		url = urllib.parse.urlsplit(url)
+		path = url.path.strip('/').split('/', 1)
+		self.__scheme__ = url.scheme
+		self.__host__ = url.netloc
+		self.__bucket__ = path[0]
+		self.__prefix__ = ''
+		if len(path) > 1 and path[1] != '':
+			self.__prefix__ = path[1] + '/'
+		self.__prefix__ = self.__prefix__ + socket.gethostname() + '/'
+		self.__access_key__ = access_key
+		self.__secret_key__ = secret_key
+		self.__region__ = region
+		self.__bandwidth__ = bandwidth * 1024
+		# current upload rate adjusted to the uplink congestion
+		self.__rate__ = self.__bandwidth__
+		self.__part_size__ = part_size
+		self.__state__ = PersistentFile(state)
+		self.__max_files__ = 0
+		self.__running__ = False
+		self.__lock__ = threading.Lock()
+		self.__event__ = threading.Event()
+		self.__stop_event__ = threading.Event()
+		self.__pending__ = []
+		self.__uploaded__ = []
+		try:
+			with open(state, 'r') as f:
+				state = json.load(f)
+			self.__pending__ = [
+				entry for entry in state['pending']
+				if os.path.exists(entry['location'])]
+			self.__uploaded__ = [
+				location for location in state['uploaded']
+				if os.path.exists(location)]
+		except:
+			logging.warning("'" + state + "' not found")
+
+
+	def __save_state__(self):
+
+		"""
+		Schedule write of upload state to disk so that uploads resume after
+		reboot
+		"""
+
+		with self.__lock__:
+			state = json.dumps(
+				{'pending': self.__pending__, 'uploaded': self.__uploaded__})
+		self.__state__.write(state)
+
+
+	def enqueue(self, location):
+
+		"""
+		Schedule closed recording fragment for upload
+
+		Args:
+			location (str): path to the recording fragment
+		"""
+
+		with self.__lock__:
+			if (
+				location in self.__uploaded__ or
+				any(entry['location'] == location
+					for entry in self.__pending__)
+			):
+				return
+			self.__pending__.append({
+				'location': location,
+				'key': self.__prefix__ + time.strftime('%Y%m%d-%H%M%S_') +
+					os.path.basename(location),
+				'upload_id': None,
+				'parts': []})
+		self.__save_state__()
+		self.__event__.set()
+
+
+	def is_uploaded(self, location):
+
+		"""
+		Check if the recording fragment was confirmed by the storage
+
+		Args:
+			location (str): path to the recording fragment
+
+		Returns:
+			bool: True if the recording fragment was uploaded, False otherwise
+		"""
+
+		with self.__lock__:
+			return location in self.__uploaded__
+
+
+	def set_max_files(self, max_files):
+
+		"""
+		Set maximum number of recorded video files to keep on storage device.
+		Only uploaded files are deleted to make room for the new ones.
+
+		Args:
+			max_files (int): maximum number of recorded video files
+		"""
+
+		self.__max_files__ = max_files
+		self.__event__.set()
+
+
+	def __retain__(self):
+
+		"""
+		Delete the oldest uploaded recording fragments above the limit
+		"""
+
+		if self.__max_files__ <= 0:
+			return
+		_, _, filenames = next(os.walk('.'))
+		fragments = sorted(
+			[filename for filename in filenames
+				if any(tag in filename for tag in self.FRAGMENTS) and
+				(filename.endswith('.mkv') or filename.endswith('.mp4'))],
+			key=os.path.getmtime)
+		excess = len(fragments) - self.__max_files__
+		for fragment in fragments:
+			if excess <= 0:
+				break
+			if self.is_uploaded(fragment):
+				logging.info("Removing uploaded fragment " + fragment)
+				os.remove(fragment)
+				with self.__lock__:
+					self.__uploaded__.remove(fragment)
+				excess = excess - 1
+		self.__save_state__()
+
+
+	def __sign__(self, method, path, query, headers):
+
+		"""
+		Sign the request with AWS Signature Version 4
+
+		Args:
+			method (str): HTTP method
+			path (str): quoted request path
+			query (str): canonical query string
+			headers (dict): request headers to sign
+		"""
+
+		amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+		scope = amz_date[:8] + '/' + self.__region__ + '/s3/aws4_request'
+		headers['host'] = self.__host__
+		headers['x-amz-date'] = amz_date
+		headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+		signed_headers = ';'.join(sorted(headers))
+		canonical_request = '\n'.join([
+			method, path, query,
+			''.join(
+				name + ':' + str(headers[name]).strip() + '\n'
+				for name in sorted(headers)),
+			signed_headers, 'UNSIGNED-PAYLOAD'])
+		string_to_sign = '\n'.join([
+			'AWS4-HMAC-SHA256', amz_date, scope,
+			hashlib.sha256(canonical_request.encode()).hexdigest()])
+		key = ('AWS4' + self.__secret_key__).encode()
+		for part in scope.split('/'):
+			key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+		headers['Authorization'] = (
+			'AWS4-HMAC-SHA256 Credential=' + self.__access_key__ + '/' + scope +
+			', SignedHeaders=' + signed_headers + ', Signature=' +
+			hmac.new(
+				key, string_to_sign.encode(), hashlib.sha256).hexdigest())
+
+
+	def __request__(self, method, key, query, body=b'', length=None):
+
+		"""
+		Execute request against the storage
+
+		Args:
+			method (str): HTTP method
+			key (str): object key
+			query (dict): query parameters
+			body (bytes or file): request body
+			length (int): length of the request body read from the file
+
+		Returns:
+			tuple: status, response headers and response body
+		"""
+
+		path = urllib.parse.quote(
+			'/' + self.__bucket__ + '/' + key, safe='/-_.~')
+		query = '&'.join(
+			urllib.parse.quote(k, safe='-_.~') + '=' +
+			urllib.parse.quote(str(v), safe='-_.~')
+			for k, v in sorted(query.items()))
+		if length is None:
+			length = len(body)
+		headers = {'content-length': str(length)}
+		self.__sign__(method, path, query, headers)
+		if self.__scheme__ == 'https':
+			connection = http.client.HTTPSConnection(self.__host__, timeout=60)
+		else:
+			connection = http.client.HTTPConnection(self.__host__, timeout=60)
+		try:
+			connection.putrequest(
+				method, path + '?' + query, skip_host=True,
+				skip_accept_encoding=True)
+			for name, value in headers.items():
+				connection.putheader(name, value)
+			connection.endheaders()
+			if isinstance(body, bytes):
+				connection.send(body)
+			else:
+				self.__send__(connection, body, length)
+			response = connection.getresponse()
+			data = response.read()
+			if response.status >= 300 or b'<Error>' in data:
+				raise http.client.HTTPException(
+					method + ' ' + key + ' failed with ' +
+					str(response.status) + ': ' + data.decode(errors='replace'))
+			return response.status, response.headers, data
+		finally:
+			connection.close()
+
+
+	def __send__(self, connection, f, length):
+
+		"""
+		Send the part of the file limiting the rate to the current bandwidth
+		and backing off when the uplink is congested by the live streaming
+
+		Args:
+			connection (HTTPConnection): connection
+			f (file): file positioned at the beginning of the part
+			length (int): length of the part
+		"""
+
+		chunk_size = 65536
+		sent = 0
+		shaped = 0
+		start = time.monotonic()
+		while sent < length:
+			if not self.__running__:
+				raise http.client.HTTPException("Upload interrupted")
+			chunk = f.read(min(chunk_size, length - sent))
+			if not chunk:
+				raise http.client.HTTPException("Fragment truncated")
+			chunk_start = time.monotonic()
+			connection.send(chunk)
+			now = time.monotonic()
+			sent = sent + len(chunk)
+			shaped = shaped + len(chunk)
+			# send blocks when the socket buffer is full, i.e. the uplink is
+			# saturated, so halve the rate to make room for the live stream
+			if now - chunk_start > 0.5:
+				self.__rate__ = max(
+					16384, int((self.__rate__ or shaped / (now - start)) / 2))
+				logging.debug(
+					"Uplink congested, upload rate reduced to " +
+					str(self.__rate__ // 1024) + " KiB/s")
+				self.__stop_event__.wait(1)
+				start = time.monotonic()
+				shaped = 0
+			elif self.__rate__ > 0:
+				delay = shaped / self.__rate__ - (now - start)
+				if delay > 0:
+					self.__stop_event__.wait(delay)
+		if self.__rate__ > 0:
+			self.__rate__ = self.__rate__ + 16384
+			if self.__bandwidth__ > 0 and self.__rate__ > self.__bandwidth__:
+				self.__rate__ = self.__bandwidth__
+
+
+	def __upload__(self, entry):
+
+		"""
+		Upload recording fragment with multipart upload
+
+		Args:
+			entry (dict): upload state of the recording fragment
+		"""
+
+		location = entry['location']
+		size = os.path.getsize(location)
+		if entry['upload_id'] is None:
+			_, _, data = self.__request__(
+				'POST', entry['key'], {'uploads': ''})
+			# NOTE: Namespace wildcards are not supported by Python on Buster.
+			entry['upload_id'] = next(
+				element.text for element in ElementTree.fromstring(data).iter()
+				if element.tag.endswith('UploadId'))
+			entry['parts'] = []
+			self.__save_state__()
+		logging.info(
+			"Uploading " + location + " to " + entry['key'] + " from part " +
+			str(len(entry['parts']) + 1))
+		with open(location, 'rb') as f:
+			while (
+				len(entry['parts']) * self.__part_size__ < size or
+				len(entry['parts']) == 0
+			):
+				offset = len(entry['parts']) * self.__part_size__
+				length = min(self.__part_size__, size - offset)
+				f.seek(offset)
+				_, headers, _ = self.__request__(
+					'PUT', entry['key'],
+					{
+						'partNumber': len(entry['parts']) + 1,
+						'uploadId': entry['upload_id']
+					}, f, length)
+				entry['parts'].append(
+					[len(entry['parts']) + 1, headers.get('ETag', '')])
+				self.__save_state__()
+		body = '<CompleteMultipartUpload>' + ''.join(
+			'<Part><PartNumber>' + str(number) + '</PartNumber><ETag>' +
+			etag + '</ETag></Part>' for number, etag in entry['parts']) + \
+			'</CompleteMultipartUpload>'
+		self.__request__(
+			'POST', entry['key'], {'uploadId': entry['upload_id']},
+			body.encode())
+		with self.__lock__:
+			self.__pending__.remove(entry)
+			self.__uploaded__.append(location)
+		self.__save_state__()
+		logging.info("Uploaded " + location)
+
+
+	def start(self):
+
+		"""
+		Start Uploader
+		"""
+
+		logging.info(
+			name(self) + " started at " + self.__scheme__ + "://" +
+			self.__host__ + "/" + self.__bucket__ + "/" + self.__prefix__)
+		self.__running__ = True
+		backoff = 1
+		while self.__running__:
+			self.__retain__()
+			with self.__lock__:
+				entry = self.__pending__[0] if self.__pending__ else None
+			if entry is None:
+				self.__event__.wait()
+				self.__event__.clear()
+				continue
+			try:
+				if not os.path.exists(entry['location']):
+					logging.warning(entry['location'] + " does not exist")
+					with self.__lock__:
+						if entry in self.__pending__:
+							self.__pending__.remove(entry)
+					self.__save_state__()
+					continue
+				self.__upload__(entry)
+				backoff = 1
+			except (OSError, http.client.HTTPException) as e:
+				if not self.__running__:
+					break
+				logging.warning(
+					"Upload of " + entry['location'] + " failed: " + str(e))
+				if 'NoSuchUpload' in str(e):
+					entry['upload_id'] = None
+					entry['parts'] = []
+					self.__save_state__()
+				self.__stop_event__.wait(backoff)
+				backoff = min(backoff * 2, 300)
+
+
+	def stop(self):
+
+		"""
+		Stop Uploader
+		"""
+
+		self.__running__ = False
+		self.__stop_event__.set()
+		self.__event__.set()
+		self.__state__.flush()
+		logging.info(name(self) + " stopped")
+
+
+TelemetrySnapshot = collections.namedtuple(
+	'TelemetrySnapshot',
+	['time', 'cpu', 'memory', 'temperature', 'disk', 'disk_free', 'throttled'])
+
+
+class BrokerClient(Server):
+
+	"""
+	Client of the broker performing privileged operations, i.e. setting and
+	saving clock and querying firmware, on behalf of the service. Requests are
+	sent from the background thread over the long-lived connection, so that
+	callers never block and never fork. When the broker is not running the
+	clock is not set, saving it falls back to sudo and firmware is queried
+	with vcgencmd at most every FALLBACK_INTERVAL until it fails.
+	"""
+
+	FALLBACK_INTERVAL = 60
+
+
+	def __init__(self, path='/run/camera/broker.sock', timeout=5):
+
+		"""
+		Initialize Broker Client
+
+		Args:
+			path (str): path to the unix socket of the broker
+			timeout (float): timeout of the request in seconds
+		"""
+
+		self.__path__ = path
+		self.__timeout__ = timeout
+		self.__queue__ = queue.Queue()
+		self.__socket__ = None
+		self.__file__ = None
+		self.__id__ = 0
+		self.__cache__ = {}
+		self.__pending__ = set()
+		self.__fallback_time__ = {}
+
+
+	def request(self, method, args=(), callback=None):
+
+		"""
+		Schedule request to the broker
+
+		Args:
+			method (str): method name
+			args (tuple): method arguments
+			callback (callable): callback called with the result on the
+				background thread
+		"""
+
+		self.__queue__.put((method, list(args), callback))
+
+
+	def is_available(self):
+
+		"""
+		Check if the broker is running
+
+		Returns:
+			bool: True if the socket of the broker exists
+		"""
+
+		return os.path.exists(self.__path__)
+
+
+	def set_time(self, seconds):
+
+		"""
+		Schedule setting and saving of the system time
+
+		Args:
+			seconds (int): seconds since the epoch
+
+		Returns:
+			bool: True if scheduled, False if the broker is not running
+		"""
+
+		if not self.is_available():
+			logging.error("Unable to set_time: broker is not running")
+			return False
+		self.request('set_time', (seconds,))
+		return True
+
+
+	def save_hwclock(self):
+
+		"""
+		Schedule saving of the system time and flushing of file system buffers
+		"""
+
+		self.request('save_hwclock')
+
+
+	def query(self, name):
+
+		"""
+		Return the latest result of the firmware query and schedule its
+		refresh
+
+		Args:
+			name (str): name of the query, e.g. 'get_throttled'
+
+		Returns:
+			int: the latest result, None if not available yet
+		"""
+
+		if name not in self.__pending__:
+			self.__pending__.add(name)
+			self.request(name, callback=lambda value: self.__on_query__(
+				name, value))
+		return self.__cache__.get(name)
+
+
+	def __on_query__(self, name, value):
+
+		"""
+		Firmware query callback
+
+		Args:
+			name (str): name of the query
+			value (int): result of the query
+		"""
+
+		if value is not None:
+			self.__cache__[name] = value
+		self.__pending__.discard(name)
+
+
+	def __connect__(self):
+
+		"""
+		Connect to the broker
+
+		Returns:
+			bool: True if connected
+		"""
+
+		if self.__socket__ is not None:
+			return True
+		try:
+			self.__socket__ = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.__socket__.settimeout(self.__timeout__)
+			self.__socket__.connect(self.__path__)
+			self.__file__ = self.__socket__.makefile('rwb')
+			logging.info("Connected to broker at " + self.__path__)
+			return True
+		except OSError:
+			self.__disconnect__()
+			return False
+
+
+	def __disconnect__(self):
+
+		"""
+		Disconnect from the broker
+		"""
+
+		if self.__file__ is not None:
+			try:
+				self.__file__.close()
+			except OSError:
+				pass
+		if self.__socket__ is not None:
+			self.__socket__.close()
+		self.__file__ = None
+		self.__socket__ = None
+
+
+	def __send__(self, method, args):
+
+		"""
+		Send request to the broker and wait for the reply
+
+		Args:
+			method (str): method name
+			args (list): method arguments
+
+		Returns:
+			object: method result
+		"""
+
+		self.__id__ += 1
+		self.__file__.write(json.dumps({
+			'id': self.__id__, 'method': method, 'args': args}).encode() +
+			b'\n')
+		self.__file__.flush()
+		line = self.__file__.readline()
+		if not line:
+			raise ConnectionError("Broker closed connection")
+		reply = json.loads(line)
+		if 'error' in reply:
+			logging.error(
+				"Broker failed to " + method + ": " + reply['error'])
+			return None
+		return reply.get('result')
+
+
+	def __fallback__(self, method, args):
+
+		"""
+		Perform request with sudo when the broker is not running
+
+		Args:
+			method (str): method name
+			args (list): method arguments
+
+		Returns:
+			object: method result
+		"""
+
+		if method == 'set_time':
+			logging.error("Unable to set_time: broker is not running")
+			return None
+		if method == 'save_hwclock':
+			call(['sudo', 'fake-hwclock'])
+			os.sync()
+			return True
+		if method == 'get_throttled':
+			# if vcgencmd failed or was forked recently
+			last = self.__fallback_time__.get(method)
+			now = time.monotonic()
+			if last is not None and (
+				last < 0 or now - last < self.FALLBACK_INTERVAL
+			):
+				return None
+			self.__fallback_time__[method] = -1
+			output = check_output(['vcgencmd', 'get_throttled'])
+			self.__fallback_time__[method] = now
+			return int(output.decode().split('=')[1], 16)
+		return None
+
+
+	def start(self):
+
+		"""
+		Start Broker Client
+		"""
+
+		logging.info(name(self) + " started")
+		while True:
+			request = self.__queue__.get()
+			if request is None:
+				break
+			method, args, callback = request
+			result = None
+			try:
+				if self.__connect__():
+					try:
+						result = self.__send__(method, args)
+					except (OSError, ValueError) as e:
+						# NOTE: The broker may have completed the request, so
+						# it is not repeated.
+						logging.warning("Broker request failed: " + str(e))
+						self.__disconnect__()
+				else:
+					result = self.__fallback__(method, args)
+			except (
+				OSError, ValueError, IndexError, CalledProcessError
+			) as e:
+				logging.error("Unable to " + method + ": " + str(e))
+			if callback is not None:
+				callback(result)
+		self.__disconnect__()
+
+
+	def stop(self):
+
+		"""
+		Stop Broker Client once scheduled requests are completed
+		"""
+
+		self.__queue__.put(None)
+		logging.info(name(self) + " stopped")
+
+
+class TelemetrySampler(Server):
+
+	"""
+	Telemetry Sampler that reads system state directly from /proc, /sys and
+	the VideoCore mailbox in the background thread and publishes it as an
+	immutable snapshot, so that readers never block and never fork
+	"""
+
+	# _IOWR(100, 0, char *)
+	IOCTL_MBOX_PROPERTY = 0xC0006400 | (struct.calcsize('P') << 16)
+	TAG_GET_THROTTLED = 0x00030046
+
+
+	def __init__(self, interval=1, broker=None):
+
+		"""
+		Initialize Telemetry Sampler
+
+		Args:
+			interval (int): sampling interval in seconds
+			broker (BrokerClient): broker queried when the firmware is not
+				accessible
+		"""
+
+		self.__interval__ = interval
+		self.__broker__ = broker
+		self.__stop_event__ = threading.Event()
+		self.__stat__ = os.open('/proc/stat', os.O_RDONLY)
+		self.__meminfo__ = os.open('/proc/meminfo', os.O_RDONLY)
+		self.__temperature__ = self.__open__(
+			'/sys/class/thermal/thermal_zone0/temp')
+		self.__throttled__ = self.__open__(
+			'/sys/devices/platform/soc/soc:firmware/get_throttled')
+		self.__mailbox__ = None
+		if self.__throttled__ is None:
+			self.__mailbox__ = self.__open__('/dev/vcio')
+		self.__cpu_times__ = (0, 0)
+		self.__snapshot__ = None
+		self.__listeners__ = []
+		self.sample()
+
+
+	def __open__(self, path):
+
+		"""
+		Open file and keep the descriptor for subsequent reads
+
+		Args:
+			path (str): path to the file
+
+		Returns:
+			int: file descriptor or None if file is not available
+		"""
+
+		try:
+			return os.open(path, os.O_RDONLY)
+		except OSError:
+			logging.warning("'" + path + "' not available")
+			return None
+
+
+	def __get_throttled__(self):
+
+		"""
+		Obtain throttled state from the firmware without forking vcgencmd
+
+		Returns:
+			int: throttled state
+		"""
+
+		if self.__throttled__ is not None:
+			return int(os.pread(self.__throttled__, 32, 0), 16)
+		if self.__mailbox__ is not None:
+			buffer = array.array(
+				'I', [7 * 4, 0, self.TAG_GET_THROTTLED, 4, 0, 0, 0])
+			fcntl.ioctl(
+				self.__mailbox__, self.IOCTL_MBOX_PROPERTY, buffer, True)
+			return buffer[5]
+		if self.__broker__ is not None:
+			return self.__broker__.query('get_throttled') or 0
+		return 0
+
+
+	def sample(self):
+
+		"""
+		Sample telemetry and publish the snapshot
+		"""
+
+		fields = os.pread(self.__stat__, 256, 0).split(b'\n', 1)[0].split()
+		times = [int(field) for field in fields[1:]]
+		idle = times[3] + times[4]
+		total = sum(times)
+		cpu = 0.0
+		if total > self.__cpu_times__[1]:
+			cpu = round(
+				100 * (1 - (idle - self.__cpu_times__[0]) /
+				(total - self.__cpu_times__[1])), 1)
+		self.__cpu_times__ = (idle, total)
+		meminfo = {}
+		for line in os.pread(self.__meminfo__, 4096, 0).split(b'\n')[:8]:
+			fields = line.split()
+			if len(fields) > 1:
+				meminfo[fields[0]] = int(fields[1])
+		memory = round(
+			100 * (1 - meminfo[b'MemAvailable:'] / meminfo[b'MemTotal:']), 1)
+		temperature = 0.0
+		if self.__temperature__ is not None:
+			temperature = round(
+				int(os.pread(self.__temperature__, 16, 0)) / 1000, 1)
+		statvfs = os.statvfs('/')
+		used = (statvfs.f_blocks - statvfs.f_bfree) * statvfs.f_frsize
+		free = statvfs.f_bavail * statvfs.f_frsize
+		disk = round(100 * used / (used + free), 1) if used + free else 0.0
+		# NOTE: Assignment of the reference is atomic, so readers always see
+		# consistent snapshot without taking any lock.
+		self.__snapshot__ = TelemetrySnapshot(
+			time.time(), cpu, memory, temperature, disk, free,
+			self.__get_throttled__())
+
+
+	def add_listener(self, listener):
+
+		"""
+		Add listener called with every new snapshot on the sampler thread
+
+		Args:
+			listener (callable): listener taking TelemetrySnapshot
+		"""
+
+		self.__listeners__.append(listener)
+
+
+	def get_snapshot(self):
+
+		"""
+		Return the latest telemetry snapshot
+
+		Returns:
+			TelemetrySnapshot: the latest telemetry snapshot
+		"""
+
+		return self.__snapshot__
+
+
+	def start(self):
+
+		"""
+		Start Telemetry Sampler
+		"""
+
+		logging.info(name(self) + " started")
+		self.__stop_event__.clear()
+		while not self.__stop_event__.wait(self.__interval__):
+			try:
+				self.sample()
+			except (OSError, ValueError, KeyError) as e:
+				logging.warning("Telemetry sampling failed: " + str(e))
+			for listener in self.__listeners__:
+				listener(self.__snapshot__)
+
+
+	def stop(self):
+
+		"""
+		Stop Telemetry Sampler
+		"""
+
+		self.__stop_event__.set()
+		logging.info(name(self) + " stopped")
+
+
+class Metrics(object):
+
+	"""
+	Metrics of the pipeline, encoder and control plane health exposed in the
+	Prometheus text format. Counters live in preallocated arrays indexed by
+	constants so that updates on hot paths are O(1). Frames and bytes of the
+	branches are read when sampled from the native counters of the elements,
+	i.e. 'stats' of identity and sink elements and 'bytes-served' of UDP
+	sinks, so that nothing runs in Python per frame. On GStreamer versions
+	without 'stats' buffer probes count frames and the size of every SAMPLE-th
+	buffer stands for the ones in between.
+	"""
+
+	BRANCHES = ('source', 'encoder', 'udp', 'rtsp', 'file')
+	SOURCE, ENCODER, UDP, RTSP, FILE = range(len(BRANCHES))
+	COUNTERS = (
+		'keyframes', 'restarts', 'fragments', 'bus_messages', 'leaked_objects')
+	KEYFRAMES, RESTARTS, FRAGMENTS, BUS_MESSAGES, LEAKED_OBJECTS = \
+		range(len(COUNTERS))
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+	THROTTLED = (
+		(0, 'under_voltage'), (1, 'frequency_capped'), (2, 'throttled'),
+		(3, 'soft_temperature_limit'), (16, 'under_voltage_occurred'),
+		(17, 'frequency_capped_occurred'), (18, 'throttled_occurred'),
+		(19, 'soft_temperature_limit_occurred'))
+	SAMPLE = 8
+
+
+	def __init__(self):
+
+		"""
+		Initialize Metrics
+		"""
+
+		self.__frames__ = array.array('Q', [0] * len(self.BRANCHES))
+		self.__bytes__ = array.array('Q', [0] * len(self.BRANCHES))
+		self.__counters__ = array.array('Q', [0] * len(self.COUNTERS))
+		self.__restart_seconds__ = 0.0
+		self.__restart_last_seconds__ = 0.0
+		self.__rtsp_clients__ = 0
+		self.__requests__ = array.array('Q', [0] * (len(self.BUCKETS) + 1))
+		self.__request_seconds__ = 0.0
+		self.__sample__ = (time.monotonic(), array.array('Q', self.__bytes__),
+			array.array('Q', self.__frames__))
+		self.__bitrate__ = 0
+		self.__drops__ = 0
+		self.__fps__ = array.array('d', [0.0] * len(self.BRANCHES))
+		self.__last__ = array.array('d', [0.0] * len(self.BRANCHES))
+		self.__seen__ = array.array('Q', [0] * len(self.BRANCHES))
+		self.__native__ = [[0, 0] for branch in self.BRANCHES]
+		self.__native_bytes__ = array.array('B', [0] * len(self.BRANCHES))
+		self.__counters_provider__ = None
+		self.__lock__ = threading.Lock()
+
+
+	def on_buffer(self, pad, info, branch):
+
+		"""
+		Pad probe counting frames flowing through the branch and sampling
+		their size, used if the element does not keep native stats
+
+		Args:
+			pad (Pad): probe pad
+			info (PadProbeInfo): pad probe info
+			branch (int): index of the branch
+
+		Returns:
+			PadProbeReturn: OK to pass the data
+		"""
+
+		# NOTE: Every probed pad is served by a single streaming thread and no
+		# other thread writes counters of the probed branch.
+		self.__frames__[branch] += 1
+		if (
+			self.__frames__[branch] % self.SAMPLE == 0 and
+			not self.__native_bytes__[branch]
+		):
+			self.__bytes__[branch] += \
+				info.get_buffer().get_size() * self.SAMPLE
+		return Gst.PadProbeReturn.OK
+
+
+	def set_counters(self, provider):
+
+		"""
+		Set provider of the elements whose native counters are read
+
+		Args:
+			provider (callable): function returning elements of the active
+				branches by index of the branch
+		"""
+
+		self.__counters_provider__ = provider
+
+
+	def add_counter(self, element, pad_name, branch):
+
+		"""
+		Count frames and bytes of the branch with native stats of the element
+		or, if the element does not keep them, with the probe on its pad
+
+		Args:
+			element (Element): identity or sink element
+			pad_name (str): name of the static pad probed if needed
+			branch (int): index of the branch
+
+		Returns:
+			int: id of the probe, None if the native stats are used
+		"""
+
+		if element.find_property('stats') is None:
+			return self.add_probe(element, pad_name, branch)
+		self.touch(branch)
+		return None
+
+
+	def add_probe(self, element, pad_name, branch):
+
+		"""
+		Count frames and bytes flowing through the pad of the element
+
+		Args:
+			element (Element): element
+			pad_name (str): name of the static pad
+			branch (int): index of the branch
+
+		Returns:
+			int: id of the probe
+		"""
+
+		probe_id = element.get_static_pad(pad_name).add_probe(
+			Gst.PadProbeType.BUFFER, self.on_buffer, branch)
+		self.touch(branch)
+		return probe_id
+
+
+	def __read__(self):
+
+		"""
+		Add progress of the native counters since the previous read, the
+		caller holds the lock
+		"""
+
+		if self.__counters_provider__ is None:
+			return
+		for branch, element in self.__counters_provider__().items():
+			frames = None
+			bytes_ = None
+			if element.find_property('stats') is not None:
+				stats = element.get_property('stats')
+				if stats.has_field('num-buffers'):
+					frames = stats.get_uint64('num-buffers')[1]
+					bytes_ = stats.get_uint64('num-bytes')[1]
+				else:
+					frames = stats.get_uint64('rendered')[1]
+			if element.find_property('bytes-served') is not None:
+				bytes_ = element.get_property('bytes-served')
+			elif frames is not None and bytes_ is None:
+				# NOTE: File sink reports position in the current fragment.
+				success, position = element.get_static_pad(
+					'sink').query_position(Gst.Format.BYTES)
+				if success:
+					bytes_ = position
+			last = self.__native__[branch]
+			# counters start over when the element is replaced
+			if frames is not None:
+				self.__frames__[branch] += \
+					frames - last[0] if frames >= last[0] else frames
+				last[0] = frames
+			if bytes_ is not None:
+				self.__bytes__[branch] += \
+					bytes_ - last[1] if bytes_ >= last[1] else bytes_
+				last[1] = bytes_
+				self.__native_bytes__[branch] = 1
+
+
+	def touch(self, branch=None):
+
+		"""
+		Restart the last frame age of the branch, e.g. when the branch is
+		created or recovered, so that it is given time to deliver first frame
+
+		Args:
+			branch (int): index of the branch, None for all branches
+		"""
+
+		now = time.monotonic()
+		if branch is None:
+			for branch in range(len(self.BRANCHES)):
+				self.__last__[branch] = now
+				self.__seen__[branch] = self.__frames__[branch]
+		else:
+			self.__last__[branch] = now
+			self.__seen__[branch] = self.__frames__[branch]
+
+
+	def get_age(self, branch):
+
+		"""
+		Return time since the last frame of the branch. Frames are not
+		timestamped, so the age is accurate to the interval between the calls.
+
+		Args:
+			branch (int): index of the branch
+
+		Returns:
+			float: time since the last frame in seconds
+		"""
+
+		with self.__lock__:
+			self.__read__()
+			now = time.monotonic()
+			frames = self.__frames__[branch]
+			if frames != self.__seen__[branch]:
+				self.__seen__[branch] = frames
+				self.__last__[branch] = now
+			return now - self.__last__[branch]
+
+
+	def inc(self, counter, value=1):
+
+		"""
+		Increment counter
+
+		Args:
+			counter (int): index of the counter
+			value (int): value to add
+		"""
+
+		with self.__lock__:
+			self.__counters__[counter] += value
+
+
+	def observe_restart(self, seconds):
+
+		"""
+		Record restart duration
+
+		Args:
+			seconds (float): restart duration in seconds
+		"""
+
+		with self.__lock__:
+			self.__counters__[self.RESTARTS] += 1
+			self.__restart_seconds__ += seconds
+			self.__restart_last_seconds__ = seconds
+
+
+	def observe_request(self, seconds):
+
+		"""
+		Record HTTP request latency
+
+		Args:
+			seconds (float): request latency in seconds
+		"""
+
+		with self.__lock__:
+			self.__requests__[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+			self.__request_seconds__ += seconds
+
+
+	def set_rtsp_clients(self, delta):
+
+		"""
+		Update number of connected RTSP clients
+
+		Args:
+			delta (int): change of the number of connected RTSP clients
+		"""
+
+		with self.__lock__:
+			self.__rtsp_clients__ += delta
+
+
+	def sample(self, snapshot=None):
+
+		"""
+		Calculate rates since the previous sample
+
+		Args:
+			snapshot (TelemetrySnapshot): telemetry snapshot, not used
+		"""
+
+		with self.__lock__:
+			self.__read__()
+			now = time.monotonic()
+			then, bytes_, frames = self.__sample__
+			# NOTE: Encoded bitrate is taken from the UDP sink counter when the
+			# parsed stream is not counted natively, sampled sizes of H.264
+			# frames miss most keyframes.
+			bitrate_branch = self.ENCODER
+			if (
+				not self.__native_bytes__[self.ENCODER] and
+				self.__native_bytes__[self.UDP]
+			):
+				bitrate_branch = self.UDP
+			if now > then:
+				self.__bitrate__ = int(
+					(self.__bytes__[bitrate_branch] - bytes_[bitrate_branch]) *
+					8 / (now - then))
+				self.__drops__ = max(0,
+					(self.__frames__[self.SOURCE] - frames[self.SOURCE]) -
+					(self.__frames__[self.ENCODER] - frames[self.ENCODER]))
+				for branch in range(len(self.BRANCHES)):
+					self.__fps__[branch] = round(
+						(self.__frames__[branch] - frames[branch]) /
+						(now - then), 1)
+			self.__sample__ = (now, array.array('Q', self.__bytes__),
+				array.array('Q', self.__frames__))
+
+
+	def get_bitrate(self):
+
+		"""
+		Return encoded bitrate
+
+		Returns:
+			int: encoded bitrate in bits per second
+		"""
+
+		return self.__bitrate__
+
+
+	def get_drops(self):
+
+		"""
+		Return number of frames dropped between source and encoder during
+		the last sampling interval
+
+		Returns:
+			int: number of dropped frames
+		"""
+
+		return self.__drops__
+
+
+	def get_fps(self, branch):
+
+		"""
+		Return framerate of the branch
+
+		Args:
+			branch (int): index of the branch
+
+		Returns:
+			float: framerate of the branch
+		"""
+
+		return self.__fps__[branch]
+
+
+	def get_frames(self, branch):
+
+		"""
+		Return number of frames which went through the branch
+
+		Args:
+			branch (int): index of the branch
+
+		Returns:
+			int: number of frames
+		"""
+
+		return self.__frames__[branch]
+
+
+	def render(self, queues, snapshot):
+
+		"""
+		Render metrics in the Prometheus text format
+
+		Args:
+			queues (dict): queue levels as (buffers, bytes) by queue name
+			snapshot (TelemetrySnapshot): telemetry snapshot
+
+		Returns:
+			str: metrics in the Prometheus text format
+		"""
+
+		with self.__lock__:
+			self.__read__()
+		lines = ['# TYPE camera_frames_total counter']
+		for branch, branch_name in enumerate(self.BRANCHES):
+			lines.append(
+				'camera_frames_total{branch="' + branch_name + '"} ' +
+				str(self.__frames__[branch]))
+		lines.append('# TYPE camera_bytes_total counter')
+		for branch, branch_name in enumerate(self.BRANCHES):
+			lines.append(
+				'camera_bytes_total{branch="' + branch_name + '"} ' +
+				str(self.__bytes__[branch]))
+		lines.append('# TYPE camera_encoder_bitrate_bits_per_second gauge')
+		lines.append(
+			'camera_encoder_bitrate_bits_per_second ' + str(self.__bitrate__))
+		lines.append('# TYPE camera_queue_level_buffers gauge')
+		for queue_name, level in sorted(queues.items()):
+			lines.append(
+				'camera_queue_level_buffers{queue="' + queue_name + '"} ' +
+				str(level[0]))
+		lines.append('# TYPE camera_queue_level_bytes gauge')
+		for queue_name, level in sorted(queues.items()):
+			lines.append(
+				'camera_queue_level_bytes{queue="' + queue_name + '"} ' +
+				str(level[1]))
+		for counter, counter_name in enumerate(self.COUNTERS):
+			if counter == self.RESTARTS:
+				continue
+			lines.append('# TYPE camera_' + counter_name + '_total counter')
+			lines.append(
+				'camera_' + counter_name + '_total ' +
+				str(self.__counters__[counter]))
+		lines.append('# TYPE camera_restart_duration_seconds summary')
+		lines.append(
+			'camera_restart_duration_seconds_sum ' +
+			str(round(self.__restart_seconds__, 6)))
+		lines.append(
+			'camera_restart_duration_seconds_count ' +
+			str(self.__counters__[self.RESTARTS]))
+		lines.append('# TYPE camera_restart_last_duration_seconds gauge')
+		lines.append(
+			'camera_restart_last_duration_seconds ' +
+			str(round(self.__restart_last_seconds__, 6)))
+		lines.append('# TYPE camera_rtsp_clients gauge')
+		lines.append('camera_rtsp_clients ' + str(self.__rtsp_clients__))
+		lines.append('# TYPE camera_http_request_duration_seconds histogram')
+		count = 0
+		for bucket, le in enumerate(self.BUCKETS + ('+Inf',)):
+			count = count + self.__requests__[bucket]
+			lines.append(
+				'camera_http_request_duration_seconds_bucket{le="' + str(le) +
+				'"} ' + str(count))
+		lines.append(
+			'camera_http_request_duration_seconds_sum ' +
+			str(round(self.__request_seconds__, 6)))
+		lines.append('camera_http_request_duration_seconds_count ' + str(count))
+		if snapshot is not None:
+			lines.append('# TYPE camera_cpu_temperature_celsius gauge')
+			lines.append(
+				'camera_cpu_temperature_celsius ' + str(snapshot.temperature))
+			lines.append('# TYPE camera_throttled gauge')
+			for bit, flag in self.THROTTLED:
+				lines.append(
+					'camera_throttled{flag="' + flag + '"} ' +
+					str((snapshot.throttled >> bit) & 1))
+		return '\n'.join(lines) + '\n'
+
+
+class TelemetryHistory(Server):
+
+	"""
+	Telemetry History kept in fixed size, time aligned ring buffers at 1 s
+	resolution for the last hour, 1 min for the last 24 hours and 15 min for
+	the last 30 days
+	"""
+
+	FIELDS = (
+		'cpu', 'memory', 'temperature', 'throttled', 'bitrate', 'fps', 'drops')
+	THROTTLED = FIELDS.index('throttled')
+	TIERS = ((1, 3600), (60, 1440), (900, 2880))
+	HEADER = '<4sII'
+	TIER_HEADER = '<IIq'
+
+
+	def __init__(self, metrics, path='history.bin'):
+
+		"""
+		Initialize Telemetry History
+
+		Args:
+			metrics (Metrics): metrics
+			path (str): path to the file with persistent history
+		"""
+
+		self.__metrics__ = metrics
+		self.__path__ = path
+		self.__lock__ = threading.Lock()
+		self.__rings__ = []
+		self.__last_slots__ = []
+		self.__accumulators__ = []
+		for _, capacity in self.TIERS:
+			self.__rings__.append(
+				array.array('f', [math.nan] * capacity * len(self.FIELDS)))
+			self.__last_slots__.append(None)
+			self.__accumulators__.append(
+				[None, 0, [0.0] * len(self.FIELDS)])
+		self.__load__()
+
+
+	def __load__(self):
+
+		"""
+		Load history from disk
+		"""
+
+		try:
+			with open(self.__path__, 'rb') as f:
+				magic, version, tiers = struct.unpack(
+					self.HEADER, f.read(struct.calcsize(self.HEADER)))
+				if magic != b'CAMH' or version != 1 or tiers != len(self.TIERS):
+					raise ValueError("incompatible format")
+				for tier, (resolution, capacity) in enumerate(self.TIERS):
+					header = struct.unpack(
+						self.TIER_HEADER,
+						f.read(struct.calcsize(self.TIER_HEADER)))
+					if header[:2] != (resolution, capacity):
+						raise ValueError("incompatible tier")
+					ring = array.array('f')
+					ring.fromfile(f, capacity * len(self.FIELDS))
+					self.__rings__[tier] = ring
+					self.__last_slots__[tier] = \
+						header[2] if header[2] >= 0 else None
+		except (OSError, EOFError, ValueError, struct.error) as e:
+			logging.warning(
+				"'" + self.__path__ + "' not loaded: " + str(e))
+
+
+	def save(self):
+
+		"""
+		Write history to disk in compact binary form
+		"""
+
+		with self.__lock__:
+			data = struct.pack(
+				self.HEADER, b'CAMH', 1, len(self.TIERS))
+			for tier, (resolution, capacity) in enumerate(self.TIERS):
+				last_slot = self.__last_slots__[tier]
+				data = data + struct.pack(
+					self.TIER_HEADER, resolution, capacity,
+					-1 if last_slot is None else last_slot) + \
+					self.__rings__[tier].tobytes()
+		write_atomic(self.__path__, data)
+
+
+	def __push__(self, tier, slot, values):
+
+		"""
+		Store values in the slot of the tier and mark skipped slots as gaps
+
+		Args:
+			tier (int): index of the tier
+			slot (int): slot, i.e. time divided by resolution of the tier
+			values (list): values of the fields
+		"""
+
+		capacity = self.TIERS[tier][1]
+		ring = self.__rings__[tier]
+		fields = len(self.FIELDS)
+		last_slot = self.__last_slots__[tier]
+		if last_slot is not None:
+			if slot <= last_slot:
+				return
+			for gap in range(max(last_slot + 1, slot - capacity), slot):
+				index = (gap % capacity) * fields
+				ring[index:index + fields] = array.array(
+					'f', [math.nan] * fields)
+		index = (slot % capacity) * fields
+		ring[index:index + fields] = array.array('f', values)
+		self.__last_slots__[tier] = slot
+
+
+	def sample(self, snapshot):
+
+		"""
+		Record telemetry sample and downsample it into the coarser tiers
+
+		Args:
+			snapshot (TelemetrySnapshot): telemetry snapshot
+		"""
+
+		values = [
+			snapshot.cpu, snapshot.memory, snapshot.temperature,
+			snapshot.throttled, self.__metrics__.get_bitrate(),
+			self.__metrics__.get_fps(Metrics.ENCODER),
+			self.__metrics__.get_drops()]
+		save = False
+		with self.__lock__:
+			for tier, (resolution, _) in enumerate(self.TIERS):
+				slot = int(snapshot.time // resolution)
+				if resolution == 1:
+					self.__push__(tier, slot, values)
+					continue
+				accumulator = self.__accumulators__[tier]
+				if accumulator[0] is not None and accumulator[0] != slot:
+					aggregate = [total / accumulator[1]
+						for total in accumulator[2]]
+					aggregate[self.THROTTLED] = accumulator[2][self.THROTTLED]
+					self.__push__(tier, accumulator[0], aggregate)
+					accumulator[1] = 0
+					accumulator[2] = [0.0] * len(self.FIELDS)
+					save = save or tier == len(self.TIERS) - 1
+				accumulator[0] = slot
+				accumulator[1] = accumulator[1] + 1
+				for field, value in enumerate(values):
+					if field == self.THROTTLED:
+						# throttled flags are aggregated with bitwise or
+						accumulator[2][field] = float(
+							int(accumulator[2][field]) | int(value))
+					else:
+						accumulator[2][field] += value
+		if save:
+			self.save()
+
+
+	def get_history(self):
+
+		"""
+		Return history of all tiers ordered from the oldest to the newest slot
+
+		Returns:
+			json: history of all tiers
+		"""
+
+		tiers = []
+		with self.__lock__:
+			for tier, (resolution, capacity) in enumerate(self.TIERS):
+				last_slot = self.__last_slots__[tier]
+				ring = self.__rings__[tier]
+				fields = len(self.FIELDS)
+				values = {name: [] for name in self.FIELDS}
+				if last_slot is not None:
+					for slot in range(last_slot - capacity + 1, last_slot + 1):
+						index = (slot % capacity) * fields
+						for field, name in enumerate(self.FIELDS):
+							value = ring[index + field]
+							values[name].append(
+								None if math.isnan(value) else
+								round(value, 1))
+				tiers.append({
+					'resolution': resolution,
+					'end': None if last_slot is None else
+						(last_slot + 1) * resolution,
+					'values': values})
+		return json.dumps({'fields': self.FIELDS, 'tiers': tiers})
+
+
+	def start(self):
+
+		"""
+		Start Telemetry History
+		"""
+
+		logging.info(name(self) + " started")
+
+
+	def stop(self):
+
+		"""
+		Stop Telemetry History and persist collected samples
+		"""
+
+		self.save()
+		logging.info(name(self) + " stopped")
+
+
+class HeapProfiler(object):
+
+	"""
+	Heap Profiler reporting resident set size, Python heap and GStreamer
+	objects alive, with the top allocation differences against a baseline
+	tracemalloc snapshot
+	"""
+
+	def __init__(self, frames=0):
+
+		"""
+		Initialize Heap Profiler
+
+		Args:
+			frames (int): number of frames stored per traceback, 0 disables
+				tracemalloc
+		"""
+
+		self.__lock__ = threading.Lock()
+		self.__baseline__ = None
+		if frames > 0 and not tracemalloc.is_tracing():
+			tracemalloc.start(frames)
+
+
+	def get_rss(self):
+
+		"""
+		Return resident set size of the process
+
+		Returns:
+			int: resident set size in KiB
+		"""
+
+		try:
+			with open('/proc/self/status') as file:
+				for line in file:
+					if line.startswith('VmRSS:'):
+						return int(line.split()[1])
+		except OSError:
+			pass
+		return 0
+
+
+	def get_objects(self):
+
+		"""
+		Return number of GStreamer objects alive. Objects are counted by the
+		leaks tracer when it is enabled with GST_TRACERS=leaks, otherwise only
+		objects referenced from Python are counted.
+
+		Returns:
+			int: number of objects
+		"""
+
+		for tracer in Gst.tracing_get_active_tracers():
+			if tracer.get_factory().get_name() != 'leaks':
+				continue
+			try:
+				objects = tracer.emit('get-live-objects')
+				return len(objects.get_value('live-objects-list'))
+			except (AttributeError, TypeError) as e:
+				logging.debug("Unable to get live objects: " + str(e))
+		return sum(1 for obj in gc.get_objects() if isinstance(obj, Gst.Object))
+
+
+	def get_heap(self, limit=10, baseline=False):
+
+		"""
+		Return heap usage and the top allocation differences against the
+		baseline snapshot
+
+		Args:
+			limit (int): maximum number of differences
+			baseline (bool): indicate whether to take the new baseline
+				snapshot after comparison
+
+		Returns:
+			json: heap usage
+		"""
+
+		heap = {
+			'rss': self.get_rss(), 'gst_objects': self.get_objects(),
+			'tracemalloc': tracemalloc.is_tracing()}
+		if not tracemalloc.is_tracing():
+			return json.dumps(heap, sort_keys=True)
+		with self.__lock__:
+			current, peak = tracemalloc.get_traced_memory()
+			heap['python'] = current // 1024
+			heap['python_peak'] = peak // 1024
+			snapshot = tracemalloc.take_snapshot().filter_traces((
+				tracemalloc.Filter(False, tracemalloc.__file__),
+				tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+			top = []
+			if self.__baseline__ is not None:
+				for stat in snapshot.compare_to(
+					self.__baseline__, 'lineno')[:limit]:
+					frame = stat.traceback[0]
+					top.append({
+						'file': frame.filename, 'line': frame.lineno,
+						'size': stat.size, 'size_diff': stat.size_diff,
+						'count': stat.count, 'count_diff': stat.count_diff})
+			heap['top'] = top
+			if baseline or self.__baseline__ is None:
+				self.__baseline__ = snapshot
+		return json.dumps(heap, sort_keys=True)
+
+
+class FlowWatchdog(Server):
+
+	"""
+	Flow Watchdog that checks that frames keep flowing through the source and
+	every active branch, triggers recovery of the stalled branch and reports
+	readiness and liveness to systemd
+	"""
+
+	def __init__(self, camera_server, metrics, deadline=5, interval=1):
+
+		"""
+		Initialize Flow Watchdog
+
+		Args:
+			camera_server (CameraServer): camera server
+			metrics (Metrics): metrics
+			deadline (float): maximum time without frames in seconds, 0 to
+				only report health
+			interval (float): check interval in seconds
+		"""
+
+		self.__camera_server__ = camera_server
+		self.__metrics__ = metrics
+		self.__deadline__ = deadline
+		self.__interval__ = interval
+		self.__stop_event__ = threading.Event()
+		self.__ready__ = False
+		# NOTE: systemd expects keep-alive at least every WatchdogSec, ping
+		# twice as often.
+		watchdog = os.environ.get('WATCHDOG_USEC')
+		self.__watchdog__ = None
+		if watchdog is not None and watchdog.isdigit():
+			self.__watchdog__ = int(watchdog) / 2000000
+		self.__pinged__ = 0
+
+
+	def get_health(self):
+
+		"""
+		Return health of the pipeline
+
+		Returns:
+			dict: status and last frame age per branch
+		"""
+
+		return self.__camera_server__.get_health(self.__deadline__)
+
+
+	def check(self):
+
+		"""
+		Check the flow of frames and recover the first stalled branch
+		"""
+
+		health = self.get_health()
+		if health['status'] == 'stalled':
+			# NOTE: Branches are ordered from the source, downstream branches
+			# stall together with the upstream one.
+			self.__camera_server__.on_stall(
+				health['stalled'][0], self.__deadline__)
+			return
+		if health['status'] == 'ok' and not self.__ready__:
+			self.__ready__ = True
+			sd_notify('READY=1\nSTATUS=Streaming')
+		if self.__watchdog__ is None:
+			return
+		# if recovery does not complete stop pinging so that systemd restarts
+		# the service
+		if (
+			health['recovering'] is not None and 
+			health['recovering'] > RecoveryEngine.WINDOW
+		):
+			return
+		now = time.monotonic()
+		if now - self.__pinged__ >= self.__watchdog__:
+			self.__pinged__ = now
+			sd_notify('WATCHDOG=1')
+
+
+	def start(self):
+
+		"""
+		Start Flow Watchdog
+		"""
+
+		logging.info(name(self) + " started")
+		self.__stop_event__.clear()
+		interval = self.__interval__
+		if self.__watchdog__ is not None:
+			interval = min(interval, self.__watchdog__)
+		while not self.__stop_event__.wait(interval):
+			try:
+				self.check()
+			except Exception as e:
+				logging.error("Flow check failed: " + str(e))
+
+
+	def stop(self):
+
+		"""
+		Stop Flow Watchdog
+		"""
+
+		self.__stop_event__.set()
+		sd_notify('STOPPING=1')
+		logging.info(name(self) + " stopped")
+
+
+class RecoveryEngine(object):
+
+	"""
+	Recovery engine that escalates recovery level when errors recur shortly
+	after the previous recovery and measures mean time to recover per error
+	class
+	"""
+
+	FLUSH = 0
+	SOURCE = 1
+	PIPELINE = 2
+	EXIT = 3
+	LEVELS = ('relinking branch', 'restarting source', 'rebuilding pipeline',
+		'exiting')
+	WINDOW = 60
+
+
+	def __init__(self, window=WINDOW):
+
+		"""
+		Initialize Recovery Engine
+
+		Args:
+			window (int): time in seconds after recovery within which next
+				error escalates recovery level
+		"""
+
+		self.__window__ = window
+		self.__lock__ = threading.Lock()
+		self.__level__ = None
+		self.__last__ = 0
+		self.__incident__ = None
+		self.__statistics__ = {}
+
+
+	def fail(self, error_class, minimum=0):
+
+		"""
+		Register an error and return recovery level to apply
+
+		Args:
+			error_class (str): class of the error
+			minimum (int): minimum recovery level
+
+		Returns:
+			int: recovery level
+		"""
+
+		now = time.monotonic()
+		with self.__lock__:
+			if self.__incident__ is None:
+				self.__incident__ = (error_class, now)
+			if (
+				self.__level__ is None or 
+				now - self.__last__ > self.__window__
+			):
+				level = minimum
+			else:
+				level = max(minimum, self.__level__ + 1)
+			self.__level__ = min(level, RecoveryEngine.EXIT)
+			self.__last__ = now
+			return self.__level__
+
+
+	def recovered(self):
+
+		"""
+		Register that data flows again after the recovery
+		"""
+
+		now = time.monotonic()
+		with self.__lock__:
+			if self.__incident__ is None:
+				return
+			error_class, start = self.__incident__
+			self.__incident__ = None
+			self.__last__ = now
+			statistics = self.__statistics__.setdefault(
+				error_class, {'count': 0, 'total': 0.0, 'max': 0.0})
+			statistics['count'] = statistics['count'] + 1
+			statistics['total'] = statistics['total'] + now - start
+			statistics['max'] = max(statistics['max'], now - start)
+		logging.info(
+			"Recovered from '" + error_class + "' in " + 
+			str(round(now - start, 3)) + " s")
+
+
+	def get_pending(self):
+
+		"""
+		Return time since the beginning of pending recovery
+
+		Returns:
+			float: time in seconds, None if recovery is not pending
+		"""
+
+		incident = self.__incident__
+		if incident is None:
+			return None
+		return time.monotonic() - incident[1]
+
+
+	def get_statistics(self):
+
+		"""
+		Return recovery statistics
+
+		Returns:
+			dict: number of recoveries, mean and maximum time to recover per
+				error class and current recovery level
+		"""
+
+		with self.__lock__:
+			classes = {}
+			for error_class, statistics in self.__statistics__.items():
+				classes[error_class] = {
+					'count': statistics['count'],
+					'mttr': statistics['total'] / statistics['count'],
+					'max': statistics['max']}
+			level = None
+			if self.__level__ is not None:
+				level = RecoveryEngine.LEVELS[self.__level__]
+			return {
+				'level': level,
+				'pending': self.__incident__ is not None,
+				'classes': classes}
+
+
+class PipelineLifecycle(object):
+
+	"""
+	Pipeline Lifecycle that keeps long-lived elements across restarts, tears
+	pipelines down so that nothing refers to the released elements anymore
+	and reports objects that are still alive afterwards
+	"""
+
+	# NOTE: Only elements that renegotiate caps whenever they go from NULL to
+	# PLAYING and carry no state of the previous configuration are reused.
+	REUSABLE = (
+		'raw-tee', 'encoder-capsfilter', 'parser', 'encoder-counter',
+		'h264-tee', 'payloader', 'rtsp-tee', 'sink-queue', 'sink')
+
+
+	def __init__(self, metrics):
+
+		"""
+		Initialize Pipeline Lifecycle
+
+		Args:
+			metrics (Metrics): metrics
+		"""
+
+		self.__metrics__ = metrics
+		self.__lock__ = threading.Lock()
+		self.__elements__ = {}
+		self.__probes__ = []
+		self.__released__ = {}
+		self.__key__ = 0
+		self.__leaked__ = []
+		self.__generation__ = 0
+		self.__created__ = 0
+		self.__reused__ = 0
+
+
+	def make(self, factory, element_name):
+
+		"""
+		Return element kept from the previous pipeline or create a new one
+
+		Args:
+			factory (str): name of the element factory
+			element_name (str): name of the element
+
+		Returns:
+			GstElement: element
+		"""
+
+		element = self.__elements__.get(element_name)
+		if (
+			element is not None and element.get_parent() is None and
+			element.get_factory().get_name() == factory
+		):
+			self.__reused__ += 1
+			return element
+		element = Gst.ElementFactory.make(factory, element_name)
+		self.__created__ += 1
+		if element is not None and element_name in self.REUSABLE:
+			self.__elements__[element_name] = element
+		return element
+
+
+	def add_probe(self, element, pad_name, probe_id):
+
+		"""
+		Remember probe to be removed on teardown, so that probes do not pile
+		up on reused elements
+
+		Args:
+			element (GstElement): element
+			pad_name (str): name of the static pad
+			probe_id (int): id of the probe, None if no probe was added
+		"""
+
+		if probe_id is not None and element.get_name() in self.__elements__:
+			self.__probes__.append((element.get_static_pad(pad_name), probe_id))
+
+
+	def release_pad(self, element):
+
+		"""
+		Release request pad of the tee the element is linked to
+
+		Args:
+			element (GstElement): element linked to the tee
+		"""
+
+		pad = element.get_static_pad('sink').get_peer()
+		if pad is not None:
+			pad.get_parent_element().release_request_pad(pad)
+
+
+	def release(self, pipeline, elements):
+
+		"""
+		Release branch linked to a tee and watch its elements being finalized
+
+		Args:
+			pipeline (GstPipeline): pipeline
+			elements (list): elements of the branch starting from the one
+				linked to the tee
+		"""
+
+		self.release_pad(elements[0])
+		for element in elements:
+			if element is None:
+				continue
+			element.set_state(Gst.State.NULL)
+			if element.get_parent() == pipeline:
+				pipeline.remove(element)
+			self.track(element)
+
+
+	def track(self, obj):
+
+		"""
+		Watch the object being finalized
+
+		Args:
+			obj (GstObject): object that no longer shall be referenced
+		"""
+
+		with self.__lock__:
+			self.__key__ += 1
+			key = self.__key__
+		handle = obj.weak_ref(self.__on_finalized__, key)
+		with self.__lock__:
+			self.__released__[key] = (obj.get_name(), handle)
+
+
+	def __on_finalized__(self, key):
+
+		"""
+		Forget finalized object
+
+		Args:
+			key (int): key of the object
+		"""
+
+		with self.__lock__:
+			self.__released__.pop(key, None)
+
+
+	def teardown(self, pipeline):
+
+		"""
+		Take elements to be reused out of the stopped pipeline and watch the
+		rest of the pipeline being finalized
+
+		Args:
+			pipeline (GstPipeline): pipeline in NULL state
+		"""
+
+		for pad, probe_id in self.__probes__:
+			pad.remove_probe(probe_id)
+		self.__probes__ = []
+		for element in list(pipeline.iterate_elements()):
+			factory = element.get_factory()
+			if factory is not None and factory.get_name() == 'tee':
+				for pad in list(element.srcpads):
+					element.release_request_pad(pad)
+			pipeline.remove(element)
+			if self.__elements__.get(element.get_name()) is not element:
+				self.track(element)
+		self.track(pipeline)
+		self.__generation__ += 1
+
+
+	def clear(self):
+
+		"""
+		Forget elements kept for reuse, e.g. when one of them may be broken
+		"""
+
+		self.__elements__ = {}
+
+
+	def check(self):
+
+		"""
+		Report released objects that are still alive. Must be called once
+		the caller dropped its references to them.
+
+		Returns:
+			list: names and reference counts of the leaked objects
+		"""
+
+		with self.__lock__:
+			alive = bool(self.__released__)
+		if alive:
+			# NOTE: Collection is only paid for when reference cycles may keep
+			# the objects alive.
+			gc.collect()
+		leaked = []
+		with self.__lock__:
+			released = list(self.__released__.items())
+			self.__released__ = {}
+		for key, (obj_name, handle) in released:
+			obj = handle()
+			if obj is None:
+				continue
+			# reference of the local variable is not counted
+			leaked.append({'name': obj_name, 'refcount': obj.__grefcount__ - 1})
+			handle.unref()
+		for obj in leaked:
+			logging.warning(
+				"Leaked " + obj['name'] + " with " + str(obj['refcount']) +
+				" references")
+		self.__metrics__.inc(Metrics.LEAKED_OBJECTS, len(leaked))
+		self.__leaked__ = leaked
+		return leaked
+
+
+	def get_statistics(self):
+
+		"""
+		Return lifecycle statistics
+
+		Returns:
+			dict: number of pipelines torn down, elements created and reused
+				and objects leaked by the last teardown
+		"""
+
+		with self.__lock__:
+			pending = len(self.__released__)
+		return {
+			'generation': self.__generation__, 'created': self.__created__,
+			'reused': self.__reused__, 'pending': pending,
+			'leaked': self.__leaked__}
+
+
+class EncoderSelector(object):
+
+	"""
+	Encoder Selector choosing H.264 encoder of raw frames. Available
+	candidates are benchmarked once per resolution and framerate on the test
+	source in a dedicated process and the one spending the least CPU time per
+	frame while sustaining the framerate is chosen, so that the pipeline falls
+	back to a software encoder where the hardware encoder is missing or busy.
+	H.264 encoded by the camera itself is used instead whenever raw frames are
+	not needed.
+	"""
+
+	CANDIDATES = ('v4l2h264enc', 'x264enc', 'openh264enc')
+	FRAMES = 60
+	MARGIN = 1.2
+	TIMEOUT = 10
+	# time to spawn the benchmark process and initialize GStreamer
+	STARTUP = 30
+
+
+	def __init__(self, encoder=None, path=ENCODER_CACHE):
+
+		"""
+		Initialize Encoder Selector
+
+		Args:
+			encoder (str): encoder to use without benchmarking, None to select
+				automatically
+			path (str): path to the file with cached benchmark results
+		"""
+
+		self.__encoder__ = encoder
+		self.__path__ = path
+		self.__lock__ = threading.Lock()
+		self.__rejected__ = set()
+		self.__selected__ = {}
+		self.__results__ = {}
+		self.__scheduled__ = set()
+
+
+	def make(self, factory_name, element_name, bitrate, framerate, controls):
+
+		"""
+		Return encoder tuned for low latency
+
+		Args:
+			factory_name (str): name of the encoder factory
+			element_name (str): name of the element
+			bitrate (int): bitrate in bits per second
+			framerate (int): framerate, also the keyframe interval
+			controls (str): extra controls of the V4L2 encoder
+
+		Returns:
+			GstElement: encoder, None if not available
+		"""
+
+		encoder = Gst.ElementFactory.make(factory_name, element_name)
+		if encoder is None:
+			return None
+		if factory_name == 'v4l2h264enc':
+			encoder.set_property(
+				'extra-controls', Gst.Structure.new_from_string(controls))
+		elif factory_name == 'x264enc':
+			Gst.util_set_object_arg(encoder, 'tune', 'zerolatency')
+			Gst.util_set_object_arg(encoder, 'speed-preset', 'ultrafast')
+			encoder.set_property('bitrate', max(1, bitrate // 1000))
+			encoder.set_property('key-int-max', framerate)
+		elif factory_name == 'openh264enc':
+			Gst.util_set_object_arg(encoder, 'complexity', 'low')
+			Gst.util_set_object_arg(encoder, 'usage-type', 'camera')
+			encoder.set_property('bitrate', bitrate)
+			encoder.set_property('gop-size', framerate)
+		return encoder
+
+
+	def benchmark(self, factory_name, width, height, framerate):
+
+		"""
+		Encode frames of the test source as fast as possible. CPU time is
+		measured for the whole process, so it is only meaningful in the
+		dedicated benchmark process.
+
+		Args:
+			factory_name (str): name of the encoder factory
+			width (int): width of the frames
+			height (int): height of the frames
+			framerate (int): framerate
+
+		Returns:
+			dict: frames per second and CPU time per frame in milliseconds,
+				None if the encoder failed
+		"""
+
+		pipeline = Gst.Pipeline.new('encoder-benchmark')
+		source = Gst.ElementFactory.make('videotestsrc', None)
+		source.set_property('num-buffers', self.FRAMES)
+		Gst.util_set_object_arg(source, 'pattern', 'ball')
+		caps = Gst.Caps.new_empty_simple('video/x-raw')
+		caps.set_value('format', 'I420')
+		caps.set_value('width', width)
+		caps.set_value('height', height)
+		caps.set_value('framerate', Gst.Fraction(framerate, 1))
+		capsfilter = Gst.ElementFactory.make('capsfilter', None)
+		capsfilter.set_property('caps', caps)
+		# NOTE: Benchmark runs at the default bitrate, it only has to tell
+		# whether the encoder keeps up.
+		encoder = self.make(
+			factory_name, None, 3000000, framerate,
+			'encode,video_bitrate=3000000,h264_i_frame_period=' +
+			str(framerate))
+		sink = Gst.ElementFactory.make('fakesink', None)
+		sink.set_property('sync', False)
+		elements = (source, capsfilter, encoder, sink)
+		for element in elements:
+			pipeline.add(element)
+		if not all(
+			upstream.link(downstream)
+			for upstream, downstream in zip(elements, elements[1:])):
+			return None
+		bus = pipeline.get_bus()
+		start = time.monotonic()
+		cpu = time.process_time()
+		message = None
+		if pipeline.set_state(Gst.State.PLAYING) != \
+			Gst.StateChangeReturn.FAILURE:
+			message = bus.timed_pop_filtered(
+				self.TIMEOUT * Gst.SECOND,
+				Gst.MessageType.EOS | Gst.MessageType.ERROR)
+		elapsed = time.monotonic() - start
+		cpu = time.process_time() - cpu
+		pipeline.set_state(Gst.State.NULL)
+		if message is None or message.type == Gst.MessageType.ERROR:
+			if message is not None:
+				error, _ = message.parse_error()
+				logging.warning(factory_name + " failed: " + str(error))
+			return None
+		return {
+			'fps': round(self.FRAMES / elapsed, 1),
+			'cpu_ms': round(cpu * 1000 / self.FRAMES, 2)}
+
+
+	def __load__(self, key):
+
+		"""
+		Return benchmark results cached for the key
+
+		Args:
+			key (list): hardware, GStreamer version, resolution and framerate
+
+		Returns:
+			dict: benchmark results by encoder, empty if not cached
+		"""
+
+		try:
+			with open(self.__path__, 'r') as cache:
+				for entry in json.load(cache):
+					if entry['key'] == key:
+						return dict(entry['results'])
+		except (OSError, ValueError, KeyError, TypeError):
+			pass
+		return {}
+
+
+	def __save__(self, key, results):
+
+		"""
+		Cache benchmark results for the key
+
+		Args:
+			key (list): hardware, GStreamer version, resolution and framerate
+			results (dict): benchmark results by encoder
+		"""
+
+		entries = []
+		try:
+			with open(self.__path__, 'r') as cache:
+				entries = [
+					entry for entry in json.load(cache) if entry['key'] != key]
+		except (OSError, ValueError, KeyError, TypeError):
+			pass
+		entries.append({'key': key, 'results': results})
+		try:
+			write_atomic(self.__path__, json.dumps(entries))
+		except OSError as e:
+			logging.warning("Unable to cache encoder benchmark: " + str(e))
+
+
+	def __spawn__(self, candidates, width, height, framerate):
+
+		"""
+		Benchmark candidates one by one in a dedicated process, so that the
+		CPU time of the HTTPS Server, telemetry and running pipelines does not
+		distort the comparison
+
+		Args:
+			candidates (list): names of the encoder factories
+			width (int): width of the frames
+			height (int): height of the frames
+			framerate (int): framerate
+
+		Returns:
+			dict: benchmark results by encoder, None if the encoder failed
+		"""
+
+		context = multiprocessing.get_context('spawn')
+		connection, child_connection = context.Pipe(False)
+		process = context.Process(
+			name='Encoder Benchmark', target=benchmark_encoders,
+			args=(candidates, width, height, framerate, child_connection))
+		process.start()
+		child_connection.close()
+		results = {}
+		try:
+			if connection.poll(
+				self.STARTUP + self.TIMEOUT * len(candidates)):
+				results = connection.recv()
+		except (EOFError, OSError) as e:
+			logging.warning("Encoder benchmark failed: " + str(e))
+		connection.close()
+		process.join(1)
+		if process.is_alive():
+			logging.warning("Encoder benchmark timed out")
+			process.terminate()
+			process.join()
+		for candidate in candidates:
+			results.setdefault(candidate, None)
+			logging.info(
+				"Encoder " + candidate + " at " + str(width) + "x" +
+				str(height) + "@" + str(framerate) + ": " +
+				str(results[candidate]))
+		return results
+
+
+	def __benchmark__(self, mode):
+
+		"""
+		Benchmark available candidates not benchmarked for the mode yet
+
+		Args:
+			mode (tuple): width, height and framerate
+		"""
+
+		key = [camera_probe_key(), Gst.version_string()] + list(mode)
+		results = self.__load__(key)
+		candidates = [
+			candidate for candidate in self.CANDIDATES
+			if candidate not in results and
+			Gst.ElementFactory.find(candidate) is not None]
+		if candidates:
+			results.update(self.__spawn__(candidates, *mode))
+			self.__save__(key, results)
+		with self.__lock__:
+			self.__results__[mode] = results
+			self.__scheduled__.discard(mode)
+
+
+	def __choose__(self, mode, results):
+
+		"""
+		Return encoder sustaining the mode at the lowest CPU cost
+
+		Args:
+			mode (tuple): width, height and framerate
+			results (dict): benchmark results by encoder
+
+		Returns:
+			str: name of the encoder factory
+		"""
+
+		working = [
+			candidate for candidate in self.CANDIDATES
+			if results.get(candidate) is not None and
+			candidate not in self.__rejected__]
+		sustaining = [
+			candidate for candidate in working
+			if results[candidate]['fps'] >= mode[2] * self.MARGIN]
+		if sustaining:
+			return min(
+				sustaining, key=lambda candidate: results[candidate]['cpu_ms'])
+		if working:
+			logging.warning(
+				"No encoder sustains " + str(mode[0]) + "x" + str(mode[1]) +
+				"@" + str(mode[2]))
+			return max(working, key=lambda candidate: results[candidate]['fps'])
+		logging.error("No encoder available")
+		return self.__get_fallback__()
+
+
+	def __get_fallback__(self):
+
+		"""
+		Return encoder used for the mode that is not benchmarked yet
+
+		Returns:
+			str: name of the encoder factory
+		"""
+
+		for encoder in list(self.__selected__.values()):
+			if encoder not in self.__rejected__:
+				return encoder
+		for candidate in self.CANDIDATES:
+			if (
+				candidate not in self.__rejected__ and
+				Gst.ElementFactory.find(candidate) is not None
+			):
+				return candidate
+		# let the pipeline fail and recover as before
+		return self.CANDIDATES[0]
+
+
+	def prepare(self, width, height, framerate):
+
+		"""
+		Benchmark candidates for the mode unless cached. Blocks, so it is
+		meant to be called once on startup before the pipeline is built and
+		Flow Watchdog is armed.
+
+		Args:
+			width (int): width of the frames
+			height (int): height of the frames
+			framerate (int): framerate
+		"""
+
+		mode = (width, height, framerate)
+		if self.__encoder__ is not None or mode in self.__results__:
+			return
+		self.__benchmark__(mode)
+
+
+	def select(self, width, height, framerate):
+
+		"""
+		Return encoder sustaining the resolution and framerate at the lowest
+		CPU cost. Never blocks: the mode that is not benchmarked yet is
+		benchmarked in the background and meanwhile uses the encoder of the
+		previous mode, the selection takes effect on the next restart.
+
+		Args:
+			width (int): width of the frames
+			height (int): height of the frames
+			framerate (int): framerate
+
+		Returns:
+			str: name of the encoder factory
+		"""
+
+		if self.__encoder__ is not None:
+			return self.__encoder__
+		mode = (width, height, framerate)
+		with self.__lock__:
+			results = self.__results__.get(mode)
+			schedule = results is None and mode not in self.__scheduled__
+			if schedule:
+				self.__scheduled__.add(mode)
+		if schedule:
+			logging.info(
+				"Benchmarking encoders for " + str(width) + "x" +
+				str(height) + "@" + str(framerate) + " in the background")
+			threading.Thread(
+				name=name(self) + ' Thread', target=self.__benchmark__,
+				args=(mode,), daemon=True).start()
+		if results is None:
+			encoder = self.__get_fallback__()
+		else:
+			encoder = self.__choose__(mode, results)
+		if self.__selected__.get(mode) != encoder:
+			logging.info("Using " + encoder + " encoder")
+		self.__selected__[mode] = encoder
+		return encoder
+
+
+	def reject(self, factory_name):
+
+		"""
+		Exclude encoder that failed in the pipeline from the selection, the
+		next encoder is chosen from the cached benchmark results
+
+		Args:
+			factory_name (str): name of the encoder factory
+		"""
+
+		if self.__encoder__ is not None or factory_name not in self.CANDIDATES:
+			return
+		logging.warning("Rejecting " + factory_name + " encoder")
+		self.__rejected__.add(factory_name)
+
+
+	def get_statistics(self):
+
+		"""
+		Return selection statistics
+
+		Returns:
+			dict: selected encoders, benchmark results and rejected encoders
+				by mode
+		"""
+
+		with self.__lock__:
+			results = dict(self.__results__)
+		return {
+			'selected': {
+				str(width) + 'x' + str(height) + '@' + str(framerate): encoder
+				for (width, height, framerate), encoder in
+				self.__selected__.items()},
+			'results': {
+				str(width) + 'x' + str(height) + '@' + str(framerate): result
+				for (width, height, framerate), result in results.items()},
+			'rejected': sorted(self.__rejected__)}
+
+
+def benchmark_encoders(candidates, width, height, framerate, connection):
+
+	"""
+	Encoder benchmark process entry method
+
+	Args:
+		candidates (list): names of the encoder factories
+		width (int): width of the frames
+		height (int): height of the frames
+		framerate (int): framerate
+		connection (Connection): connection the results are sent over
+	"""
+
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	Gst.init(None)
+	selector = EncoderSelector()
+	connection.send({
+		candidate: selector.benchmark(candidate, width, height, framerate)
+		for candidate in candidates})
+	connection.close()
+
+
+class CameraServer(Server):
+	
+	"""
+	Camera Server
+	"""
+
+	# NOTE: Other messages, e.g. QOS, are dropped by GStreamer without
+	# entering Python.
+	BUS_MESSAGES = (
+		Gst.MessageType.EOS | Gst.MessageType.ERROR | Gst.MessageType.ELEMENT |
+		Gst.MessageType.STATE_CHANGED)
+	BUS_TIMEOUT = 100 * Gst.MSECOND
+	# NOTE: State changes are acted on only for the sinks of the branches.
+	STATE_SOURCES = ('rtsp-sink', 'file-sink')
+	TIMELAPSE_TIMEOUT = 2
+	# NOTE: Timelapse fragments are rotated daily regardless of the recording
+	# settings, which may disable the rotation.
+	TIMELAPSE_MAX_SIZE_TIME = 24 * 3600 * Gst.SECOND
+	# NOTE: Every camera gets a block of local RTP ports for its regions of
+	# interest, so that cameras with consecutive port offsets do not clash.
+	ROI_PORT = 32000
+	MAX_ROIS = 16
+	ROI_BITRATE = 1000000
+
+
+	def __init__(self, args, telemetry, metrics):
+
+		"""
+		Initialize Camera Server
+
+		Args:
+			args (Namespace): command line arguments
+			telemetry (TelemetrySampler): telemetry sampler
+			metrics (Metrics): metrics
+		"""
+
+		self.__telemetry__ = telemetry
+		self.__metrics__ = metrics
+		self.__camera_timeout__ = args.camera_timeout
+		self.__throughput__ = args.throughput
+		self.__zero_copy__ = args.zero_copy
+		self.__camera_number__ = args.camera_number
+		self.__port_offset__ = args.port_offset
+		self.__zero_copy_cache__ = PersistentFile(ZERO_COPY_CACHE)
+		self.__zero_copy_fallback__ = self.__load_zero_copy_fallback__()
+		self.__zero_copy_links__ = {}
+		self.__default_logging_level__ = getattr(logging, args.debug.upper())
+		self.__error_lock__ = threading.Lock()
+		self.__main_lock__ = threading.Lock()
+		#self.__stats_lock__ = threading.Lock()
+		self.__restart_lock__ = threading.Lock()
+		self.__bus_thread__ = None
+		self.__bus_running__ = False
+		self.__timelapse_timer_id__ = 0
+		self.__timelapse_eos__ = threading.Event()
+		if args.model is not None:
+			self.__model__ = args.model
+		else:
+			self.__model__ = detect_camera()
+		self.__stats_id__ = 0
+		self.__extra_controls__ = 'encode,video_bitrate_mode={},h264_profile=0,\
+			h264_level=11,video_bitrate={},h264_i_frame_period={}'
+		parameters = None
+		self.__config__ = PersistentFile('camera.json')
+		self.__recovery__ = RecoveryEngine()
+		self.__lifecycle__ = PipelineLifecycle(metrics)
+		self.__encoder_selector__ = EncoderSelector(
+			None if args.encoder == 'auto' else args.encoder)
+
+		try:
+			with open('camera.json', 'r') as config:
+				parameters = json.load(config)
+		except:
+			logging.warning("'camera.json' not found")
+
+		if parameters is not None and 'persistent' in parameters and \
+			parameters['persistent'] == 1:
+
+			logging.info("Loading parameters from 'camera.json'")
+			
+			# Quality
+
+			if 'width' in parameters:
+				self.__width__ = parameters['width']
+			else:
+				if self.__model__ == 'imx219' or self.__model__ == 'imx477':
+					self.__width__ = 800
+				if self.__model__ == 'ov9281':
+					self.__width__ = 1280
+				if self.__model__ == 'v4l2':
+					self.__width__ = 1280
+			if 'height' in parameters:
+				self.__height__ = parameters['height']
+			else:
+				if self.__model__ == 'imx219' or self.__model__ == 'imx477':
+					self.__height__ = 608
+				if self.__model__ == 'ov9281':
+					self.__width__ = 800
+				if self.__model__ == 'v4l2':
+					self.__height__ = 720
+			if 'framerate' in parameters:
+				self.__framerate__ = parameters['framerate']
+			else:
+				self.__framerate__ = 30
+			if 'bitrate_mode' in parameters:
+				self.__bitrate_mode__ = parameters['bitrate_mode']
+			else:
+				self.__bitrate_mode__ = 0
+			if 'bitrate' in parameters:
+				self.__bitrate__ = parameters['bitrate']
+			else:
+				self.__bitrate__ = 3000000
+			if 'sensor_mode' in parameters:
+				self.__sensor_mode__ = parameters['sensor_mode']
+			else:
+				self.__sensor_mode__ = 0
+
+			# Effects	
+
+			if 'brightness' in parameters:
+				self.__brightness__ = parameters['brightness']
+			else:
+				self.__brightness__ = 50
+			if 'contrast' in parameters:
+				self.__contrast__ = parameters['contrast']
+			else:
+				self.__contrast__ = 0
+			if 'saturation' in parameters:
+				self.__saturation__ = parameters['saturation']
+			else:
+				self.__saturation__ = 0
+			if 'sharpness' in parameters:
+				self.__sharpness__ = parameters['sharpness']
+			else:
+				self.sharpness = 0
+			if 'drc' in parameters:
+				self.__drc__ = parameters['drc']
+			else:
+				self.__drc = 0
+			if 'image_effect' in parameters:
+				self.__image_effect__ = parameters['image_effect']
+			else:
+				self.__image_effect__ = 0
+			if 'awb_mode' in parameters:
+				self.__awb_mode__ = parameters['awb_mode']
+			else:
+				self.__awb_mode__ = 1
+			if 'awb_gain_blue' in parameters:
+				self.__awb_gain_blue__ = parameters['awb_gain_blue']
+			else:
+				self.__awb_gain_blue__ = 0
+			if 'awb_gain_red' in parameters:
+				self.__awb_gain_red__ = parameters['awb_gain_red']
+			else:
+				self.__awb_gain_red__ = 0
+
+			# Settings
+
+			if 'exposure_mode' in parameters:
+				self.__exposure_mode__ = parameters['exposure_mode']
+			else:
+				self.__exposure_mode__ = 1
+			if 'metering_mode' in parameters:
+				self.__metering_mode__ = parameters['metering_mode']
+			else:
+				self.__metering_mode__ = 0
+			if 'exposure_compensation' in parameters:
+				self.__exposure_compensation__ = \
+					parameters['exposure_compensation']
+			else:
+				self.__exposure_compensation__ = 0
+			if 'iso' in parameters:
+				self.__iso__ = parameters['iso']
+			else:
+				self.__iso__ = 0
+			if 'shutter_speed' in parameters:
+				self.__shutter_speed__ = parameters['shutter_speed']
+			else:
+				self.__shutter_speed__ = 0
+			if 'video_stabilisation' in parameters:
+				self.__video_stabilisation__ = \
+					(parameters['video_stabilisation'] == 1)
+			else:
+				self.__video_stabilisation__ = False
+			if 'gain' in parameters:
+				self.__gain__ = parameters['gain']
+			else:
+				self.__gain__ = 1
+			if 'awb' in parameters:
+				self.__awb__ = parameters['awb']
+			else:
+				self.__awb__ = 4
+
+			# Orientation
+
+			if 'rotation' in parameters:
+				self.__rotation__ = parameters['rotation']
+			else:
+				self.__rotation__ = 0
+			if 'hflip' in parameters:
+				self.__hflip__ = (parameters['hflip'] == 1)
+			else:
+				self.__hflip__ = False
+			if 'vflip' in parameters:
+				self.__vflip__ = (parameters['vflip'] == 1)
+			else:
+				self.__vflip__ = False
+			if 'video_direction' in parameters:
+				self.__video_direction__ = parameters['video_direction']
+			else:
+				self.__video_direction__ = 0
+	
+			# Controls
+
+			if 'logging_level' in parameters:
+				self.__logging_level__ = parameters['logging_level']
+			else:
 				self.__logging_level__ = 0
 			if 'stats' in parameters:
 				self.__stats__ = int(parameters['stats'], 16)
@@ -679,633 +4059,1595 @@ class CameraServer(Server):
 			if self.__continuation__:
 				self.__fragment_id__ = parameters['fragment_id']
 			else:
-				self.__fragment_id__ = 0
-			self.__persistent__ = (parameters['persistent'] == 1)
+				self.__fragment_id__ = 0
+			if 'timelapse' in parameters:
+				self.__timelapse__ = parameters['timelapse']
+			else:
+				self.__timelapse__ = 0
+			if 'timelapse_id' in parameters:
+				self.__timelapse_id__ = parameters['timelapse_id']
+			else:
+				self.__timelapse_id__ = 0
+			if 'rois' in parameters:
+				self.__rois__ = parameters['rois']
+			else:
+				self.__rois__ = {}
+			self.__persistent__ = (parameters['persistent'] == 1)
+		
+		else:
+		
+			# Quality
+
+			if self.__model__ == 'imx219' or self.__model__ == 'imx477':
+				self.__width__ = 800
+				self.__height__ = 608
+			if self.__model__ == 'ov9281':
+				self.__width__ = 1280
+				self.__height__ = 800				
+			if self.__model__ == 'v4l2':
+				self.__width__ = 1280
+				self.__height__ = 720
+			self.__framerate__ = 30
+			self.__bitrate_mode__ = 0
+			self.__bitrate__ = 3000000
+			self.__sensor_mode__ = 0
+
+			# Effects
+
+			self.__brightness__ = 50
+			self.__contrast__ = 0
+			self.__saturation__ = 0
+			self.__sharpness__ = 0
+			self.__drc__ = 0
+			self.__image_effect__ = 0
+			self.__awb_mode__ = 1
+			self.__awb_gain_blue__ = 0
+			self.__awb_gain_red__ = 0
+
+			# Settings
+
+			self.__exposure_mode__ = 1
+			self.__metering_mode__ = 0
+			self.__exposure_compensation__ = 0
+			self.__iso__ = 0
+			self.__shutter_speed__ = 0
+			# TODO(marcin.sielski): Change it to True
+			self.__video_stabilisation__ = False
+			self.__gain__ = 1
+			self.__awb__ = 4
+
+			# Orientation
+
+			self.__rotation__ = 0
+			self.__hflip__ = False
+			self.__vflip__ = False
+			self.__video_direction__ = 0
+
+			# Controls
+
+			self.__logging_level__ = 0
+			self.__stats__ = 0x00000000
+			self.__rtsp__ = False
+			self.__record__ = False
+			self.__format__ = False
+			self.__max_files__ = 0
+			self.__max_size_bytes__ = 0
+			self.__max_size_time__ = 0
+			self.__fragment_id__ = 0
+			self.__continuation__ = False
+			self.__timelapse__ = 0
+			self.__timelapse_id__ = 0
+			self.__rois__ = {}
+			self.__persistent__ = False
+
+		self.__uploader__ = None
+		self.__rtsp_server__ = None
+		self.__broker__ = None
+		self.__raw_pending__ = False
+		# NOTE: Encoders are benchmarked before the pipeline is built and Flow
+		# Watchdog is armed, so that restarts never wait for the benchmark.
+		if self.__needs_raw__():
+			self.__encoder_selector__.prepare(
+				self.__width__, self.__height__, self.__framerate__)
+		for roi in self.__rois__.values():
+			self.__encoder_selector__.prepare(
+				roi['output_width'], roi['output_height'], self.__framerate__)
+
+		self.init()
+
+
+	def set_time(self, time):
+		
+		"""
+		Sets system time to specified time
+		
+		Args:
+			time (int): time to set
+
+		Returns:
+			bool: True if the time is being set, False if the broker is not
+				running
+		"""
+		
+		if self.__broker__ is None:
+			return False
+		return self.__broker__.set_time(time)
+
+
+	def send_keyframe(self):
+
+		"""
+		Forces to send key frame
+		"""
+
+		self.__metrics__.inc(Metrics.KEYFRAMES)
+		srcpad = self.__encoder__.get_static_pad( "src")
+		structure = Gst.Structure.new_empty("GstForceKeyUnit")
+		structure.set_value('all-headers', True)
+		srcpad.send_event(
+			Gst.Event.new_custom(Gst.EventType.CUSTOM_UPSTREAM,
+			structure))
+
+
+
+	def get_parameters(self):
+
+		"""
+		Return Camera Server parameters set
+
+		Returns:
+			json: Camera Server parameters set
+		"""
+
+		self.send_keyframe()
+		return json.dumps(
+			{
+				'model': self.__model__, 
+
+				# Quality
+
+				'width': self.__width__, 
+				'height': self.__height__, 
+				'framerate': self.__framerate__, 
+				'bitrate_mode': self.get_bitrate_mode(),
+				'bitrate': self.__bitrate__,
+				'sensor_mode': self.__sensor_mode__,
+
+				# Effects
+
+				'brightness': self.__brightness__,
+				'contrast': self.__contrast__,
+				'saturation': self.__saturation__,
+				'sharpness': self.__sharpness__,
+				'drc': self.__drc__,
+				'image_effect': self.__image_effect__, 
+				'awb_mode': self.__awb_mode__,
+				'awb_gain_blue': self.__awb_gain_blue__,
+				'awb_gain_red': self.__awb_gain_red__, 
+
+				# Settings
+
+				'exposure_mode': self.__exposure_mode__,
+				'metering_mode': self.__metering_mode__,
+				'exposure_compensation': self.__exposure_compensation__,
+				'iso': self.__iso__,
+				'shutter_speed': self.__shutter_speed__,
+				'video_stabilisation': int(self.__video_stabilisation__),
+				'gain': self.__gain__,
+				'awb': self.__awb__,
+
+				# Orientation
+
+				'rotation': self.__rotation__, 
+				'hflip': int(self.__hflip__),
+				'vflip': int(self.__vflip__),
+				'video_direction': self.__video_direction__,
+
+				# Controls
+
+				'logging_level': int(self.__logging_level__),
+				'stats': '{0:#0{1}x}'.format(self.__stats__,10),
+				'rtsp': int(self.__rtsp__),
+				'record': int(self.__record__),
+				'format': int(self.__format__),
+				'max_files': self.__max_files__,
+				'max_size_bytes': self.__max_size_bytes__,
+				'max_size_time': self.__max_size_time__,
+				'persistent': int(self.__persistent__),
+				'fragment_id': self.__fragment_id__,
+				'continuation': int(self.__continuation__),
+				'timelapse': self.__timelapse__,
+				'timelapse_id': self.__timelapse_id__,
+				'rois': self.__rois__
+			},
+
+			sort_keys=True)
+
+
+	def __get_key__(self, e):
+		
+		"""
+		Obtain key
+		"""
+
+		return e[0]
+
+
+	def get_media(self):
+
+		"""
+		Obtain names of media files from the media folder
+
+		Returns:
+			json: list of media files from the media folder
+		"""
+
+		media = []
+		free = self.__telemetry__.get_snapshot().disk_free
+		media.append([str(free // (2**30))])
+		_, _, filenames = next(os.walk('.'))	
+		for filename in filenames:
+			if filename.endswith('.mkv') or filename.endswith('.mp4'):
+				media.append(
+					[filename,  datetime.datetime.fromtimestamp(
+						os.path.getmtime(
+							filename)).strftime("%Y-%m-%d, %H:%M")])
+		media.sort(key=self.__get_key__)
+		return json.dumps(media, sort_keys=True)
+
+
+	def init(self):
+
+		"""
+		Initialize streaming pipeline
+		"""
+
+		self.__pipeline__ = Gst.Pipeline('camera-server-pipeline')
+
+		self.__raw__ = self.__needs_raw__()
+		self.__source__ = self.__get_source__()
+		if self.__raw__:
+			self.__source_caps__ = Gst.Caps.new_empty_simple('video/x-raw')
+		else:
+			# NOTE: When nothing consumes raw frames H.264 is taken directly
+			# from the camera encoder instead of re-encoding raw frames.
+			logging.info("Using camera encoder")
+			self.__source_caps__ = Gst.Caps.new_empty_simple('video/x-h264')
+			self.__source_caps__.set_value('profile', 'baseline')
+			self.__source__.set_property('bitrate', self.__bitrate__)
+			self.__source__.set_property(
+				'keyframe-interval', self.__framerate__)
+			self.__source__.set_property('inline-headers', True)
+		self.__source_caps__.set_value('width', self.__width__)
+		self.__source_caps__.set_value('height', self.__height__)
+		#if self.__shutter_speed__ > 0 and 1000000 / self.__shutter_speed__ < self.__framerate__:
+		#	if 1000000 / self.__shutter_speed__ < 1:
+		#		numerator = 1
+		#		denominator = int(1000000 % self.__shutter_speed__)
+		#	else:
+		#		numerator = int(1000000 / self.__shutter_speed__)
+		#		denominator = 1
+		#else:
+		#numerator = self.__framerate__
+		#denominator = 1
+		#self.__source_caps__.set_value(
+		#	'framerate', Gst.Fraction(numerator, denominator))
+		if self.__raw__ and (
+			self.__model__ == 'imx219' or self.__model__ == 'imx477'):
+			self.__source_caps__.set_value('format', 'I420')                        
+		if self.__model__ == 'ov9281':
+			self.__source_caps__.set_value('format', 'GRAY8')		
+		self.__source_caps__.set_value(
+			'framerate', Gst.Fraction(self.__framerate__, 1))
+
+		self.__source_capsfilter__ = Gst.ElementFactory.make(
+			'capsfilter', 'source-capsfilter')
+		self.__source_capsfilter__.set_property('caps', self.__source_caps__)
+
+		self.__source_counter__ = Gst.ElementFactory.make(
+			'identity', 'source-counter')
+		self.__source_counter__.set_property('silent', True)
+		# NOTE: Handoff signal is not emitted for every buffer if supported.
+		if self.__source_counter__.find_property('signal-handoffs'):
+			self.__source_counter__.set_property('signal-handoffs', False)
+
+		if self.__model__ == 'ov9281':
+			self.__overlay__ = Gst.ElementFactory.make(
+				'textoverlay', 'text-overlay')
+			self.__overlay__.set_property('shaded-background', True)
+			self.__overlay__.set_property('valignment','top')
+			self.__overlay__.set_property('font-desc', 'Arial, 12')
+
+		self.__raw_tee__ = self.__lifecycle__.make('tee', 'raw-tee')
+
+		if self.__model__ == 'ov9281' or self.__model__ == 'v4l2':
+			self.__converter__ = Gst.ElementFactory.make(
+				'videoconvert', 'converter')
+			self.__converter_caps__ = Gst.Caps.new_empty_simple('video/x-raw')
+			self.__converter_caps__.set_value('width', self.__width__)
+			self.__converter_caps__.set_value('height', self.__height__)
+			self.__converter_caps__.set_value(
+				'framerate', Gst.Fraction(self.__framerate__, 1))
+			if self.__model__ == 'ov9281':
+				self.__converter_caps__.set_value('format', 'RGB')
+			else:
+				self.__converter_caps__.set_value('format', 'I420')
+			self.__converter_capsfilter__ = Gst.ElementFactory.make(
+			'capsfilter', 'converter-capsfilter')
+			self.__converter_capsfilter__.set_property(
+				'caps', self.__converter_caps__)
+				
+		#self.__source_queue__ = Gst.ElementFactory.make(
+		#	'queue', 'source-gueue')
+		#self.__video_rate__ = Gst.ElementFactory.make(
+		#	'videorate', 'video-rate')
+		#self.__video_rate__.set_property('average-period', 9223372036854775807)
+		#self.__video_rate__.set_property('rate', 0.9)
+		#if self.__shutter_speed__ < 100000:
+		#	self.__video_rate__.set_property('max-duplication-time', 10000000)
+		#self.__video_rate_caps__ = Gst.Caps.new_empty_simple('video/x-raw')
+		#self.__video_rate_caps__.set_value(
+		#	'framerate', Gst.Fraction(self.__framerate__, 1))
+		#self.__video_rate_capsfilter__ = Gst.ElementFactory.make(
+		#	'capsfilter', 'video-rate-capsfilter')
+		#self.__video_rate_capsfilter__.set_property(
+		#	'caps', self.__video_rate_caps__)
+		#self.__video_rate_queue__ = Gst.ElementFactory.make(
+		#	'queue', 'video-rate-gueue')
 		
+		if self.__raw__:
+			self.__encoder__ = self.__get_encoder__()
+			if self.__zero_copy__ and self.__exports_dmabuf__():
+				self.__set_zero_copy__()
 		else:
+			self.__encoder__ = self.__source__
+
+		self.__encoder_caps__ = Gst.Caps.new_empty_simple('video/x-h264')
+		self.__encoder_caps__.set_value('profile', 'baseline')
+		# NOTE: Software encoders pick the level on their own.
+		factory = self.__encoder__.get_factory()
+		if factory is not None and factory.get_name() == 'v4l2h264enc':
+			self.__encoder_caps__.set_value('level', '4')
+
+		self.__encoder_capsfilter__ = self.__lifecycle__.make(
+			'capsfilter', 'encoder-capsfilter')
+		self.__encoder_capsfilter__.set_property('caps', self.__encoder_caps__)
+
+		self.__parser__ = self.__lifecycle__.make('h264parse', 'parser')
+		GstBase.BaseParse.set_infer_ts(self.__parser__, True)	
+		GstBase.BaseParse.set_pts_interpolation(self.__parser__, True)
+		self.__parser__.set_property('config-interval', -1)
+
+		self.__encoder_counter__ = self.__lifecycle__.make(
+			'identity', 'encoder-counter')
+		self.__encoder_counter__.set_property('silent', True)
+		# NOTE: Handoff signal is not emitted for every buffer if supported.
+		if self.__encoder_counter__.find_property('signal-handoffs'):
+			self.__encoder_counter__.set_property('signal-handoffs', False)
+
+		self.__h264_tee__ = self.__lifecycle__.make('tee', 'h264-tee')
+
+		self.__payloader__ = self.__lifecycle__.make('rtph264pay', 'payloader')
+		self.__payloader__.set_property('config-interval', -1)
+
+		self.__rtsp_tee__ = self.__lifecycle__.make('tee', 'rtsp-tee')
+
+		self.__sink_queue__ = self.__lifecycle__.make('queue', 'sink-queue')
+		self.__sink_queue__.set_property(
+			'max-size-buffers', 0)
+		self.__sink_queue__.set_property(
+			'max-size-bytes', 0)
+		self.__sink_queue__.set_property('max-size-time', 0)
+
+		self.__sink__ = self.__lifecycle__.make('udpsink', 'sink')
+		self.__sink__.set_property('host', '127.0.0.1')
+		self.__sink__.set_property('port', 31415 + self.__port_offset__)
+		self.__sink__.set_property('sync', False)
+
+		self.__pipeline__.add(self.__source__)
+		self.__pipeline__.add(self.__source_counter__)
+		self.__pipeline__.add(self.__source_capsfilter__)
+		#self.__pipeline__.add(self.__source_queue__)
+		#self.__pipeline__.add(self.__video_rate__)
+		#self.__pipeline__.add(self.__video_rate_capsfilter__)
+		#self.__pipeline__.add(self.__video_rate_queue__)
+		
+		
+		if self.__model__ == 'ov9281':
+			self.__pipeline__.add(self.__overlay__)
+		if self.__raw__:
+			self.__pipeline__.add(self.__raw_tee__)
+		if self.__model__ == 'ov9281' or self.__model__ == 'v4l2':
+			self.__pipeline__.add(self.__converter__)
+			self.__pipeline__.add(self.__converter_capsfilter__)
+		if self.__raw__:
+			self.__pipeline__.add(self.__encoder__)
+			self.__pipeline__.add(self.__encoder_capsfilter__)
+		self.__pipeline__.add(self.__parser__)
+		self.__pipeline__.add(self.__encoder_counter__)
+		self.__pipeline__.add(self.__h264_tee__)
+		self.__pipeline__.add(self.__payloader__)
+		self.__pipeline__.add(self.__rtsp_tee__)
+		self.__pipeline__.add(self.__sink_queue__)
+		self.__pipeline__.add(self.__sink__)
+
+		self.__source__.link(self.__source_counter__)
+		self.__source_counter__.link(self.__source_capsfilter__)
+		#self.__source_capsfilter__.link(self.__source_queue__)
+		#self.__source_capsfilter__.link(self.__video_rate__)
+		#self.__video_rate__.link(self.__video_rate_capsfilter__)
+		#self.__video_rate_capsfilter__.link(self.__video_rate_queue__)
+		
+		if self.__model__ == 'imx219' or self.__model__ == 'imx477':
+			#self.__video_rate_capsfilter__.link(self.__raw_tee__)
+			if self.__raw__:
+				self.__source_capsfilter__.link(self.__raw_tee__)
+				self.__raw_tee__.link(self.__encoder__) 
+			else:
+				self.__source_capsfilter__.link(self.__parser__)
+		if self.__model__ == 'ov9281':
+			self.__source_capsfilter__.link(self.__overlay__)
+			self.__overlay__.link(self.__raw_tee__)
+			self.__raw_tee__.link(self.__converter__)  
+			self.__converter__.link(self.__converter_capsfilter__)  
+			self.__converter_capsfilter__.link(self.__encoder__)
+		if self.__model__ == 'v4l2':
+			self.__source_capsfilter__.link(self.__raw_tee__)
+			self.__raw_tee__.link(self.__converter__)
+			self.__converter__.link(self.__converter_capsfilter__)
+			self.__converter_capsfilter__.link(self.__encoder__)
+		if self.__raw__:
+			self.__encoder__.link(self.__encoder_capsfilter__)
+			self.__encoder_capsfilter__.link(self.__parser__)
+		self.__parser__.link(self.__encoder_counter__)
+		self.__encoder_counter__.link(self.__h264_tee__)
+		self.__h264_tee__.link(self.__payloader__)
+		self.__payloader__.link(self.__rtsp_tee__)
+		self.__rtsp_tee__.link(self.__sink_queue__)
+		self.__sink_queue__.link(self.__sink__)
+
+		self.__metrics__.add_counter(
+			self.__source_counter__, 'sink', Metrics.SOURCE)
+		self.__lifecycle__.add_probe(
+			self.__encoder_counter__, 'sink', self.__metrics__.add_counter(
+				self.__encoder_counter__, 'sink', Metrics.ENCODER))
+		self.__lifecycle__.add_probe(
+			self.__sink__, 'sink', self.__metrics__.add_counter(
+				self.__sink__, 'sink', Metrics.UDP))
+		if not TIMELINE.is_marked("first RTP packet"):
+			self.__sink__.get_static_pad('sink').add_probe(
+				Gst.PadProbeType.BUFFER, self.__on_first_packet__)
+		self.__zero_copy_links__ = {}
+		if (
+			self.__raw__ and self.__zero_copy__ and self.__exports_dmabuf__()
+		):
+			if self.__model__ == 'ov9281' or self.__model__ == 'v4l2':
+				link = 'converter-encoder'
+			else:
+				link = 'source-encoder'
+			self.__encoder__.get_static_pad('sink').add_probe(
+				Gst.PadProbeType.BUFFER, self.__on_zero_copy__, link)
 		
-			# Quality
+		self.__timelapse_valve__ = None
+		self.__timelapse_queue__ = None
+		self.__timelapse_converter__ = None
+		self.__timelapse_encoder__ = None
+		self.__timelapse_sink__ = None
+		if self.__timelapse__ > 0:
+			self.__init_timelapse__()
+		self.__roi_crops__ = {}
+		for roi_name in sorted(self.__rois__):
+			self.__init_roi__(roi_name)
+
+		# NOTE: Messages are handled on the Bus Thread instead of the sync
+		# handler, so that streaming threads posting them do not wait for the
+		# interpreter.
+		self.__bus__ = self.__pipeline__.get_bus()
+
+		self.__file_queue__ = None
+		self.__file_rate__ = None
+		self.__file_converter__ = None
+		self.__file_encoder__ = None
+		self.__file_sink__ = None
+		self.__file_muxer__ = None
+		self.__raw_framerate__ = 0
+		self.__rtsp_queue__ = None
+		self.__rtsp_sink__ = None
+		self.__metrics__.set_counters(self.get_counters)
+		# previous pipeline is no longer referenced
+		self.__lifecycle__.check()
+
+
+	def __init_timelapse__(self):
+
+		"""
+		Create timelapse branch admitting a single raw frame every timelapse
+		interval and encoding it as JPEG into rotated fragments
+		"""
+
+		# NOTE: Frames are dropped by the valve in the streaming thread of the
+		# source before any conversion work, so that the branch costs nothing
+		# between captures.
+		self.__timelapse_valve__ = Gst.ElementFactory.make(
+			'valve', 'timelapse-valve')
+		self.__timelapse_valve__.get_static_pad('src').add_probe(
+			Gst.PadProbeType.BUFFER, self.__on_timelapse_frame__)
+		self.__timelapse_queue__ = Gst.ElementFactory.make(
+			'queue', 'timelapse-queue')
+		self.__timelapse_queue__.set_property('max-size-buffers', 2)
+		self.__timelapse_queue__.set_property('max-size-bytes', 0)
+		self.__timelapse_queue__.set_property('max-size-time', 0)
+		self.__timelapse_queue__.set_property('leaky', 2)
+		self.__timelapse_converter__ = Gst.ElementFactory.make(
+			'videoconvert', 'timelapse-converter')
+		self.__timelapse_encoder__ = Gst.ElementFactory.make(
+			'jpegenc', 'timelapse-encoder')
+		self.__timelapse_sink__ = Gst.ElementFactory.make(
+			'splitmuxsink', 'timelapse-sink')
+		self.__timelapse_sink__.set_property(
+			'muxer', Gst.ElementFactory.make('matroskamux', 'timelapse-muxer'))
+		self.__timelapse_sink__.set_property(
+			'max-size-time', self.TIMELAPSE_MAX_SIZE_TIME)
+		self.__timelapse_sink__.set_property(
+			'max-files', self.__get_max_files__())
+		self.__timelapse_sink__.set_property(
+			'start-index', self.__timelapse_id__)
+		self.__timelapse_sink__.connect(
+			'format-location', self.__on_timelapse_location__)
+		self.__timelapse_sink__.set_property(
+			'location', self.__get_timelapse_location__(self.__timelapse_id__))
+		elements = (
+			self.__timelapse_valve__, self.__timelapse_queue__,
+			self.__timelapse_converter__, self.__timelapse_encoder__,
+			self.__timelapse_sink__)
+		for element in elements:
+			self.__pipeline__.add(element)
+		self.__raw_tee__.link(self.__timelapse_valve__)
+		for upstream, downstream in zip(elements, elements[1:]):
+			upstream.link(downstream)
+		# EOS of the branch is posted when the last fragment is finalized
+		self.__pipeline__.set_property('message-forward', True)
+
+
+	def __on_timelapse__(self):
+
+		"""
+		Open the valve to admit the next timelapse frame
+
+		Returns:
+			bool: True to keep the timer running
+		"""
+
+		self.__timelapse_valve__.set_property('drop', False)
+		return True
+
+
+	def __on_timelapse_frame__(self, pad, info):
+
+		"""
+		Close the valve behind the admitted timelapse frame
+
+		Args:
+			pad (GstPad): valve source pad
+			info (GstPadProbeInfo): probe info
+
+		Returns:
+			GstPadProbeReturn: OK to pass the frame
+		"""
+
+		self.__timelapse_valve__.set_property('drop', True)
+		return Gst.PadProbeReturn.OK
+
+
+	def __get_timelapse_location__(self, fragment_id):
+
+		"""
+		Return file name of the timelapse fragment
+
+		Args:
+			fragment_id (int): fragment id
+
+		Returns:
+			str: file name
+		"""
+
+		return 'v_' + str(self.__width__) + 'x' + str(self.__height__) + \
+			'_TL' + str(self.__timelapse__) + '_{0:0{1}}.mkv'.format(
+			fragment_id, 2)
+
+
+	def __on_timelapse_location__(self, splitmux, fragment_id):
+
+		"""
+		format-location callback executed when new timelapse file is about to
+		be created
+
+		Args:
+			splitmux (GstSplitMuxSink): splitmux sink element
+			fragment_id (int): fragment id
+
+		Returns:
+			str: file name
+		"""
+
+		self.__timelapse_id__ = fragment_id + 1
+		self.__metrics__.inc(Metrics.FRAGMENTS)
+		GLib.timeout_add_seconds(0, self.__on_store__)
+		return self.__get_timelapse_location__(fragment_id)
+
+
+	def __finalize_timelapse__(self):
+
+		"""
+		Finalize the timelapse fragment being written
+		"""
+
+		# broken pipeline may never deliver EOS to the sink
+		if self.__timelapse_sink__ is None or self.__error_lock__.locked():
+			return
+		self.__timelapse_eos__.clear()
+		self.__timelapse_queue__.get_static_pad('sink').send_event(
+			Gst.Event.new_eos())
+		if not self.__timelapse_eos__.wait(self.TIMELAPSE_TIMEOUT):
+			logging.warning("Timelapse fragment not finalized")
+
+
+	def __get_roi_port__(self, roi_name):
+
+		"""
+		Return local port RTP packets of the region of interest are sent to
+
+		Args:
+			roi_name (str): name of the region of interest
+
+		Returns:
+			int: port
+		"""
+
+		return self.ROI_PORT + self.__port_offset__ * self.MAX_ROIS + \
+			self.__rois__[roi_name]['slot']
+
+
+	def __set_crop__(self, crop, roi):
+
+		"""
+		Crop the region of interest out of the frame. Region is clamped to the
+		frame, e.g. after the resolution has been lowered.
+
+		Args:
+			crop (GstVideoCrop): crop element
+			roi (dict): region of interest
+		"""
+
+		left = min(roi['x'], self.__width__ - 2)
+		top = min(roi['y'], self.__height__ - 2)
+		crop.set_property('left', left)
+		crop.set_property('top', top)
+		crop.set_property(
+			'right', max(0, self.__width__ - left - roi['width']))
+		crop.set_property(
+			'bottom', max(0, self.__height__ - top - roi['height']))
+
+
+	def __init_roi__(self, roi_name):
+
+		"""
+		Create branch cropping the region of interest out of raw frames,
+		scaling it to its own resolution and streaming it over RTP
+
+		Args:
+			roi_name (str): name of the region of interest
+		"""
+
+		roi = self.__rois__[roi_name]
+		prefix = 'roi-' + roi_name + '-'
+		roi_queue = Gst.ElementFactory.make('queue', prefix + 'queue')
+		roi_queue.set_property('max-size-buffers', 2)
+		roi_queue.set_property('max-size-bytes', 0)
+		roi_queue.set_property('max-size-time', 0)
+		roi_queue.set_property('leaky', 2)
+		crop = Gst.ElementFactory.make('videocrop', prefix + 'crop')
+		self.__set_crop__(crop, roi)
+		# NOTE: Output size is fixed so that moving and zooming the crop only
+		# renegotiates the scaler and never the encoder.
+		scaler = Gst.ElementFactory.make('videoscale', prefix + 'scaler')
+		scaler_caps = Gst.Caps.new_empty_simple('video/x-raw')
+		scaler_caps.set_value('width', roi['output_width'])
+		scaler_caps.set_value('height', roi['output_height'])
+		scaler_capsfilter = Gst.ElementFactory.make(
+			'capsfilter', prefix + 'scaler-capsfilter')
+		scaler_capsfilter.set_property('caps', scaler_caps)
+		converter = Gst.ElementFactory.make(
+			'videoconvert', prefix + 'converter')
+		factory_name = self.__encoder_selector__.select(
+			roi['output_width'], roi['output_height'], self.__framerate__)
+		encoder = self.__encoder_selector__.make(
+			factory_name, prefix + 'encoder', roi['bitrate'],
+			self.__framerate__, self.__extra_controls__.format(
+				self.__bitrate_mode__, roi['bitrate'], self.__framerate__))
+		encoder_caps = Gst.Caps.new_empty_simple('video/x-h264')
+		encoder_caps.set_value('profile', 'baseline')
+		if factory_name == 'v4l2h264enc':
+			encoder_caps.set_value('level', '4')
+		encoder_capsfilter = Gst.ElementFactory.make(
+			'capsfilter', prefix + 'encoder-capsfilter')
+		encoder_capsfilter.set_property('caps', encoder_caps)
+		parser = Gst.ElementFactory.make('h264parse', prefix + 'parser')
+		parser.set_property('config-interval', -1)
+		payloader = Gst.ElementFactory.make('rtph264pay', prefix + 'payloader')
+		payloader.set_property('config-interval', -1)
+		sink = Gst.ElementFactory.make('udpsink', prefix + 'sink')
+		sink.set_property('host', '127.0.0.1')
+		sink.set_property('port', self.__get_roi_port__(roi_name))
+		sink.set_property('sync', False)
+		elements = (
+			roi_queue, crop, scaler, scaler_capsfilter, converter, encoder,
+			encoder_capsfilter, parser, payloader, sink)
+		for element in elements:
+			self.__pipeline__.add(element)
+		self.__raw_tee__.link(roi_queue)
+		for upstream, downstream in zip(elements, elements[1:]):
+			upstream.link(downstream)
+		self.__roi_crops__[roi_name] = crop
+
+
+	def __on_first_packet__(self, pad, info):
+
+		"""
+		Mark the first RTP packet sent on the startup timeline
+
+		Args:
+			pad (GstPad): sink pad
+			info (GstPadProbeInfo): probe info
+
+		Returns:
+			GstPadProbeReturn: REMOVE to execute only once
+		"""
+
+		TIMELINE.mark("first RTP packet")
+		return Gst.PadProbeReturn.REMOVE
+
+
+	def __set_io_mode__(self, element, property, mode):
+
+		"""
+		Set io mode of the element if it is supported and did not fail before
+
+		Args:
+			element (GstElement): element to configure
+			property (str): name of the io mode property
+			mode (str): io mode nick
+
+		Returns:
+			bool: True if io mode was set, False otherwise
+		"""
+
+		key = element.get_name() + '.' + property
+		if key in self.__zero_copy_fallback__:
+			return False
+		if element.find_property(property) is None:
+			return False
+		Gst.util_set_object_arg(element, property, mode)
+		logging.debug("Set " + key + " to " + mode)
+		return True
+
+
+	def __exports_dmabuf__(self):
+
+		"""
+		Check if the source can export raw frames as dmabuf
+
+		Returns:
+			bool: True for V4L2 based sources, False otherwise
+		"""
+
+		# NOTE: Neither rpicamsrc nor arducamsrc expose io modes and their
+		# frames are never dmabuf, so probing them would only cost a restart.
+		return self.__source__.find_property('io-mode') is not None
+
+
+	def __load_zero_copy_fallback__(self):
+
+		"""
+		Load io modes that failed before on this hardware
+
+		Returns:
+			set: keys of the io modes in form element.property
+		"""
+
+		try:
+			with open(ZERO_COPY_CACHE, 'r') as cache:
+				cache = json.load(cache)
+			if cache['key'] == camera_probe_key():
+				return set(cache['fallback'])
+		except (OSError, ValueError, KeyError, TypeError):
+			pass
+		return set()
+
+
+	def __add_zero_copy_fallback__(self, key):
+
+		"""
+		Remember io mode that failed, so that it is not tried again on the
+		next start
+
+		Args:
+			key (str): key of the io mode in form element.property
+		"""
+
+		self.__zero_copy_fallback__.add(key)
+		self.__zero_copy_cache__.write(json.dumps({
+			'key': camera_probe_key(),
+			'fallback': sorted(self.__zero_copy_fallback__)}))
+		self.__zero_copy_cache__.flush()
+
+
+	def __set_zero_copy__(self):
+
+		"""
+		Configure elements to exchange dmabuf instead of copying raw frames
+		"""
+
+		# NOTE: The encoder imports dmabuf on its input queue and falls back
+		# to the default mode if frames turn out not to be dmabuf.
+		self.__set_io_mode__(self.__source__, 'io-mode', 'dmabuf')
+		self.__set_io_mode__(
+			self.__encoder__, 'output-io-mode', 'dmabuf-import')
+		self.__set_io_mode__(self.__encoder__, 'capture-io-mode', 'mmap')
+
+
+	def __on_zero_copy__(self, pad, info, link):
+
+		"""
+		Check if the first raw frame on the link was passed as dmabuf
+
+		Args:
+			pad (GstPad): encoder sink pad
+			info (GstPadProbeInfo): probe info
+			link (str): name of the link
+
+		Returns:
+			GstPadProbeReturn: REMOVE once the link has been checked, DROP while
+				waiting for fallback
+		"""
+
+		if link in self.__zero_copy_links__:
+			# frames are dropped until the pipeline is rebuilt
+			return Gst.PadProbeReturn.DROP
+		buffer = info.get_buffer()
+		zero_copy = buffer.n_memory() > 0
+		for i in range(buffer.n_memory()):
+			if not GstAllocators.is_dmabuf_memory(buffer.peek_memory(i)):
+				zero_copy = False
+		self.__zero_copy_links__[link] = zero_copy
+		if zero_copy:
+			logging.info("Zero-copy on " + link + " link")
+			return Gst.PadProbeReturn.REMOVE
+		logging.warning("Copying on " + link + " link")
+		encoder = self.__encoder__.get_name()
+		if (
+			self.__encoder__.find_property('output-io-mode') is None or
+			encoder + '.output-io-mode' in self.__zero_copy_fallback__
+		):
+			return Gst.PadProbeReturn.REMOVE
+		# encoder cannot import the frames so fall back to its default mode
+		self.__add_zero_copy_fallback__(encoder + '.output-io-mode')
+		threading.Thread(target=self.restart).start()
+		return Gst.PadProbeReturn.DROP
+
+
+	def get_zero_copy(self):
+
+		"""
+		Return which raw links pass frames without copying
+
+		Returns:
+			json: zero-copy state per link and element io modes that fell back
+		"""
+
+		return json.dumps({
+			'enabled': self.__zero_copy__,
+			'links': self.__zero_copy_links__,
+			'fallback': sorted(self.__zero_copy_fallback__)}, sort_keys=True)
+
+
+	def __needs_raw__(self):
+
+		"""
+		Check if any branch consumes raw frames
+
+		Returns:
+			bool: True if pipeline shall provide raw frames, False if H.264 can
+				be taken directly from the camera
+		"""
+
+		if self.__model__ == 'ov9281' or self.__model__ == 'v4l2':
+			return True
+		if self.__timelapse__ > 0 or self.__rois__:
+			return True
+		return self.__format__ and (self.__record__ or self.__raw_pending__)
+
+
+	def __switch_topology__(self):
+
+		"""
+		Rebuild pipeline if raw frames are no longer needed
+		"""
+
+		if self.__raw__ and not self.__needs_raw__():
+			logging.info("Switching to camera encoder")
+			self.restart()
+
+
+	def start(self):
+
+		"""
+		Start Camera Server
+		"""
+
+		span = 'CameraServer.start'
+		TRACER.begin(span)
+		logging.info(name(self) + " started")
+		self.set_logging_level(self.__logging_level__)
+		self.__start_bus__()
+		self.__pipeline__.set_state(Gst.State.PLAYING)
+		TIMELINE.mark("pipeline playing")
+		self.set_stats(self.__stats__)
+		if self.__timelapse_sink__ is not None:
+			self.__timelapse_timer_id__ = GLib.timeout_add_seconds(
+				self.__timelapse__, self.__on_timelapse__)
+		# if streaming is configured
+		if self.__rtsp__:
+			self.__rtsp__ = False
+			# start streaming during startup
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.set_rtsp(True, True)
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.__restart_lock__.release()
+			TRACER.event(span, "self.__restart_lock__.release()")
+		# if recording is configured
+		if self.__record__:
+			self.__record__ = False
+			# start recording during startup
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.set_record(True, True)
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.__restart_lock__.release()
+			TRACER.event(span, "self.__restart_lock__.release()")
+		TRACER.end(span)
+
+
+	def stop(self, persist=True):
+
+		"""
+		Stop Camera Server
+
+		Args:
+			persist (bool): False to tear down without persisting parameters,
+				e.g. when the pipeline is rebuilt
+		"""
+
+		span = 'CameraServer.stop'
+		TRACER.begin(span)
+		if not self.__record__ and self.__stats__ == 0x0000040C:
+			self.__stats__ = 0x000000000
+		if persist:
+			if self.__persistent__:
+				self.store()
+				self.__config__.flush()
+				if self.__broker__ is not None:
+					self.__broker__.save_hwclock()
+			else:
+				parameters = None
+				try:
+					with open('camera.json', 'r') as config:
+						parameters = json.load(config)
+				except:
+					pass
+				if parameters is not None:
+					parameters['persistent'] = self.__persistent__
+					self.__config__.write(json.dumps(parameters))
+					self.__config__.flush()
+		if self.__stats_id__ != 0:
+			#logging.debug(
+			#	function_name + 
+			#	": self.__stats_lock__.acquire(blocking=True)")
+			#self.__stats_lock__.acquire(blocking=True)
+			GLib.source_remove(self.__stats_id__)
+			self.__stats_id__ = 0
+			#self.__stats_lock__.release()
+			#logging.debug(function_name + ": self.__restart_lock__.release()")
+		# if still streaming during shutdown
+		if self.__rtsp__:
+			# stop streaming during shutdown
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.set_rtsp(False, True)
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.__restart_lock__.release()
+			TRACER.event(span, "self.__restart_lock__.release()")
+		# if still recording during shutdown
+		if self.__record__:
+			# stop recording during shutdown
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.set_record(False, True)
+			TRACER.event(span, "__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.__restart_lock__.release()
+			TRACER.event(span, "__restart_lock__.release()")
+		if self.__timelapse_timer_id__ != 0:
+			GLib.source_remove(self.__timelapse_timer_id__)
+			self.__timelapse_timer_id__ = 0
+		self.__finalize_timelapse__()
+		# NOTE(marcin.sielski): Make sure pipeline elements are set to 
+		# Gst.State.NULL so that the object can be safely disposed.
+		self.__pipeline__.set_state(Gst.State.NULL)
+		self.__stop_bus__()
+		self.__lifecycle__.teardown(self.__pipeline__)
+		logging.info(name(self) + " stopped")
+		TRACER.end(span)
+
+
+	def __start_bus__(self):
+
+		"""
+		Start handling messages of the pipeline on the Bus Thread
+		"""
+
+		self.__bus_running__ = True
+		self.__bus_thread__ = threading.Thread(
+			name='Bus Thread', target=self.__on_bus__, args=(self.__bus__,))
+		self.__bus_thread__.daemon = True
+		self.__bus_thread__.start()
+
+
+	def __stop_bus__(self):
+
+		"""
+		Stop handling messages of the pipeline
+		"""
+
+		self.__bus_running__ = False
+		if (
+			self.__bus_thread__ is not None and
+			self.__bus_thread__ is not threading.current_thread()
+		):
+			self.__bus_thread__.join()
+		self.__bus_thread__ = None
 
-			if self.__model__ == 'imx219' or self.__model__ == 'imx477':
-				self.__width__ = 800
-				self.__height__ = 608
-			if self.__model__ == 'ov9281':
-				self.__width__ = 1280
-				self.__height__ = 800				
-			self.__framerate__ = 30
-			self.__bitrate_mode__ = 0
-			self.__bitrate__ = 3000000
-			self.__sensor_mode__ = 0
 
-			# Effects
+	def __on_bus__(self, bus):
 
-			self.__brightness__ = 50
-			self.__contrast__ = 0
-			self.__saturation__ = 0
-			self.__sharpness__ = 0
-			self.__drc__ = 0
-			self.__image_effect__ = 0
-			self.__awb_mode__ = 1
-			self.__awb_gain_blue__ = 0
-			self.__awb_gain_red__ = 0
+		"""
+		Bus Thread entry method. Pops messages of interest from the bus of the
+		pipeline until stopped.
 
-			# Settings
+		Args:
+			bus (Bus): bus of the pipeline
+		"""
 
-			self.__exposure_mode__ = 1
-			self.__metering_mode__ = 0
-			self.__exposure_compensation__ = 0
-			self.__iso__ = 0
-			self.__shutter_speed__ = 0
-			# TODO(marcin.sielski): Change it to True
-			self.__video_stabilisation__ = False
-			self.__gain__ = 1
-			self.__awb__ = 4
+		while self.__bus_running__:
+			message = bus.timed_pop_filtered(
+				self.BUS_TIMEOUT, self.BUS_MESSAGES)
+			if message is None:
+				continue
+			if (
+				message.type == Gst.MessageType.STATE_CHANGED and
+				message.src.get_name() not in self.STATE_SOURCES
+			):
+				continue
+			self.__metrics__.inc(Metrics.BUS_MESSAGES)
+			try:
+				self.__on_message__(bus, message)
+			except Exception as e:
+				logging.error(
+					"Unable to handle " + str(message.type) + ": " + repr(e))
 
-			# Orientation
 
-			self.__rotation__ = 0
-			self.__hflip__ = False
-			self.__vflip__ = False
-			self.__video_direction__ = 0
+	def __on_error_lock_release__(self):
 
-			# Controls
+		"""
+		Release self.__error_lock__
 
-			self.__logging_level__ = 0
-			self.__stats__ = 0x00000000
-			self.__rtsp__ = False
-			self.__record__ = False
-			self.__format__ = False
-			self.__max_files__ = 0
-			self.__max_size_bytes__ = 0
-			self.__max_size_time__ = 0
-			self.__fragment_id__ = 0
-			self.__continuation__ = False
-			self.__persistent__ = False
+		Returns:
+			bool: False to indicate execute once
+		"""
 
+		span = 'CameraServer.__on_error_lock_release__'
+		TRACER.begin(span)
+		if self.__error_lock__.locked():
+			self.__error_lock__.release()
+			TRACER.event(span, "__error_lock.release()")
+		TRACER.end(span, "return False")
+		return False
 
-		self.init()
 
+	def __branch_of__(self, element):
 
-	def set_time(self, time):
-		
 		"""
-		Sets system time to specified time
-		
+		Return name of the branch the element belongs to
+
 		Args:
-			time (int): time to set
+			element (GstElement): element
+
+		Returns:
+			str: 'file', 'rtsp', 'source' or 'core'
 		"""
-		
-		os.system('sudo timedatectl set-time @' + str(time))
-		os.system('sudo fake-hwclock')
-		os.sync()
 
+		branches = (
+			('file', (
+				self.__file_queue__, self.__file_rate__,
+				self.__file_converter__, self.__file_encoder__,
+				self.__file_sink__)),
+			('rtsp', (self.__rtsp_queue__, self.__rtsp_sink__)),
+			('source', (self.__source__,)))
+		for branch, elements in branches:
+			for candidate in elements:
+				if candidate is None:
+					continue
+				if element == candidate or element.has_as_ancestor(candidate):
+					return branch
+		return 'core'
 
-	def send_keyframe(self):
+
+	def __recover__(self, branch, element, error_class, minimum):
 
 		"""
-		Forces to send key frame
+		Start recovery from an error. Must be called with self.__error_lock__
+		acquired.
+
+		Args:
+			branch (str): branch that failed
+			element (GstElement): element that reported the error
+			error_class (str): class of the error
+			minimum (int): minimum recovery level
 		"""
 
-		srcpad = self.__encoder__.get_static_pad( "src")
-		structure = Gst.Structure.new_empty("GstForceKeyUnit")
-		structure.set_value('all-headers', True)
-		srcpad.send_event(
-			Gst.Event.new_custom(Gst.EventType.CUSTOM_UPSTREAM,
-			structure))
+		if branch == 'source':
+			minimum = max(minimum, RecoveryEngine.SOURCE)
+		level = self.__recovery__.fail(branch + ':' + error_class, minimum)
+		logging.warning(
+			"Recovering " + branch + " branch from '" + error_class + 
+			"' by " + RecoveryEngine.LEVELS[level])
+		# NOTE: Recovery waits for the pipeline, so it cannot run on the
+		# streaming thread nor on the main loop.
+		threading.Thread(
+			name='Recovery Thread', target=self.__on_recover__,
+			args=(level, branch, element)).start()
 
 
+	def __on_recover__(self, level, branch, element):
 
-	def get_parameters(self):
+		"""
+		Recover from an error at the specified level
+
+		Args:
+			level (int): recovery level
+			branch (str): branch that failed
+			element (GstElement): element that reported the error
+		"""
+
+		span = 'CameraServer.__on_recover__'
+		TRACER.begin(span, "level=%s, branch=%s", level, branch)
+		if level == RecoveryEngine.EXIT:
+			logging.critical("Unable to recover, exiting")
+			self.__config__.flush()
+			logging.shutdown()
+			os._exit(1)
+		delay = 0
+		if level == RecoveryEngine.FLUSH:
+			if branch == 'file':
+				self.__relink_record__()
+			elif branch == 'rtsp':
+				self.__relink_rtsp__()
+			else:
+				while (
+					element is not None and 
+					element.get_parent() != self.__pipeline__
+				):
+					element = element.get_parent()
+				if element is not None:
+					self.__relink_element__(element)
+				self.send_keyframe()
+			# if the error stopped streaming thread of the source restart it
+			if not self.__wait_for_data__(
+				self.__sink__.get_static_pad('sink'), 2):
+				self.__reset_element__(self.__source__)
+				delay = round((self.__camera_timeout__ + 500) / 1000)
+		elif level == RecoveryEngine.SOURCE:
+			self.__reset_element__(self.__source__)
+			delay = round((self.__camera_timeout__ + 500) / 1000)
+		else:
+			# restarting source did not help
+			self.__rebuild__(branch == 'source')
+			delay = round((self.__camera_timeout__ + 500) / 1000)
+		self.__sink__.get_static_pad('sink').add_probe(
+			Gst.PadProbeType.BUFFER, self.__on_recovered__)
+		self.__metrics__.touch()
+		GLib.timeout_add_seconds(delay, self.__on_error_lock_release__)
+		TRACER.end(span)
+
+
+	def __on_recovered__(self, pad, info):
 
 		"""
-		Return Camera Server parameters set
+		Mark recovery as complete once data flows again
+
+		Args:
+			pad (GstPad): sink pad
+			info (GstPadProbeInfo): probe info
 
 		Returns:
-			json: Camera Server parameters set
+			GstPadProbeReturn: REMOVE to execute only once
 		"""
 
-		self.send_keyframe()
-		return json.dumps(
-			{
-				'model': self.__model__, 
+		self.__recovery__.recovered()
+		return Gst.PadProbeReturn.REMOVE
 
-				# Quality
 
-				'width': self.__width__, 
-				'height': self.__height__, 
-				'framerate': self.__framerate__, 
-				'bitrate_mode': self.__bitrate_mode__,
-				'bitrate': self.__bitrate__,
-				'sensor_mode': self.__sensor_mode__,
+	def __reset_element__(self, element):
 
-				# Effects
+		"""
+		Reset element by bringing it down and back to the state of the pipeline
 
-				'brightness': self.__brightness__,
-				'contrast': self.__contrast__,
-				'saturation': self.__saturation__,
-				'sharpness': self.__sharpness__,
-				'drc': self.__drc__,
-				'image_effect': self.__image_effect__, 
-				'awb_mode': self.__awb_mode__,
-				'awb_gain_blue': self.__awb_gain_blue__,
-				'awb_gain_red': self.__awb_gain_red__, 
+		Args:
+			element (GstElement): element to reset
+		"""
 
-				# Settings
+		logging.info("Resetting " + element.get_name())
+		element.set_state(Gst.State.NULL)
+		element.sync_state_with_parent()
 
-				'exposure_mode': self.__exposure_mode__,
-				'metering_mode': self.__metering_mode__,
-				'exposure_compensation': self.__exposure_compensation__,
-				'iso': self.__iso__,
-				'shutter_speed': self.__shutter_speed__,
-				'video_stabilisation': int(self.__video_stabilisation__),
-				'gain': self.__gain__,
-				'awb': self.__awb__,
 
-				# Orientation
+	def __on_data__(self, pad, info, event):
 
-				'rotation': self.__rotation__, 
-				'hflip': int(self.__hflip__),
-				'vflip': int(self.__vflip__),
-				'video_direction': self.__video_direction__,
+		"""
+		Signal that data reached the pad
 
-				# Controls
+		Args:
+			pad (GstPad): pad
+			info (GstPadProbeInfo): probe info
+			event (Event): event to set
 
-				'logging_level': int(self.__logging_level__),
-				'stats': '{0:#0{1}x}'.format(self.__stats__,10),
-				'rtsp': int(self.__rtsp__),
-				'record': int(self.__record__),
-				'format': int(self.__format__),
-				'max_files': self.__max_files__,
-				'max_size_bytes': self.__max_size_bytes__,
-				'max_size_time': self.__max_size_time__,
-				'persistent': int(self.__persistent__),
-				'fragment_id': self.__fragment_id__,
-				'continuation': int(self.__continuation__)
-			},
+		Returns:
+			GstPadProbeReturn: REMOVE to execute only once
+		"""
 
-			sort_keys=True)
+		event.set()
+		return Gst.PadProbeReturn.REMOVE
 
 
-	def __get_key__(self, e):
-		
+	def __wait_for_data__(self, pad, timeout):
+
 		"""
-		Obtain key
+		Wait for data to reach the pad
+
+		Args:
+			pad (GstPad): pad
+			timeout (float): timeout in seconds
+
+		Returns:
+			bool: True if data reached the pad, False otherwise
 		"""
 
-		return e[0]
+		event = threading.Event()
+		pad.add_probe(Gst.PadProbeType.BUFFER, self.__on_data__, event)
+		return event.wait(timeout)
 
 
-	def get_media(self):
+	def __on_blocked__(self, pad, info, event):
 
 		"""
-		Obtain names of media files from the media folder
+		Signal that the pad is blocked
+
+		Args:
+			pad (GstPad): pad
+			info (GstPadProbeInfo): probe info
+			event (Event): event to set
 
 		Returns:
-			json: list of media files from the media folder
+			GstPadProbeReturn: OK to keep the pad blocked
 		"""
 
-		media = []
-		_, _, free = shutil.disk_usage('/')
-		media.append([str(free // (2**30))])
-		_, _, filenames = next(os.walk('.'))	
-		for filename in filenames:
-			if filename.endswith('.mkv') or filename.endswith('.mp4'):
-				media.append(
-					[filename,  datetime.datetime.fromtimestamp(
-						os.path.getmtime(
-							filename)).strftime("%Y-%m-%d, %H:%M")])
-		media.sort(key=self.__get_key__)
-		return json.dumps(media, sort_keys=True)
+		event.set()
+		return Gst.PadProbeReturn.OK
 
 
-	def init(self):
+	def __relink_element__(self, element):
 
 		"""
-		Initialize streaming pipeline
+		Reset element while data upstream of it is held back and relink it so
+		that caps and other sticky events are sent to it again
+
+		Args:
+			element (GstElement): element to relink
 		"""
 
-		self.__pipeline__ = Gst.Pipeline('camera-server-pipeline')
+		sinkpad = element.get_static_pad('sink')
+		srcpad = None
+		if sinkpad is not None:
+			srcpad = sinkpad.get_peer()
+		if srcpad is None:
+			self.__reset_element__(element)
+			return
+		event = threading.Event()
+		probe_id = srcpad.add_probe(
+			Gst.PadProbeType.BLOCK_DOWNSTREAM, self.__on_blocked__, event)
+		# NOTE: If upstream does not push data it is not blocked and there is
+		# nothing to hold back.
+		event.wait(1)
+		srcpad.unlink(sinkpad)
+		self.__reset_element__(element)
+		srcpad.link(sinkpad)
+		srcpad.remove_probe(probe_id)
 
-		self.__source__ = self.__get_source__()
-		self.__source_caps__ = Gst.Caps.new_empty_simple('video/x-raw')
-		self.__source_caps__.set_value('width', self.__width__)
-		self.__source_caps__.set_value('height', self.__height__)
-		#if self.__shutter_speed__ > 0 and 1000000 / self.__shutter_speed__ < self.__framerate__:
-		#	if 1000000 / self.__shutter_speed__ < 1:
-		#		numerator = 1
-		#		denominator = int(1000000 % self.__shutter_speed__)
-		#	else:
-		#		numerator = int(1000000 / self.__shutter_speed__)
-		#		denominator = 1
-		#else:
-		#numerator = self.__framerate__
-		#denominator = 1
-		#self.__source_caps__.set_value(
-		#	'framerate', Gst.Fraction(numerator, denominator))
-		if self.__model__ == 'imx219' or self.__model__ == 'imx477':
-			self.__source_caps__.set_value('format', 'I420')                        
-		if self.__model__ == 'ov9281':
-			self.__source_caps__.set_value('format', 'GRAY8')		
-		self.__source_caps__.set_value(
-			'framerate', Gst.Fraction(self.__framerate__, 1))
 
-		self.__source_capsfilter__ = Gst.ElementFactory.make(
-			'capsfilter', 'source-capsfilter')
-		self.__source_capsfilter__.set_property('caps', self.__source_caps__)
+	def __detach__(self, elements):
+
+		"""
+		Detach branch from its tee without waiting for data to drain
+
+		Args:
+			elements (list): elements of the branch starting from the one
+				linked to the tee
+		"""
+
+		self.__lifecycle__.release(self.__pipeline__, elements)
+
+
+	def __resume__(self, rtsp, record):
+
+		"""
+		Resume streaming and recording from safe context
+
+		Args:
+			rtsp (bool): True if streaming shall be resumed
+			record (bool): True if recording shall be resumed
+		"""
+
+		span = 'CameraServer.__resume__'
+		TRACER.begin(span, "rtsp=%s, record=%s", rtsp, record)
+		if rtsp:
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.set_rtsp(True, True)
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.__restart_lock__.release()
+			TRACER.event(span, "self.__restart_lock__.release()")
+		if record:
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.set_record(True, True)
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
+			self.__restart_lock__.acquire(blocking=True)
+			self.__restart_lock__.release()
+			TRACER.event(span, "self.__restart_lock__.release()")
+		TRACER.end(span)
+
+
+	def __relink_rtsp__(self):
+
+		"""
+		Replace RTSP branch keeping the rest of the pipeline running
+		"""
+
+		if self.__rtsp_queue__ is not None:
+			self.__detach__([self.__rtsp_queue__, self.__rtsp_sink__])
+			self.__rtsp_queue__ = None
+			self.__rtsp_sink__ = None
+		rtsp = self.__rtsp__
+		self.__rtsp__ = False
+		self.__resume__(rtsp, False)
+
+
+	def __relink_record__(self):
+
+		"""
+		Replace recording branch keeping the rest of the pipeline running. The
+		fragment being written when the error occurred is not finalized.
+		"""
+
+		if self.__file_queue__ is not None:
+			self.__detach__([
+				self.__file_queue__, self.__file_rate__,
+				self.__file_converter__, self.__file_encoder__,
+				self.__file_sink__])
+			self.__file_queue__ = None
+			self.__file_rate__ = None
+			self.__file_converter__ = None
+			self.__file_encoder__ = None
+			self.__file_sink__ = None
+		record = self.__record__
+		self.__record__ = False
+		self.__resume__(False, record)
+
+
+	def __rebuild__(self, reset_image_effect=False):
+
+		"""
+		Rebuild pipeline without draining it and restore streaming and
+		recording
+
+		Args:
+			reset_image_effect (bool): True to reset image effect suspected to
+				cause the error of the source
+		"""
+
+		restart_start = time.monotonic()
+		rtsp = self.__rtsp__
+		record = self.__record__
+		# NOTE: Branches are not stopped gracefully since the pipeline is
+		# broken. Parameters are not persisted as the state is temporary.
+		self.__rtsp__ = False
+		self.__record__ = False
+		if reset_image_effect and self.__image_effect__ != 0:
+			logging.warning(
+				"Resetting image effect " + str(self.__image_effect__) +
+				" as it may be the cause of the error")
+			self.__image_effect__ = 0
+		self.__raw_pending__ = record and self.__format__
+		self.stop(False)
+		# elements of the broken pipeline are not reused
+		self.__lifecycle__.clear()
+		self.init()
+		self.start()
+		self.__raw_pending__ = False
+		self.__resume__(rtsp, record)
+		self.__metrics__.observe_restart(time.monotonic() - restart_start)
 
-		if self.__model__ == 'ov9281':
-			self.__overlay__ = Gst.ElementFactory.make(
-				'textoverlay', 'text-overlay')
-			self.__overlay__.set_property('shaded-background', True)
-			self.__overlay__.set_property('valignment','top')
-			self.__overlay__.set_property('font-desc', 'Arial, 12')
 
-		self.__raw_tee__ = Gst.ElementFactory.make('tee', 'raw-tee')
+	def get_branches(self):
 
-		if self.__model__ == 'ov9281':
-			self.__converter__ = Gst.ElementFactory.make(
-				'videoconvert', 'converter')
-			self.__converter_caps__ = Gst.Caps.new_empty_simple('video/x-raw')
-			self.__converter_caps__.set_value('width', self.__width__)
-			self.__converter_caps__.set_value('height', self.__height__)
-			self.__converter_caps__.set_value(
-				'framerate', Gst.Fraction(self.__framerate__, 1))
-			self.__converter_caps__.set_value('format', 'RGB')
-			self.__converter_capsfilter__ = Gst.ElementFactory.make(
-			'capsfilter', 'converter-capsfilter')
-			self.__converter_capsfilter__.set_property(
-				'caps', self.__converter_caps__)
-				
-		#self.__source_queue__ = Gst.ElementFactory.make(
-		#	'queue', 'source-gueue')
-		#self.__video_rate__ = Gst.ElementFactory.make(
-		#	'videorate', 'video-rate')
-		#self.__video_rate__.set_property('average-period', 9223372036854775807)
-		#self.__video_rate__.set_property('rate', 0.9)
-		#if self.__shutter_speed__ < 100000:
-		#	self.__video_rate__.set_property('max-duplication-time', 10000000)
-		#self.__video_rate_caps__ = Gst.Caps.new_empty_simple('video/x-raw')
-		#self.__video_rate_caps__.set_value(
-		#	'framerate', Gst.Fraction(self.__framerate__, 1))
-		#self.__video_rate_capsfilter__ = Gst.ElementFactory.make(
-		#	'capsfilter', 'video-rate-capsfilter')
-		#self.__video_rate_capsfilter__.set_property(
-		#	'caps', self.__video_rate_caps__)
-		#self.__video_rate_queue__ = Gst.ElementFactory.make(
-		#	'queue', 'video-rate-gueue')
-		
-		self.__encoder__ = Gst.ElementFactory.make('v4l2h264enc', 'encoder')
-		self.__encoder__.set_property(
-			'extra-controls', Gst.Structure.new_from_string(
-				self.__extra_controls__.format(self.__bitrate_mode__,
-				self.__bitrate__, self.__framerate__)))
+		"""
+		Return branches that are expected to deliver frames
 
-		self.__encoder_caps__ = Gst.Caps.new_empty_simple('video/x-h264')
-		self.__encoder_caps__.set_value('profile', 'baseline')
-		self.__encoder_caps__.set_value('level', '4')
+		Returns:
+			list: indices of the branches
+		"""
 
-		self.__encoder_capsfilter__ = Gst.ElementFactory.make(
-			'capsfilter', 'encoder-capsfilter')
-		self.__encoder_capsfilter__.set_property('caps', self.__encoder_caps__)
+		branches = [Metrics.SOURCE, Metrics.ENCODER, Metrics.UDP]
+		if self.__rtsp_queue__ is not None:
+			branches.append(Metrics.RTSP)
+		if self.__file_queue__ is not None:
+			branches.append(Metrics.FILE)
+		return branches
 
-		self.__parser__ = Gst.ElementFactory.make('h264parse', 'parser')
-		GstBase.BaseParse.set_infer_ts(self.__parser__, True)	
-		GstBase.BaseParse.set_pts_interpolation(self.__parser__, True)
-		self.__parser__.set_property('config-interval', -1)
 
-		self.__h264_tee__ = Gst.ElementFactory.make('tee', 'h264-tee')
+	def get_counters(self):
 
-		self.__payloader__ = Gst.ElementFactory.make('rtph264pay', 'payloader')
-		self.__payloader__.set_property('config-interval', -1)
+		"""
+		Return elements whose native counters measure the active branches
 
-		self.__rtsp_tee__ = Gst.ElementFactory.make('tee', 'rtsp-tee')
+		Returns:
+			dict: elements by index of the branch
+		"""
 
-		self.__sink_queue__ = Gst.ElementFactory.make('queue', 'sink-queue')
-		self.__sink_queue__.set_property(
-			'max-size-buffers', 0)
-		self.__sink_queue__.set_property(
-			'max-size-bytes', 0)
-		self.__sink_queue__.set_property('max-size-time', 0)
+		counters = {
+			Metrics.SOURCE: self.__source_counter__,
+			Metrics.ENCODER: self.__encoder_counter__,
+			Metrics.UDP: self.__sink__}
+		if self.__rtsp_queue__ is not None and self.__rtsp_sink__ is not None:
+			counters[Metrics.RTSP] = self.__rtsp_sink__
+		if self.__file_queue__ is not None and self.__file_sink__ is not None:
+			counters[Metrics.FILE] = self.__file_sink__.get_property('sink')
+		return counters
 
-		self.__sink__ = Gst.ElementFactory.make('udpsink', 'sink')
-		self.__sink__.set_property('host', '127.0.0.1')
-		self.__sink__.set_property('port', 31415)
-		self.__sink__.set_property('sync', False)
 
-		self.__pipeline__.add(self.__source__)
-		self.__pipeline__.add(self.__source_capsfilter__)
-		#self.__pipeline__.add(self.__source_queue__)
-		#self.__pipeline__.add(self.__video_rate__)
-		#self.__pipeline__.add(self.__video_rate_capsfilter__)
-		#self.__pipeline__.add(self.__video_rate_queue__)
-		
-		
-		if self.__model__ == 'ov9281':
-			self.__pipeline__.add(self.__overlay__)
-		self.__pipeline__.add(self.__raw_tee__)
-		if self.__model__ == 'ov9281':
-			self.__pipeline__.add(self.__converter__)
-			self.__pipeline__.add(self.__converter_capsfilter__)
-		self.__pipeline__.add(self.__encoder__)
-		self.__pipeline__.add(self.__encoder_capsfilter__)
-		self.__pipeline__.add(self.__parser__)
-		self.__pipeline__.add(self.__h264_tee__)
-		self.__pipeline__.add(self.__payloader__)
-		self.__pipeline__.add(self.__rtsp_tee__)
-		self.__pipeline__.add(self.__sink_queue__)
-		self.__pipeline__.add(self.__sink__)
+	def get_health(self, deadline):
 
-		self.__source__.link(self.__source_capsfilter__)
-		#self.__source_capsfilter__.link(self.__source_queue__)
-		#self.__source_capsfilter__.link(self.__video_rate__)
-		#self.__video_rate__.link(self.__video_rate_capsfilter__)
-		#self.__video_rate_capsfilter__.link(self.__video_rate_queue__)
-		
-		if self.__model__ == 'imx219' or self.__model__ == 'imx477':
-			#self.__video_rate_capsfilter__.link(self.__raw_tee__)
-			self.__source_capsfilter__.link(self.__raw_tee__)
-			self.__raw_tee__.link(self.__encoder__) 
-		if self.__model__ == 'ov9281':
-			self.__source_capsfilter__.link(self.__overlay__)
-			self.__overlay__.link(self.__raw_tee__)
-			self.__raw_tee__.link(self.__converter__)  
-			self.__converter__.link(self.__converter_capsfilter__)  
-			self.__converter_capsfilter__.link(self.__encoder__)
-		self.__encoder__.link(self.__encoder_capsfilter__)
-		self.__encoder_capsfilter__.link(self.__parser__)
-		self.__parser__.link(self.__h264_tee__)
-		self.__h264_tee__.link(self.__payloader__)
-		self.__payloader__.link(self.__rtsp_tee__)
-		self.__rtsp_tee__.link(self.__sink_queue__)
-		self.__sink_queue__.link(self.__sink__)
-		
-		self.bus = self.__pipeline__.get_bus()
-		self.bus.set_sync_handler(self.__on_message__)
+		"""
+		Return health of the pipeline
 
-		self.__file_queue__ = None
-		self.__file_rate__ = None
-		self.__file_converter__ = None
-		self.__file_encoder__ = None
-		self.__file_sink__ = None
-		self.__raw_framerate__ = 0
+		Args:
+			deadline (float): maximum time without frames in seconds
 
+		Returns:
+			dict: status and last frame age per branch
+		"""
+
+		branches = {}
+		stalled = []
+		for branch in self.get_branches():
+			age = self.__metrics__.get_age(branch)
+			branches[Metrics.BRANCHES[branch]] = round(age, 3)
+			if deadline > 0 and age > deadline:
+				stalled.append(branch)
+		pending = self.__recovery__.get_pending()
+		if pending is not None:
+			status = 'recovering'
+		elif stalled:
+			status = 'stalled'
+		else:
+			status = 'ok'
+		return {
+			'status': status, 'deadline': deadline, 'recovering': pending,
+			'branches': branches, 'stalled': stalled}
 
-	def start(self):
+
+	def on_stall(self, branch, deadline):
 
 		"""
-		Start Camera Server
+		Recover branch that did not deliver frames before the deadline
+
+		Args:
+			branch (int): index of the branch
+			deadline (float): maximum time without frames in seconds
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
-		logging.info(name(self) + " started")
-		self.set_logging_level(self.__logging_level__)
-		self.__pipeline__.set_state(Gst.State.PLAYING)
-		self.set_stats(self.__stats__)
-		# if streaming is configured
-		if self.__rtsp__:
-			self.__rtsp__ = False
-			# start streaming during startup
-			logging.debug(
-				function_name +
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.set_rtsp(True, True)
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
-		# if recording is configured
-		if self.__record__:
-			self.__record__ = False
-			# start recording during startup
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.set_record(True, True)
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
+		# if request that rebuilds pipeline is in progress give it more time
+		if (
+			self.__main_lock__.locked() and 
+			self.__metrics__.get_age(branch) < 3 * deadline
+		):
+			return
+		# if recovery is already pending
+		if not self.__error_lock__.acquire(blocking=False):
+			return
+		logging.error(
+			"No frames on " + Metrics.BRANCHES[branch] + " branch for " + 
+			str(round(self.__metrics__.get_age(branch), 1)) + " s")
+		TRACER.dump()
+		# release any existing locks to resume execution
+		if self.__main_lock__.locked():
+			self.__main_lock__.release()
+		if self.__restart_lock__.locked():
 			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
-		logging.debug(function_name + ": exit")
+		element = None
+		if branch == Metrics.SOURCE:
+			branch_name = 'source'
+		elif branch == Metrics.RTSP:
+			branch_name = 'rtsp'
+		elif branch == Metrics.FILE:
+			branch_name = 'file'
+		else:
+			branch_name = 'core'
+			if branch == Metrics.ENCODER:
+				element = self.__encoder__
+		self.__recover__(branch_name, element, 'stall', RecoveryEngine.FLUSH)
 
 
-	def stop(self):
+	def get_recovery(self):
 
 		"""
-		Stop Camera Server
+		Return recovery statistics
+
+		Returns:
+			json: mean time to recover per error class
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
-		if not self.__record__ and self.__stats__ == 0x0000040C:
-			self.__stats__ = 0x000000000
-		if self.__persistent__:
-			logging.info("Writing parameters to 'camera.json' file")
-			with open('camera.json', 'w') as config:
-				config.write(self.get_parameters())
-			os.system('sudo fake-hwclock')
-			os.sync()
-		else:
-			parameters = None
-			try:
-				with open('camera.json', 'r') as config:
-					parameters = json.load(config)
-			except:
-				pass
-			if parameters is not None:
-				parameters['persistent'] = self.__persistent__
-				with open('camera.json', 'w') as config:
-					json.dump(parameters, config)
-		if self.__stats_id__ != 0:
-			#logging.debug(
-			#	function_name + 
-			#	": self.__stats_lock__.acquire(blocking=True)")
-			#self.__stats_lock__.acquire(blocking=True)
-			GLib.source_remove(self.__stats_id__)
-			self.__stats_id__ = 0
-			#self.__stats_lock__.release()
-			#logging.debug(function_name + ": self.__restart_lock__.release()")
-		# if still streaming during shutdown
-		if self.__rtsp__:
-			# stop streaming during shutdown
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.set_rtsp(False, True)
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
-		# if still recording during shutdown
-		if self.__record__:
-			# stop recording during shutdown
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.set_record(False, True)
-			logging.debug(
-				function_name + ": __restart_lock__.acquire(blocking=True)")
-			self.__restart_lock__.acquire(blocking=True)
-			self.__restart_lock__.release()
-			logging.debug(function_name + ": __restart_lock__.release()")
-		# NOTE(marcin.sielski): Make sure pipeline elements are set to 
-		# Gst.State.NULL so that the object can be safely disposed.
-		
-#		if self.__source__ is not None:
-#			self.__source__.set_state(Gst.State.NULL)
-#			self.__source__.unlink(self.__source_capsfilter__)
-#			self.__pipeline__.remove(self.__source__)
-#			self.__source__ = None
-#			del self.__source__
-#		if self.__source_capsfilter__ is not None:
-#			self.__source_capsfilter__.set_state(Gst.State.NULL)
-#			self.__source_capsfilter__.unlink(self.__raw_tee__)
-#			self.__pipeline__.remove(self.__source_capsfilter__)
-#			self.__source_capsfilter__ = None
-#			self.__source_caps__ = None
-#			del self.__source_caps__
-#		if self.__raw_tee__ is not None:
-#			self.__raw_tee__.set_state(Gst.State.NULL)
-#			self.__raw_tee__.unlink(self.__converter__)
-#			self.__pipeline__.remove(self.__raw_tee__)
-#			self.__raw_tee__ = None
-#			del self.__raw_tee__
-#		if self.__converter__ is not None:
-#			self.__converter__.set_state(Gst.State.NULL)
-#			self.__converter__.unlink(self.__converter_capsfilter__)
-#			self.__pipeline__.remove(self.__converter__)
-#			self.__converter__ = None
-#			del self.__converter__
-#		if self.__converter_capsfilter__ is not None:
-#			self.__converter_capsfilter__.set_state(Gst.State.NULL)
-#			self.__converter_capsfilter__.unlink(self.__encoder__)
-#			self.__pipeline__.remove(self.__converter_capsfilter__)
-#			self.__converter_capsfilter__ = None
-#			self.__converter_caps__ = None
-#			del self.__converter_caps__
-#		if self.__encoder__ is not None:
-#			self.__encoder__.set_state(Gst.State.NULL)
-#			self.__encoder__.unlink(self.__encoder_capsfilter__)
-#			self.__pipeline__.remove(self.__encoder__)
-#			self.__encoder__ = None
-#			del self.__encoder__
-#		if self.__encoder_capsfilter__ is not None:
-#			self.__encoder_capsfilter__.set_state(Gst.State.NULL)
-#			self.__encoder_capsfilter__.unlink(self.__parser__)
-#			self.__pipeline__.remove(self.__encoder_capsfilter__)
-#			self.__encoder_capsfilter__ = None
-#			self.__encoder_caps__ = None
-#			del self.__encoder_caps__
-#		if self.__parser__ is not None:
-#			self.__parser__.set_state(Gst.State.NULL)
-#			self.__parser__.unlink(self.__h264_tee__)
-#			self.__pipeline__.remove(self.__parser__)
-#			self.__parser__ = None
-#			del self.__parser__
-#		if self.__h264_tee__ is not None:
-#			self.__h264_tee__.set_state(Gst.State.NULL)
-#			self.__h264_tee__.unlink(self.__payloader__)
-#			self.__pipeline__.remove(self.__h264_tee__)
-#			self.__h264_tee__ = None
-#			del self.__h264_tee__
-#		if self.__payloader__ is not None:
-#			self.__payloader__.set_state(Gst.State.NULL)
-#			self.__payloader__.unlink(self.__rtsp_tee__)
-#			self.__pipeline__.remove(self.__payloader__)
-#			self.__payloader__ = None
-#			del self.__payloader__
-#		if self.__rtsp_tee__ is not None:
-#			self.__rtsp_tee__.set_state(Gst.State.NULL)
-#			self.__rtsp_tee__.unlink(self.__sink_queue__)
-#			self.__pipeline__.remove(self.__rtsp_tee__)
-#			self.__rtsp_tee__ = None
-#			del self.__rtsp_tee__
-#		if self.__sink_queue__ is not None:
-#			self.__sink_queue__.set_state(Gst.State.NULL)
-#			self.__sink_queue__.unlink(self.__sink__)
-#			self.__pipeline__.remove(self.__sink_queue__)
-#			self.__sink_queue__ = None
-#			del self.__sink_queue__
-#		if self.__sink__ is not None:
-#			self.__sink__.set_state(Gst.State.NULL)
-#			self.__pipeline__.remove(self.__sink__)
-#			self.__sink__ = None
-#			del self.__sink__
-#
-#		if self.__file_queue__ is not None:
-#			self.__file_queue__.set_state(Gst.State.NULL)
-#			self.__file_queue__ = None
-#		if self.__file_rate__ is not None:
-#			self.__file_rate__.set_state(Gst.State.NULL)
-#			self.__file_rate__ = None
-#		if self.__file_converter__ is not None:
-#			self.__file_converter__.set_state(Gst.State.NULL)
-#			self.__file_converter__ = None
-#		if self.__file_encoder__ is not None:
-#			self.__file_encoder__.set_state(Gst.State.NULL)
-#			self.__file_encoder__ = None
-#		if self.__file_sink__ is not None:
-#			self.__file_sink__.set_state(Gst.State.NULL)
-#			self.__file_sink__ = None
-		self.__pipeline__.set_state(Gst.State.NULL)
-		logging.info(name(self) + " stopped")
-		logging.debug(function_name + ": exit")
+		return json.dumps(self.__recovery__.get_statistics(), sort_keys=True)
 
 
-	def __on_error_lock_release__(self):
+	def get_lifecycle(self):
 
 		"""
-		Release self.__error_lock__
+		Return pipeline lifecycle statistics
 
 		Returns:
-			bool: False to indicate execute once
+			json: elements created and reused and objects leaked
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
-		if self.__error_lock__.locked():
-			self.__error_lock__.release()
-			logging.debug(function_name + ": __error_lock.release()")
-		logging.debug(function_name + ": return False")
-		return False
+		return json.dumps(self.__lifecycle__.get_statistics(), sort_keys=True)
 
 
-	def __on_restart__(self):
-		
+	def get_encoder(self):
+
 		"""
-		Restart Camera Server to try to recover from error
+		Return encoder selection statistics
 
 		Returns:
-			bool: False to indicate execute once
+			json: selected encoders and benchmark results
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
-		# NOTE(marcin.sielski): We are under error condition so try to restart 
-		# only streaming.
-		self.__record__ = False
-		self.__rtsp__ = False
-		self.__image_effect__ = 0
-		self.restart(True)
-		GLib.timeout_add_seconds(
-			round((self.__camera_timeout__ + 500) / 1000), 
-			self.__on_error_lock_release__)
-		logging.debug(function_name + ": return False")
-		return False
+		return json.dumps(
+			self.__encoder_selector__.get_statistics(), sort_keys=True)
 
 
 	def __on_stop__(self):
@@ -1317,24 +5659,29 @@ class CameraServer(Server):
 			bool: False to indicate execute only once
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraServer.__on_stop__'
+		TRACER.begin(span)
 		if self.__file_queue__ is not None:
 			self.__file_queue__.set_state(Gst.State.NULL)
+			self.__lifecycle__.track(self.__file_queue__)
 			self.__file_queue__ = None
 		if self.__file_rate__ is not None:
 			self.__file_rate__.set_state(Gst.State.NULL)
+			self.__lifecycle__.track(self.__file_rate__)
 			self.__file_rate__ = None
 		if self.__file_converter__ is not None:
 			self.__file_converter__.set_state(Gst.State.NULL)
+			self.__lifecycle__.track(self.__file_converter__)
 			self.__file_converter__ = None
 		if self.__file_encoder__ is not None:
 			self.__file_encoder__.set_state(Gst.State.NULL)
+			self.__lifecycle__.track(self.__file_encoder__)
 			self.__file_encoder__ = None
 		if self.__file_sink__ is not None:
 			self.__file_sink__.set_state(Gst.State.NULL)
+			self.__lifecycle__.track(self.__file_sink__)
 			self.__file_sink__ = None
+		self.__file_muxer__ = None
 		self.__on_store__()
 		if (
 			(self.__model__ == 'imx219' or self.__model__ == 'imx477') and 
@@ -1350,16 +5697,18 @@ class CameraServer(Server):
 			if self.__main_lock__.locked():
 				# unblock concurrent requests
 				self.__main_lock__.release()
-				logging.debug(function_name + ": self.__main_lock__.release()")
+				TRACER.event(span, "self.__main_lock__.release()")
+			# go back to camera encoder if raw frames are no longer needed
+			if self.__raw__ and not self.__needs_raw__():
+				threading.Thread(target=self.__switch_topology__).start()
 		# if request was executed in safe context
 		else:
 			# if not unblocked by an error
 			if self.__restart_lock__.locked():
 				# unblock execution
 				self.__restart_lock__.release()
-				logging.debug(
-					function_name + ": self.__restart_lock__.release()")
-		logging.debug(function_name + ": return False")
+				TRACER.event(span, "self.__restart_lock__.release()")
+		TRACER.end(span, "return False")
 		return False
 
 
@@ -1368,53 +5717,69 @@ class CameraServer(Server):
 		"""
 		Handle messages on the bus
 
-		Returns:
-			BusSyncReply: with decision what to do further with the message
+		Args:
+			bus (Bus): bus of the pipeline
+			message (Message): message
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
+		span = 'CameraServer.__on_message__'
 		t = message.type
-		logging.debug(function_name + ": "+str(t))
+		TRACER.event(span, "%s", t)
 		if t == Gst.MessageType.EOS:
-			logging.debug(function_name + ": Gst.MessageType.EOS")
+			TRACER.event(span, "Gst.MessageType.EOS")
 			logging.info("EOS")
-			GLib.timeout_add_seconds(0, self.__on_restart__)
-			return Gst.BusSyncReply.DROP
+			# if recovery is not already pending
+			if self.__error_lock__.acquire(blocking=False):
+				TRACER.event(span, "self.__error_lock__.acquire()")
+				self.__recover__('core', None, 'eos', RecoveryEngine.PIPELINE)
+			return
 		elif t == Gst.MessageType.ERROR:
-			logging.debug(function_name + ": Gst.MessageType.ERROR")
+			TRACER.event(span, "Gst.MessageType.ERROR")
 			error, debug = message.parse_error()
 			logging.error(str(error) + " at " + str(debug))
+			TRACER.dump()
+			# if camera failed detection shall be repeated on the next start
+			if message.src == self.__source__:
+				forget_camera()
+			# if encoder failed to import frames fall back to copying
 			if (
-				str(error) == 
-				"gst-stream-error-quark: Internal data stream error. (1)"
+				self.__zero_copy__ and self.__raw__ and
+				message.src == self.__encoder__
 			):
-				self.__pipeline__.set_state(Gst.State.PLAYING)
-				sinkpad = self.__source__.get_static_pad("src").get_peer()
-				if sinkpad is not None:
-					sinkpad.send_event(Gst.Event.new_eos())
-			else:
-				# if error already is pending
-				if self.__error_lock__.locked():
-					# drop the message 
-					return Gst.BusSyncReply.DROP
-				# notify that server has pending error
-				logging.debug(
-					function_name + 
-					": self.__error_lock__.acquire(blocking=True)")
-				self.__error_lock__.acquire(blocking=True)
-				# release any existing locks to resume execution
-				if self.__main_lock__.locked():
-					self.__main_lock__.release()
-					logging.debug(
-						function_name + ": self.__main_lock__.release()")
-				if self.__restart_lock__.locked():
-					self.__restart_lock__.release()
-					logging.debug(
-						function_name + ": self.__restart_lock__.release()")
+				self.__add_zero_copy_fallback__(
+					self.__encoder__.get_name() + '.output-io-mode')
+			# if encoder is missing or busy select another one on rebuild
+			if (
+				self.__raw__ and message.src == self.__encoder__ and
+				error.domain == 'gst-resource-error-quark'
+			):
+				self.__encoder_selector__.reject(
+					self.__encoder__.get_factory().get_name())
+			# notify that server has pending error unless error already is
+			# pending, e.g. stall reported by the watchdog, as waiting would
+			# block the Bus Thread joined by the recovery
+			if not self.__error_lock__.acquire(blocking=False):
+				# drop the message 
+				return
+			TRACER.event(span, "self.__error_lock__.acquire()")
+			# release any existing locks to resume execution
+			if self.__main_lock__.locked():
+				self.__main_lock__.release()
+				TRACER.event(span, "self.__main_lock__.release()")
+			if self.__restart_lock__.locked():
+				self.__restart_lock__.release()
+				TRACER.event(span, "self.__restart_lock__.release()")
+			self.__recover__(
+				self.__branch_of__(message.src), message.src,
+				error.domain + ':' + str(error.code), RecoveryEngine.FLUSH)
 		elif t == Gst.MessageType.ELEMENT:
-			logging.debug(function_name + ": Gst.MessageType.ELEMENT")
+			TRACER.event(span, "Gst.MessageType.ELEMENT")
 			s = message.get_structure()
+			if (
+				s.has_name('splitmuxsink-fragment-closed') and
+				self.__uploader__ is not None
+			):
+				self.__uploader__.enqueue(s.get_string('location'))
 			if s.has_name("GstBinForwarded"):
 				forward_msg = s.get_value("message")
 				if forward_msg.type == Gst.MessageType.EOS:
@@ -1428,6 +5793,7 @@ class CameraServer(Server):
 						):
 							srcpad.remove_probe(self.probe_id)
 						# destroy pipeline
+						self.__lifecycle__.release_pad(self.__file_queue__)
 						self.__pipeline__.remove(self.__file_queue__)
 						if self.__file_rate__ is not None:
 						 	self.__pipeline__.remove(self.__file_rate__)
@@ -1437,7 +5803,10 @@ class CameraServer(Server):
 						 	self.__pipeline__.remove(self.__file_encoder__)
 						self.__pipeline__.remove(self.__file_sink__)
 						GLib.timeout_add_seconds(0, self.__on_stop__)
-						return Gst.BusSyncReply.DROP
+						return
+					if forward_msg.src.name == 'timelapse-sink':
+						self.__timelapse_eos__.set()
+						return
 			# if s.has_name("GstMultiFileSink"):
 			# 	self.__index__ = self.__file_sink__.get_property('index')
 			# 	logging.debug(
@@ -1484,10 +5853,7 @@ class CameraServer(Server):
 
 		elif t == Gst.MessageType.STATE_CHANGED:
 			# if rtsp-sink or file-sink
-			if (
-				message.src.name == 'rtsp-sink' or 
-				message.src.name == 'file-sink'
-			):
+			if message.src.name in self.STATE_SOURCES:
 				s = message.get_structure()
 				# is PLAYING
 				if (
@@ -1515,20 +5881,33 @@ class CameraServer(Server):
 						if self.__main_lock__.locked():
 							# unblock concurrent requests
 							self.__main_lock__.release()
-							logging.debug(
-								function_name + 
-								": self.__main_lock__.release()")
+							TRACER.event(span, "self.__main_lock__.release()")
 					# and request was executed in safe context
 					else:
 						# if not unblocked by an error
 						if self.__restart_lock__.locked():
 							# unblock execution
 							self.__restart_lock__.release()
-							logging.debug(
-								function_name + 
-								": self.__restart_lock__.release()")
-				
-		return Gst.BusSyncReply.PASS
+							TRACER.event(
+								span, "self.__restart_lock__.release()")
+
+
+	def __get_encoder__(self):
+
+		"""
+		Return H.264 encoder of raw frames selected for the resolution and
+		framerate
+
+		Returns:
+			GstElement: encoder
+		"""
+
+		return self.__encoder_selector__.make(
+			self.__encoder_selector__.select(
+				self.__width__, self.__height__, self.__framerate__),
+			'encoder', self.__bitrate__, self.__framerate__,
+			self.__extra_controls__.format(
+				self.__bitrate_mode__, self.__bitrate__, self.__framerate__))
 
 
 	def __get_source__(self):
@@ -1542,6 +5921,7 @@ class CameraServer(Server):
 
 		if self.__model__ == 'imx219' or self.__model__ == 'imx477':
 			source = Gst.ElementFactory.make('rpicamsrc', 'camera-source')
+			source.set_property('camera-number', self.__camera_number__)
 			source.set_property('preview', 0)
 			source.set_property('annotation-mode', self.__stats__)
 			source.set_property(
@@ -1585,6 +5965,12 @@ class CameraServer(Server):
 			source.set_property('vflip', self.__vflip__)
 			source.set_property('video-direction', self.__video_direction__)
 
+		if self.__model__ == 'v4l2':
+
+			source = Gst.ElementFactory.make('v4l2src', 'camera-source')
+			source.set_property(
+				'device', '/dev/video' + str(self.__camera_number__))
+
 		if self.__model__ == 'ov9281':
 
 			source = Gst.ElementFactory.make('arducamsrc', 'camera-source')
@@ -1650,9 +6036,32 @@ class CameraServer(Server):
 		"""
 
 		self.__bitrate_mode__ = bitrate_mode
+		# if H.264 is taken from the camera the mode takes effect only once
+		# raw frames are encoded
+		if not self.__raw__:
+			logging.warning(
+				"Bitrate mode " + str(bitrate_mode) + " is not supported by " +
+				"the camera encoder, variable bitrate is used")
+			self.store()
+			return
 		self.restart()
 
 
+	def get_bitrate_mode(self):
+
+		"""
+		Return bitrate mode in effect, the camera encoder always uses
+		variable bitrate
+
+		Returns:
+			int: bitrate mode of the video stream
+		"""
+
+		if not self.__raw__:
+			return 0
+		return self.__bitrate_mode__
+
+
 	def set_bitrate(self, bitrate):
 
 		"""
@@ -2281,15 +6690,63 @@ class CameraServer(Server):
 			'video-direction', self.__video_direction__)
 
 
+	def __format_telemetry__(self):
+
+		"""
+		Format the latest telemetry snapshot for the overlay
+
+		Returns:
+			str: formatted telemetry
+		"""
+
+		snapshot = self.__telemetry__.get_snapshot()
+		return (
+			'CPU: ' + str(snapshot.cpu) + '% MEM: ' + str(snapshot.memory) + 
+			'% TMP: ' + str(snapshot.temperature) + 'C DSK: ' + 
+			str(snapshot.disk) + '% THR: ' + hex(snapshot.throttled))
+
+
+	def get_metrics(self):
+
+		"""
+		Return metrics of the Camera Server
+
+		Returns:
+			str: metrics in the Prometheus text format
+		"""
+
+		queues = {}
+		for element in [
+			self.__sink_queue__, self.__rtsp_queue__, self.__file_queue__]:
+			if element is not None and element.get_parent() is not None:
+				queues[element.name] = (
+					element.get_property('current-level-buffers'),
+					element.get_property('current-level-bytes'))
+		return self.__metrics__.render(
+			queues, self.__telemetry__.get_snapshot())
+
+
+	def get_telemetry(self):
+
+		"""
+		Return the latest telemetry snapshot
+
+		Returns:
+			json: the latest telemetry snapshot
+		"""
+
+		return json.dumps(
+			self.__telemetry__.get_snapshot()._asdict(), sort_keys=True)
+
+
 	def __on_stats__(self):
 		
 		"""
 		Callback function executed in the background to collect statistics
 		"""
 		
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraServer.__on_stats__'
+		TRACER.begin(span)
 		#if not self.__stats_lock__.locked():
 		#	logging.debug(
 		#		function_name + 
@@ -2301,46 +6758,23 @@ class CameraServer(Server):
 		#			self.__stats_lock__.release()
 		#			logging.debug(function_name + ": false")
 				return False
-			# TODO: Fix subprocess.check_output during shutdown
 			self.__source__.set_property(
 				'annotation-text', 
-				'CPU: ' + str(psutil.cpu_percent()) + 
-				'% MEM: ' + str(psutil.virtual_memory().percent) + 
-				'% TMP: ' + str(round(CPUTemperature().temperature, 1)) + 
-				'C DSK: ' + str(round(DiskUsage().usage, 1)) + 
-				'% THR: ' + subprocess.check_output(
-					['vcgencmd', 'get_throttled']).decode('utf-8').replace(
-						'throttled=','').strip() + '\n\n' + self.__model__ + 
-						' ')
+				self.__format_telemetry__() + '\n\n' + self.__model__ + ' ')
 		if self.__model__ == 'ov9281':
-			tm = time.localtime()
 			if self.__record__ and self.__stats__ == 0x00000000:
-				self.__overlay__.set_property(
-						'text', str(tm.tm_hour) + ':' +
-						str(tm.tm_min).zfill(2) + ':' +
-						str(tm.tm_sec).zfill(2) + ' ' + str(tm.tm_mon) +
-						'/' + str(tm.tm_mday) + '/' + str(tm.tm_year))
+				self.__overlay__.set_property('text', self.__format_time__())
 			else:
 				shutter_speed = self.__source__.get_property(
 					'shutter-speed')
 				self.__overlay__.set_property(
 					'text',
-					'CPU: ' + str(psutil.cpu_percent()) + 
-					'% MEM: ' + str(psutil.virtual_memory().percent) + 
-					'% TMP: ' + str(round(CPUTemperature().temperature, 1))+ 
-					'C DSK: ' + str(round(DiskUsage().usage, 1)) + 
-					'% THR: ' + subprocess.check_output(
-						['vcgencmd', 'get_throttled']).decode(
-							'utf-8').replace('throttled=','').strip() + 
-							'\n' + self.__model__ + ' ' + str(tm.tm_hour) +
-							':' + str(tm.tm_min).zfill(2) + ':' + 
-							str(tm.tm_sec).zfill(2) + ' ' + str(tm.tm_mon) +
-							'/' + str(tm.tm_mday) + '/' + str(tm.tm_year) +
-							'\n' + 'Shutter (current: ' +
-							str(shutter_speed) + ', range: 30000)'	 
-				)
+					self.__format_telemetry__() + '\n' + self.__model__ + 
+					' ' + self.__format_time__() + '\n' + 
+					'Shutter (current: ' + str(shutter_speed) + 
+					', range: 30000)')
 		#	self.__stats_lock__.release()
-		logging.debug(function_name + ": true")
+		TRACER.event(span, "true")
 		return True
 		
 
@@ -2372,32 +6806,37 @@ class CameraServer(Server):
 			if self.__stats_id__ != 0:
 				GLib.source_remove(self.__stats_id__)
 				self.__stats_id__ = 0
+			self.__stats__ = stats
 			if self.__record__ and stats == 0x00000000:
-				self.__stats__ = stats
-				tm = time.localtime()
-				self.__overlay__.set_property(
-					'text', str(tm.tm_hour) + ':' + str(tm.tm_min).zfill(2) + 
-					':' + str(tm.tm_sec).zfill(2) + ' ' + str(tm.tm_mon) + '/' + 
-					str(tm.tm_mday) + '/' + str(tm.tm_year))
+				self.__overlay__.set_property('text', self.__format_time__())
 				self.__overlay__.set_property('silent', False)
 				self.__stats_id__ = GLib.timeout_add_seconds(
 						1, self.__on_stats__)
+			elif stats == 0x00000000:
+				self.__overlay__.set_property('silent', True)
 			else:
-				self.__stats__ = stats
-				tm = time.localtime()
-				if stats == 0x00000000 or (
-					stats == 0x00000000 and not self.__record__):
-					self.__overlay__.set_property('silent', True)
-				else:
-					self.__overlay__.set_property(
-					'text', 'Copyright (c) 2021 Marcin Sielski\n' +
-					self.__model__ + ' ' + str(tm.tm_hour).zfill(2) + ':' + 
-					str(tm.tm_min).zfill(2) + ':' + str(tm.tm_sec).zfill(2) +
-					' ' + str(tm.tm_mon) + '/' + str(tm.tm_mday) + '/' + 
-					str(tm.tm_year))
-					self.__overlay__.set_property('silent', False)
-					self.__stats_id__ = GLib.timeout_add_seconds(
-						1, self.__on_stats__)
+				self.__overlay__.set_property(
+				'text', 'Copyright (c) 2021 Marcin Sielski\n' + 
+				self.__model__ + ' ' + self.__format_time__())
+				self.__overlay__.set_property('silent', False)
+				self.__stats_id__ = GLib.timeout_add_seconds(
+					1, self.__on_stats__)
+
+
+	def __format_time__(self):
+
+		"""
+		Format current time with 1 s accuracy for the text overlay
+
+		Returns:
+			str: formatted time
+		"""
+
+		tm = time.localtime()
+		return (
+			str(tm.tm_hour) + ':' + str(tm.tm_min).zfill(2) + ':' + 
+			str(tm.tm_sec).zfill(2) + ' ' + str(tm.tm_mon) + '/' + 
+			str(tm.tm_mday) + '/' + str(tm.tm_year))
 
 
 	def __enable_disable_rtsp__(self, pad, info):
@@ -2413,9 +6852,8 @@ class CameraServer(Server):
 			PadProbeReturn: DROP data in data probes
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraServer.__enable_disable_rtsp__'
+		TRACER.begin(span)
 		pad.remove_probe(info.id)
 		# if this is start streaming request
 		if self.__rtsp__:	
@@ -2423,37 +6861,38 @@ class CameraServer(Server):
 			self.__rtsp_queue__ = Gst.ElementFactory.make('queue', 'rtsp-queue')
 			self.__rtsp_sink__ = Gst.ElementFactory.make('udpsink', 'rtsp-sink')
 			self.__rtsp_sink__.set_property('host', '127.0.0.1')
-			self.__rtsp_sink__.set_property('port', 3141)
+			self.__rtsp_sink__.set_property(
+				'port', 3141 + self.__port_offset__)
 			self.__rtsp_sink__.set_property('sync', False)
 			self.__pipeline__.add(self.__rtsp_queue__)
 			self.__pipeline__.add(self.__rtsp_sink__)
 			self.__rtsp_tee__.link(self.__rtsp_queue__)
 			self.__rtsp_queue__.link(self.__rtsp_sink__)
+			self.__metrics__.add_counter(
+				self.__rtsp_sink__, 'sink', Metrics.RTSP)
 			self.__rtsp_queue__.set_state(Gst.State.PLAYING)
 			self.__rtsp_sink__.set_state(Gst.State.PLAYING)
 		# if this is stop streaming request
 		else:
 			# destroy pipeline
-			self.__rtsp_queue__.set_state(Gst.State.NULL)
-			self.__rtsp_sink__.set_state(Gst.State.NULL)
-			self.__pipeline__.remove(self.__rtsp_queue__)
-			self.__pipeline__.remove(self.__rtsp_sink__)
+			self.__lifecycle__.release(
+				self.__pipeline__, [self.__rtsp_queue__, self.__rtsp_sink__])
+			self.__rtsp_queue__ = None
+			self.__rtsp_sink__ = None
 			logging.info("Streaming stopped")
 			# if function is execute in the unsafe context
 			if not self.__safe__:
 				# if not unblocked by an error
 				if self.__main_lock__.locked():
 					self.__main_lock__.release()
-					logging.debug(
-						function_name + ": self.__main_lock__.release()")
+					TRACER.event(span, "self.__main_lock__.release()")
 			# if function is executed in safe context
 			else:
 				# if not unblocked by an error
 				if self.__restart_lock__.locked():
 					self.__restart_lock__.release()
-					logging.debug(
-						function_name + ": self.__restart_lock__.release()")
-		logging.debug(function_name + ": return Gst.PadProbeReturn.DROP")
+					TRACER.event(span, "self.__restart_lock__.release()")
+		TRACER.end(span, "return Gst.PadProbeReturn.DROP")
 		return Gst.PadProbeReturn.DROP
 
 
@@ -2467,14 +6906,12 @@ class CameraServer(Server):
 			safe (bool): indicate if function is executed in safe context
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(
-			function_name + ": rtsp=" + str(rtsp) + ", safe=" + str(safe))
+		span = 'CameraServer.set_rtsp'
+		TRACER.begin(span, "rtsp=%s, safe=%s", rtsp, safe)
 		# discard invalid requests
 		if self.__rtsp__ == rtsp:
 			logging.warning("Discarding invalid RTSP request")
-			logging.debug(function_name + ": exit")
+			TRACER.end(span)
 			return
 		# if function is executed in unsafe context
 		if not safe:
@@ -2482,17 +6919,16 @@ class CameraServer(Server):
 			if self.__error_lock__.locked():
 				# discard the request
 				logging.warning("Discarding RTSP request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			# block concurrent requests
-			logging.debug(
-				function_name + ": self.__main_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__main_lock__.acquire(blocking=True)")
 			self.__main_lock__.acquire(blocking=True)
 			# if error is pending
 			if self.__error_lock__.locked():
 				# discard the request
 				logging.warning("Discarding RTSP request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 		self.__safe__ = safe		
 		self.__rtsp__ = rtsp
@@ -2500,7 +6936,7 @@ class CameraServer(Server):
 		srcpad = self.__payloader__.get_static_pad( "src")
 		srcpad.add_probe(
 			Gst.PadProbeType.BLOCK_DOWNSTREAM, self.__enable_disable_rtsp__)
-		logging.debug(function_name + ": exit")
+		TRACER.end(span)
 
 
 	def __push_eos__(self):
@@ -2510,14 +6946,13 @@ class CameraServer(Server):
 
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraServer.__push_eos__'
+		TRACER.begin(span)
 		sinkpad = self.__file_queue__.get_static_pad("src").get_peer()
 		logging.info("Pushing EOS event on pad " + sinkpad.name)
 		self.__pipeline__.set_property("message-forward", True)
 		sinkpad.send_event(Gst.Event.new_eos())
-		logging.debug(function_name + ": exit")
+		TRACER.end(span)
 
 
 	def __on_store__(self):
@@ -2526,16 +6961,26 @@ class CameraServer(Server):
 		Store data on disk callback.
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraServer.__on_store__'
+		TRACER.begin(span)
+		self.store()
+		if self.__broker__ is not None:
+			self.__broker__.save_hwclock()
+		TRACER.end(span)
+
+
+	def store(self):
+
+		"""
+		Schedule write of parameters to 'camera.json' file if they are
+		persistent
+		"""
+
 		if self.__persistent__:
-			logging.info("Writing parameters to 'camera.json' file")
-			with open('camera.json', 'w') as config:
-				config.write(self.get_parameters())
-		os.system('sudo fake-hwclock')
-		os.sync()
-		logging.debug(function_name + ": exit")
+			parameters = json.loads(self.get_parameters())
+			# requested bitrate mode is kept for encoding of raw frames
+			parameters['bitrate_mode'] = self.__bitrate_mode__
+			self.__config__.write(json.dumps(parameters, sort_keys=True))
 
 
 	def __on_format_location__(self, splitmux, fragment_id):
@@ -2552,18 +6997,23 @@ class CameraServer(Server):
 			str: file name
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": fragment_id=" + str(fragment_id))
+		span = 'CameraServer.__on_format_location__'
+		TRACER.begin(span, "fragment_id=%s", fragment_id)
+		# NOTE: Fragment ids restart with the recording and Uploader keeps
+		# every fragment until it is uploaded, so names are made unique.
+		tag = ''
+		if self.__uploader__ is not None:
+			tag = time.strftime('%Y%m%d-%H%M%S_')
 		if self.__format__:
 			result = 'v_' + str(self.__width__) + 'x' + str(self.__height__) + \
-				'_HYUV_{0:0{1}}.mkv'.format(fragment_id, 2)
+				'_HYUV_' + tag + '{0:0{1}}.mkv'.format(fragment_id, 2)
 		else:
 			result = 'v_' + str(self.__width__) + 'x' + str(self.__height__) + \
-				'_H264_{0:0{1}}.mp4'.format(fragment_id, 2)
+				'_H264_' + tag + '{0:0{1}}.mp4'.format(fragment_id, 2)
 		self.__fragment_id__ = fragment_id + 1
+		self.__metrics__.inc(Metrics.FRAGMENTS)
 		GLib.timeout_add_seconds(0, self.__on_store__)
-		logging.debug(function_name + ": return " + result)
+		TRACER.end(span, "return %s", result)
 		return result
 
 
@@ -2603,9 +7053,8 @@ class CameraServer(Server):
 			PadProbeReturn: DROP data in data probes
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraServer.__enable_disable_record__'
+		TRACER.begin(span)
 		# if this is record request
 		if self.__record__:
 			# create pipeline
@@ -2634,9 +7083,9 @@ class CameraServer(Server):
 							self.__raw_framerate__ = 1
 					else:
 				 		self.__raw_framerate__ = self.__framerate__
-					logging.debug(
-				 		function_name + ': self.__raw__framerate__=' + 
-				 		str(self.__raw_framerate__))
+					TRACER.event(
+						span, "self.__raw__framerate__=%s",
+						self.__raw_framerate__)
 					self.__file_rate__.set_property(
 				 		'max-rate', self.__raw_framerate__)
 					self.__file_rate__.set_property('drop-only', True)
@@ -2654,10 +7103,10 @@ class CameraServer(Server):
 					'max-size-time', self.__max_size_time__)
 				self.__file_sink__.set_property(
 					'max-size-bytes', self.__max_size_bytes__)
-				self.__file_sink__.set_property('max-files', self.__max_files__)
-				logging.debug(
-					function_name + ": self.__fragment_id__=" +
-					str(self.__fragment_id__))
+				self.__file_sink__.set_property(
+					'max-files', self.__get_max_files__())
+				TRACER.event(
+					span, "self.__fragment_id__=%s", self.__fragment_id__)
 				self.__file_sink__.set_property(
 					'start-index', self.__fragment_id__)
 				self.__file_sink__.connect(
@@ -2707,10 +7156,10 @@ class CameraServer(Server):
 					'max-size-time', self.__max_size_time__)
 				self.__file_sink__.set_property(
 					'max-size-bytes', self.__max_size_bytes__)
-				self.__file_sink__.set_property('max-files', self.__max_files__)
-				logging.debug(
-					function_name + ": self.__fragment_id__=" +
-					str(self.__fragment_id__))
+				self.__file_sink__.set_property(
+					'max-files', self.__get_max_files__())
+				TRACER.event(
+					span, "self.__fragment_id__=%s", self.__fragment_id__)
 				self.__file_sink__.set_property(
 					'start-index', self.__fragment_id__)
 				self.__file_sink__.connect(
@@ -2720,6 +7169,12 @@ class CameraServer(Server):
 					str(self.__height__) + 
 					'_H264_{0:0{1}}.mp4'.format(self.__fragment_id__, 2))
 				self.__file_sink__.set_property('send-keyframe-requests', True)
+			# NOTE: File writer is set explicitly to count buffers written by
+			# the branch with its native stats.
+			writer = Gst.ElementFactory.make('filesink', 'file-writer')
+			writer.set_property('async', False)
+			self.__file_sink__.set_property('sink', writer)
+			self.__metrics__.add_counter(writer, 'sink', Metrics.FILE)
 			self.__pipeline__.add(self.__file_queue__)
 			self.__pipeline__.add(self.__file_sink__)
 			if self.__format__:
@@ -2745,7 +7200,7 @@ class CameraServer(Server):
 			self.__file_queue__.set_state(Gst.State.PLAYING)
 			self.__file_sink__.set_state(Gst.State.PLAYING)
 
-		logging.debug(function_name + ": return Gst.PadProbeReturn.DROP")
+		TRACER.end(span, "return Gst.PadProbeReturn.DROP")
 		return Gst.PadProbeReturn.DROP
 
 
@@ -2759,15 +7214,20 @@ class CameraServer(Server):
 			safe (bool): indicate if function is executed from safe context
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(
-			function_name + ": record=" + str(record) + ", safe=" + str(safe))
+		span = 'CameraServer.set_record'
+		TRACER.begin(span, "record=%s, safe=%s", record, safe)
 		# discard invalid requests
 		if self.__record__ == record:
 			logging.warning("Discarding invalid record request")
-			logging.debug(function_name + ": exit")
+			TRACER.end(span)
 			return
+		# if raw recording is requested in the topology without raw frames
+		if record and self.__format__ and not self.__raw__:
+			# switch to topology with raw frames first
+			logging.info("Switching to raw frames and encoder")
+			self.__raw_pending__ = True
+			self.restart()
+			self.__raw_pending__ = False
 		# if function is executed in unsafe context
 		if not safe:
 			# if error is pending
@@ -2775,18 +7235,17 @@ class CameraServer(Server):
 				# discard the request
 				logging.warning(
 					"Discarding record request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			# block concurrent requests
-			logging.debug(
-				function_name + ": self.__main_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__main_lock__.acquire(blocking=True)")
 			self.__main_lock__.acquire(blocking=True)
 			# if error is pending
 			if self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding record request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 		self.__safe__ = safe
 		self.__record__ = record
@@ -2809,7 +7268,7 @@ class CameraServer(Server):
 				Gst.PadProbeType.BLOCK | Gst.PadProbeType.BUFFER, 
 				self.__enable_disable_record__)
 			threading.Thread(target=self.__push_eos__, args=()).start()
-		logging.debug(function_name + ": exit")
+		TRACER.end(span)
 
 
 	def remove(self, filename):
@@ -2821,10 +7280,9 @@ class CameraServer(Server):
 			filename (str): name of the file to remove
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
+		span = 'CameraServer.remove'
 
-		logging.debug(function_name + ": filename=" + str(filename))
+		TRACER.begin(span, "filename=%s", filename)
 
 		if filename == '':
 			_, _, filenames = next(os.walk('.'))
@@ -2835,17 +7293,17 @@ class CameraServer(Server):
 						os.remove(filename)
 					else:
 						logging.warning(
-							function_name + ": filename=" + str(filename) + 
-						" does not exist")
+							span + ": filename=" + str(filename) + 
+							" does not exist")
 		else:
 			if os.path.exists(filename):
 				os.remove(filename)
 			else:
 				logging.warning(
-					function_name + ": filename=" + str(filename) + 
+					span + ": filename=" + str(filename) + 
 					" does not exist")
 
-		logging.debug(function_name + ": exit")
+		TRACER.end(span)
 
 
 	def restart(self, safe=False):
@@ -2857,9 +7315,9 @@ class CameraServer(Server):
 			safe (bool): indicate if function is executed in the safe context
 		"""
 		#snapshot1 = tracemalloc.take_snapshot()
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": safe=" + str(safe))
+		restart_start = time.monotonic()
+		span = 'CameraServer.restart'
+		TRACER.begin(span, "safe=%s", safe)
 		# if function is executed in unsafe context
 		if not safe:
 			# if error is pending
@@ -2867,337 +7325,1101 @@ class CameraServer(Server):
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			# block concurrent requests
-			logging.debug(
-				function_name + ": self.__main_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__main_lock__.acquire(blocking=True)")
 			self.__main_lock__.acquire(blocking=True)
 			# if error is pending
 			if self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 		rtsp = self.__rtsp__
 		record = self.__record__
+		raw_pending = self.__raw_pending__
+		self.__raw_pending__ = raw_pending or (record and self.__format__)
 		# if server is streaming
 		if self.__rtsp__:
 			# stop streaming
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.set_rtsp(False, True)
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
+			TRACER.event(span, "self.__restart_lock__.release()")
 		# if server is recording
 		if self.__record__:
 			# stop recording
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return			
 			self.set_record(False, True)
-			logging.debug(
-				function_name + ": __restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
+			TRACER.event(span, "self.__restart_lock__.release()")
 		super().restart()
+		self.__raw_pending__ = raw_pending
 		# if server was streaming before the restart 
 		if rtsp:
 			# start streaming
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.set_rtsp(True, True)
-			logging.debug(
-				function_name + ": __restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
+			TRACER.event(span, "self.__restart_lock__.release()")
 		# if server was recording before the restart
 		if record:
 			# start recording
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.set_record(True, True)
-			logging.debug(
-				function_name + 
-				": self.__restart_lock__.acquire(blocking=True)")
+			TRACER.event(span, "self.__restart_lock__.acquire(blocking=True)")
 			self.__restart_lock__.acquire(blocking=True)
 			# if function is executed in unsafe context and if error is pending
 			if not safe and self.__error_lock__.locked():
 				# discard the request
 				logging.warning(
 					"Discarding restart request due to pending error")
-				logging.debug(function_name + ": exit")
+				TRACER.end(span)
 				return
 			self.__restart_lock__.release()
-			logging.debug(function_name + ": self.__restart_lock__.release()")
+			TRACER.event(span, "self.__restart_lock__.release()")
 		# if function is executed in unsafe context and was not unblocked by
 		# an error
 		if not safe and self.__main_lock__.locked():
 			# unblock concurrent requests
 			self.__main_lock__.release()
-			logging.debug(function_name + ": self.__main_lock__.release()")
-		logging.debug(function_name + ": exit")
+			TRACER.event(span, "self.__main_lock__.release()")
+		self.__metrics__.observe_restart(time.monotonic() - restart_start)
+		TRACER.end(span)
 		#snapshot2 = tracemalloc.take_snapshot()
 		#top_stats = snapshot2.compare_to(snapshot1, 'lineno')
 		#for stat in top_stats[:10]:
 		#	print(stat)
 
 
-	def set_format(self, format):
+	def set_format(self, format):
+
+		"""
+		Set format of recorded video file
+
+		Args:
+			format (bool): format of recorded video file
+		"""
+
+		span = 'CameraServer.set_format'
+		TRACER.begin(span, "format=%s", format)
+		self.__format__ = format
+		if self.__record__:
+			self.set_record(False)
+			self.set_record(True)
+		TRACER.end(span)
+
+
+	def set_max_files(self, max_files):
+
+		"""
+		Set maximum number of recorded video files to keep on storage device
+		Once the maximum is reached old files start to be deleted to make room
+		for new ones
+
+		Args:
+			max_files (int): maximum number of recorded video files
+		"""
+
+		span = 'CameraServer.set_max_files'
+		TRACER.begin(span, "max_files=%s", max_files)
+		self.__max_files__ = max_files
+		if self.__uploader__ is not None:
+			self.__uploader__.set_max_files(self.__max_files__)
+		if self.__file_sink__ is not None:
+			self.__file_sink__.set_property(
+				'max-files', self.__get_max_files__())
+		TRACER.end(span)
+
+
+	def __get_max_files__(self):
+
+		"""
+		Return maximum number of files for the file sink. When Uploader is
+		attached it takes care of the retention so that fragments are deleted
+		only after confirmed upload.
+
+		Returns:
+			int: maximum number of files for the file sink
+		"""
+
+		if self.__uploader__ is not None:
+			return 0
+		return self.__max_files__
+
+
+	def set_rtsp_server(self, rtsp_server):
+
+		"""
+		Attach RTSP Server serving the regions of interest
+
+		Args:
+			rtsp_server (RTSPServer): RTSP server
+		"""
+
+		self.__rtsp_server__ = rtsp_server
+		for roi_name in sorted(self.__rois__):
+			self.__rtsp_server__.add_mount(
+				roi_name, self.__get_roi_port__(roi_name))
+
+
+	def set_broker(self, broker):
+
+		"""
+		Attach Broker Client performing privileged operations
+
+		Args:
+			broker (BrokerClient): broker client
+		"""
+
+		self.__broker__ = broker
+
+
+	def set_uploader(self, uploader):
+
+		"""
+		Attach Uploader of the closed recording fragments
+
+		Args:
+			uploader (Uploader): uploader
+		"""
+
+		self.__uploader__ = uploader
+		self.__uploader__.set_max_files(self.__max_files__)
+
+
+	def set_max_size_bytes(self, max_size_bytes):
+
+		"""
+		Set maximum size of the recorded video file in bytes
+
+		Args:
+			max_size_bytes (int): maximum size of the recorded video file in
+				bytes
+		"""
+
+		span = 'CameraServer.set_max_size_bytes'
+		TRACER.begin(span, "max_size_bytes=%s", max_size_bytes)
+		self.__max_size_bytes__ = max_size_bytes
+		if self.__record__:
+			self.set_record(False)
+			self.set_record(True)
+		TRACER.end(span)
+
+
+	def set_max_size_time(self, max_size_time):
+
+		"""
+		Set maximum size of the recorded video file in nanoseconds
+
+		Args:
+			max_size_time (int): maximum size of the recorded video file in
+				nanoseconds
+		"""
+
+		span = 'CameraServer.set_max_size_time'
+		TRACER.begin(span, "max_size_time=%s", max_size_time)
+		self.__max_size_time__ = max_size_time
+		if self.__record__:
+			self.set_record(False)
+			self.set_record(True)
+		TRACER.end(span)
+
+
+	def set_timelapse(self, timelapse):
+
+		"""
+		Set interval of the timelapse recording
+
+		Args:
+			timelapse (int): interval between timelapse frames in seconds, 0 to
+				disable timelapse recording
+		"""
+
+		span = 'CameraServer.set_timelapse'
+		TRACER.begin(span, "timelapse=%s", timelapse)
+		if timelapse < 0:
+			logging.warning("Discarding invalid timelapse request")
+			TRACER.end(span)
+			return
+		self.__timelapse__ = timelapse
+		# NOTE: Raw frames are needed while timelapse is recording.
+		self.restart()
+		TRACER.end(span)
+
+
+	def set_roi(
+		self, roi_name, x, y, width, height, output_width=0, output_height=0,
+		bitrate=0):
+
+		"""
+		Add region of interest streamed as a virtual camera or move it. Moving
+		and zooming applies to the next frame without restarting the
+		pipeline.
+
+		Args:
+			roi_name (str): name of the region of interest, also the RTSP mount
+				point below the path of the camera
+			x (int): left edge of the region in pixels
+			y (int): top edge of the region in pixels
+			width (int): width of the region in pixels
+			height (int): height of the region in pixels
+			output_width (int): width of the stream, 0 to keep it
+			output_height (int): height of the stream, 0 to keep it
+			bitrate (int): bitrate of the stream, 0 to keep it
+		"""
+
+		span = 'CameraServer.set_roi'
+		TRACER.begin(
+			span, "roi_name=%s, x=%s, y=%s, width=%s, height=%s", roi_name,
+			x, y, width, height)
+		# planar formats require even offsets and sizes
+		x, y, width, height, output_width, output_height = (
+			value - value % 2 for value in
+			(x, y, width, height, output_width, output_height))
+		if (
+			not roi_name or
+			not all(c.isalnum() or c in '-_' for c in roi_name) or
+			x < 0 or y < 0 or width <= 0 or height <= 0 or
+			x + width > self.__width__ or y + height > self.__height__
+		):
+			logging.warning("Discarding invalid ROI request")
+			TRACER.end(span)
+			return
+		roi = self.__rois__.get(roi_name)
+		if roi is None:
+			slots = [other['slot'] for other in self.__rois__.values()]
+			free = [slot for slot in range(self.MAX_ROIS) if slot not in slots]
+			if not free:
+				logging.warning("Discarding ROI request, too many ROIs")
+				TRACER.end(span)
+				return
+			roi = {
+				'slot': free[0], 'output_width': width,
+				'output_height': height, 'bitrate': self.ROI_BITRATE}
+		output = (roi['output_width'], roi['output_height'], roi['bitrate'])
+		roi.update({'x': x, 'y': y, 'width': width, 'height': height})
+		if output_width > 0 and output_height > 0:
+			roi['output_width'] = output_width
+			roi['output_height'] = output_height
+		if bitrate > 0:
+			roi['bitrate'] = bitrate
+		crop = self.__roi_crops__.get(roi_name)
+		if roi_name in self.__rois__ and crop is not None and output == (
+			roi['output_width'], roi['output_height'], roi['bitrate']):
+			# digital pan, tilt and zoom
+			self.__set_crop__(crop, roi)
+			TRACER.end(span)
+			return
+		if roi_name not in self.__rois__:
+			self.__rois__[roi_name] = roi
+			if self.__rtsp_server__ is not None:
+				self.__rtsp_server__.add_mount(
+					roi_name, self.__get_roi_port__(roi_name))
+		self.restart()
+		TRACER.end(span)
+
+
+	def remove_roi(self, roi_name):
+
+		"""
+		Remove region of interest
+
+		Args:
+			roi_name (str): name of the region of interest
+		"""
+
+		span = 'CameraServer.remove_roi'
+		TRACER.begin(span, "roi_name=%s", roi_name)
+		if roi_name not in self.__rois__:
+			logging.warning("Discarding invalid ROI request")
+			TRACER.end(span)
+			return
+		if self.__rtsp_server__ is not None:
+			self.__rtsp_server__.remove_mount(roi_name)
+		del self.__rois__[roi_name]
+		self.restart()
+		TRACER.end(span)
+
+
+	def get_rois(self):
+
+		"""
+		Return regions of interest
+
+		Returns:
+			json: regions of interest by name
+		"""
+
+		return json.dumps(self.__rois__, sort_keys=True)
+
+
+	def set_persistent(self, persistent):
+
+		"""
+		Set configuration persistence
+
+		Args:
+			persistent (bool): True if configuration shall be persistent,
+				False otherwise
+		"""
+
+		span = 'CameraServer.set_persistent'
+		TRACER.begin(span, "persistent=%s", persistent)
+		self.__persistent__ = persistent
+		TRACER.end(span)
+
+
+	def set_continuation(self, continuation):
+
+		"""
+		Set configuration continuation
+
+		Args:
+			continuation (bool): True if recording shall continuation from last
+			    fragment id, False otherwise
+		"""
+
+		span = 'CameraServer.set_continuation'
+		TRACER.begin(span, "continuation=%s", continuation)
+		self.__continuation__ = continuation
+		TRACER.end(span)
+
+
+	def set_logging_level(self, logging_level):
+
+		"""
+		Set logging level
+
+		Args:
+			logging_level (int): logging level
+		"""	
+
+		span = 'CameraServer.set_logging_level'
+		TRACER.begin(span, "logging_level=%s", logging_level)
+		self.__logging_level__ = logging_level
+		# NOTE: Only the level changes, handlers keep the format configured
+		# on startup, e.g. with the camera id prefix.
+		root = logging.getLogger()
+		if self.__default_logging_level__ != 0:
+			if self.__logging_level__ == 0:
+				Gst.debug_set_active(False)
+				root.setLevel(self.__default_logging_level__)
+			else:
+				Gst.debug_set_colored(False)
+				Gst.debug_set_default_threshold(
+					(50-self.__logging_level__+10)/10)
+				#Gst.debug_set_threshold_for_name("videorate", (50-self.__logging_level__+10)/10+1)
+				Gst.debug_set_active(True)
+				root.setLevel(self.__logging_level__)
+		TRACER.end(span)
+
+
+
+class Servers(object):
+
+	"""
+	Servers
+	"""
+
+	def __init__(self, servers):
+
+		"""
+		Initialize servers
+
+		Args:
+			servers (list): list of servers
+		"""
+
+		self.__servers__ = servers
+		self.__threads__ = []
+
+
+	def start(self):
+
+		"""
+		Starts servers
+		"""
+
+		for server in self.__servers__:
+			thread = threading.Thread(
+				name=name(server) + ' Thread', target=server.start, args=())
+			thread.deamon = True
+			thread.start()
+			self.__threads__.append(thread)
+
+
+	def stop(self):
+
+		"""
+		Stop servers
+		"""
+
+		for server in self.__servers__:
+			server.stop()
+		for thread in self.__threads__:
+			thread.join()
+
+
+def create_media(args):
+
+	"""
+	Create servers running the pipeline of a single camera. Must be called
+	after Gst.init().
+
+	Args:
+		args (Namespace): command line arguments of the camera
+
+	Returns:
+		tuple: camera server, metrics, telemetry history, flow watchdog, heap
+			profiler and list of servers to start
+	"""
+
+	broker = BrokerClient(args.broker)
+	telemetry = TelemetrySampler(broker=broker)
+	metrics = Metrics()
+	history = TelemetryHistory(metrics)
+	telemetry.add_listener(metrics.sample)
+	telemetry.add_listener(history.sample)
+	camera_server = CameraServer(args, telemetry, metrics)
+	profiler = HeapProfiler(args.tracemalloc)
+	watchdog = FlowWatchdog(
+		camera_server, metrics, deadline=args.watchdog_deadline)
+	path = '/pi'
+	if args.camera_id is not None:
+		path = '/' + args.camera_id
+	rtsp_server = RTSPServer(
+		camera_server, port=str(8000 + args.port_offset), path=path,
+		metrics=metrics, rtp_port=3141 + args.port_offset)
+	camera_server.set_rtsp_server(rtsp_server)
+	camera_server.set_broker(broker)
+	# NOTE: Broker Client stops after Camera Server, so that the clock saved
+	# on stop is completed.
+	servers = [
+		camera_server, broker, telemetry, history, rtsp_server, watchdog]
+	if args.upload_url is not None:
+		upload_url = args.upload_url
+		if args.camera_id is not None:
+			upload_url = upload_url.rstrip('/') + '/' + args.camera_id
+		uploader = Uploader(
+			upload_url, os.environ.get('AWS_ACCESS_KEY_ID', ''),
+			os.environ.get('AWS_SECRET_ACCESS_KEY', ''),
+			os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+			args.upload_bandwidth)
+		camera_server.set_uploader(uploader)
+		servers.append(uploader)
+	return camera_server, metrics, history, watchdog, profiler, servers
+
+
+def run_media(args, connection):
+
+	"""
+	Media process entry method. Runs the pipeline of a single camera and
+	serves requests of the control plane received over the connection on the
+	main thread, so that the GStreamer callbacks never wait for the HTTPS
+	Server. Cameras specified by camera id are pinned to their own core and
+	record into their own directory.
+
+	Args:
+		args (Namespace): command line arguments of the camera
+		connection (Connection): connection to the control plane
+	"""
+
+	prefix = "media"
+	if args.camera_id is not None:
+		prefix = args.camera_id
+	if getattr(logging, args.debug.upper()):
+		logging.basicConfig(
+			format="%(asctime)s " + prefix + " %(levelname)s: %(message)s",
+			level=getattr(logging, args.debug.upper()))
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	# NOTE: Readiness and liveness are reported by the control plane.
+	os.environ.pop('NOTIFY_SOCKET', None)
+	os.environ.pop('WATCHDOG_USEC', None)
+	if args.camera_id is not None:
+		core = args.port_offset % os.cpu_count()
+		try:
+			os.sched_setaffinity(0, {core})
+			logging.info("Pinned to core " + str(core))
+		except OSError as e:
+			logging.warning(
+				"Unable to pin to core " + str(core) + ": " + str(e))
+		os.makedirs(args.camera_id, exist_ok=True)
+		os.chdir(args.camera_id)
+	Gst.init(None)
+	prewarm_registry(args.model)
+	camera_server, metrics, history, watchdog, profiler, servers = \
+		create_media(args)
+	control_server = ControlServer(ControlChannel(connection), {
+		'camera': camera_server, 'history': history, 'watchdog': watchdog,
+		'metrics': metrics, 'profiler': profiler})
+	servers = Servers(servers)
+	servers.start()
+	logging.info("Camera (" + args.model + ") running")
+	control_server.start()
+	servers.stop()
+
+
+class ControlChannel(object):
+
+	"""
+	Control Channel exchanging requests of the control plane and replies of
+	the media process as compact binary messages. A request consists of the
+	request id, the target index, the method name length and the reply flag
+	followed by the method name and JSON encoded arguments. A reply consists
+	of the request id, the status and the value type followed by the value.
+	Empty message requests to stop.
+	"""
+
+	TARGETS = ('camera', 'history', 'watchdog', 'metrics', 'profiler')
+	REQUEST = struct.Struct('!IBBB')
+	REPLY = struct.Struct('!IBB')
+	JSON = 0
+	TEXT = 1
+
+
+	def __init__(self, connection):
 
 		"""
-		Set format of recorded video file
+		Initialize Control Channel
 
 		Args:
-			format (bool): format of recorded video file
+			connection (Connection): connection
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": format="+str(format))
-		self.__format__ = format
-		if self.__record__:
-			self.set_record(False)
-			self.set_record(True)
-		logging.debug(function_name + ": exit")
+		self.__connection__ = connection
 
 
-	def set_max_files(self, max_files):
+	def send_request(self, request_id, target, method, args, reply=True):
 
 		"""
-		Set maximum number of recorded video files to keep on storage device
-		Once the maximum is reached old files start to be deleted to make room
-		for new ones
+		Send request
 
 		Args:
-			max_files (int): maximum number of recorded video files
+			request_id (int): id the reply is matched with
+			target (str): name of the object
+			method (str): name of the method
+			args (tuple): arguments
+			reply (bool): indicate whether reply is expected
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": max_files=" + str(max_files))
-		self.__max_files__ = max_files
-		if self.__file_sink__ is not None:
-			self.__file_sink__.set_property('max-files', self.__max_files__)
-		logging.debug(function_name + ": exit")
+		method = method.encode()
+		self.__connection__.send_bytes(
+			self.REQUEST.pack(
+				request_id, self.TARGETS.index(target), len(method), reply) +
+			method + json.dumps(args, separators=(',', ':')).encode())
 
 
-	def set_max_size_bytes(self, max_size_bytes):
+	def recv_request(self):
 
 		"""
-		Set maximum size of the recorded video file in bytes
+		Receive request
 
-		Args:
-			max_size_bytes (int): maximum size of the recorded video file in
-				bytes
+		Returns:
+			tuple: request id, name of the object, name of the method,
+				arguments and reply flag or None if stop is requested
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": max_size_bytes=" + str(max_size_bytes))
-		self.__max_size_bytes__ = max_size_bytes
-		if self.__record__:
-			self.set_record(False)
-			self.set_record(True)
-		logging.debug(function_name + ": exit")
+		data = self.__connection__.recv_bytes()
+		if not data:
+			return None
+		request_id, target, length, reply = self.REQUEST.unpack_from(data)
+		offset = self.REQUEST.size
+		method = data[offset:offset + length].decode()
+		args = json.loads(data[offset + length:])
+		return request_id, self.TARGETS[target], method, args, bool(reply)
 
 
-	def set_max_size_time(self, max_size_time):
+	def send_reply(self, request_id, ok, value):
 
 		"""
-		Set maximum size of the recorded video file in nanoseconds
+		Send reply
 
 		Args:
-			max_size_time (int): maximum size of the recorded video file in
-				nanoseconds
+			request_id (int): id of the request
+			ok (bool): indicate whether request succeeded
+			value (any): result of the method or error message
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": max_size_time=" + str(max_size_time))
-		self.__max_size_time__ = max_size_time
-		if self.__record__:
-			self.set_record(False)
-			self.set_record(True)
-		logging.debug(function_name + ": exit")
+		# NOTE: Most of the results are already JSON documents, do not encode
+		# them twice.
+		if isinstance(value, str):
+			header = self.REPLY.pack(request_id, ok, self.TEXT)
+			value = value.encode()
+		else:
+			header = self.REPLY.pack(request_id, ok, self.JSON)
+			value = json.dumps(value, separators=(',', ':')).encode()
+		self.__connection__.send_bytes(header + value)
 
 
-	def set_persistent(self, persistent):
+	def recv_reply(self):
 
 		"""
-		Set configuration persistence
+		Receive reply
+
+		Returns:
+			tuple: request id, status and value
+		"""
+
+		data = self.__connection__.recv_bytes()
+		request_id, ok, kind = self.REPLY.unpack_from(data)
+		value = data[self.REPLY.size:].decode()
+		if kind == self.JSON:
+			value = json.loads(value)
+		return request_id, bool(ok), value
+
+
+	def send_stop(self):
+
+		"""
+		Request to stop
+		"""
+
+		self.__connection__.send_bytes(b'')
+
+
+	def poll(self, timeout):
+
+		"""
+		Wait for the message
 
 		Args:
-			persistent (bool): True if configuration shall be persistent,
-				False otherwise
+			timeout (float): timeout in seconds
+
+		Returns:
+			bool: True if message is available
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": persistent=" + str(persistent))
-		self.__persistent__ = persistent
-		logging.debug(function_name + ": exit")
+		return self.__connection__.poll(timeout)
 
 
-	def set_continuation(self, continuation):
+	def close(self):
 
 		"""
-		Set configuration continuation
+		Close Control Channel
+		"""
+
+		self.__connection__.close()
+
+
+class ControlServer(Server):
+
+	"""
+	Control Server executing requests of the control plane in the media
+	process. Queries are answered on the main thread, while requests that may
+	restart the pipeline are executed one by one on the worker thread, so
+	that a slow restart does not hold health and metrics queries.
+	"""
+
+	def __init__(self, channel, targets):
+
+		"""
+		Initialize Control Server
 
 		Args:
-			continuation (bool): True if recording shall continuation from last
-			    fragment id, False otherwise
+			channel (ControlChannel): channel to the control plane
+			targets (dict): objects requests can be addressed to
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": continuation=" + str(continuation))
-		self.__continuation__ = continuation
-		logging.debug(function_name + ": exit")
+		self.__channel__ = channel
+		self.__targets__ = targets
+		self.__lock__ = threading.Lock()
+		self.__queue__ = queue.Queue()
 
 
-	def set_logging_level(self, logging_level):
+	def __execute__(self, request):
 
 		"""
-		Set logging level
+		Execute request and send reply if it is expected
 
 		Args:
-			logging_level (int): logging level
-		"""	
+			request (tuple): request id, name of the object, name of the
+				method, arguments and reply flag
+		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": logging_level=" + str(logging_level))
-		self.__logging_level__ = logging_level
-		root = logging.getLogger()
-		for h in root.handlers[:]:
-			root.removeHandler(h)
-			h.close()
-		if self.__default_logging_level__ != 0:
-			if self.__logging_level__ == 0:
-				Gst.debug_set_active(False)
-				logging.basicConfig(
-					format="%(asctime)s %(levelname)s: %(message)s",
-					level=self.__default_logging_level__)
+		request_id, target, method, args, reply = request
+		try:
+			function = getattr(self.__targets__[target], method)
+			result = (True, function(*args))
+		except Exception as e:
+			logging.error(
+				"Request " + target + "." + method + " failed: " + repr(e))
+			result = (False, repr(e))
+		if not reply:
+			return
+		try:
+			with self.__lock__:
+				self.__channel__.send_reply(request_id, *result)
+		except (OSError, ValueError) as e:
+			logging.warning("Unable to send reply: " + str(e))
+
+
+	def __work__(self):
+
+		"""
+		Execute requests that may restart the pipeline in order
+		"""
+
+		while True:
+			request = self.__queue__.get()
+			if request is None:
+				break
+			self.__execute__(request)
+
+
+	def start(self):
+
+		"""
+		Start Control Server. Returns when the control plane requests to stop
+		or goes away.
+		"""
+
+		logging.info(name(self) + " started")
+		worker = threading.Thread(
+			name=name(self) + ' Worker Thread', target=self.__work__)
+		worker.start()
+		while True:
+			try:
+				request = self.__channel__.recv_request()
+			except (EOFError, OSError):
+				break
+			if request is None:
+				break
+			# NOTE: Getters only read the state, the same way HTTPS Server
+			# threads do when running in a single process.
+			if request[2].startswith('get_') or request[1] != 'camera':
+				self.__execute__(request)
 			else:
-				Gst.debug_set_colored(False)
-				Gst.debug_set_default_threshold(
-					(50-self.__logging_level__+10)/10)
-				#Gst.debug_set_threshold_for_name("videorate", (50-self.__logging_level__+10)/10+1)
-				Gst.debug_set_active(True)
-				logging.basicConfig(
-					format="%(asctime)s %(levelname)s: %(message)s",
-					level=self.__logging_level__)
-		logging.debug(function_name + ": exit")
+				self.__queue__.put(request)
+		self.__queue__.put(None)
+		worker.join()
+		logging.info(name(self) + " stopped")
 
 
+class RemoteObject(object):
 
-class Servers(object):
+	"""
+	Proxy forwarding method calls to an object in the media process
+	"""
+
+	def __init__(self, media_process, target, reply=True):
+
+		"""
+		Initialize Remote Object
+
+		Args:
+			media_process (MediaProcess): media process
+			target (str): name of the object in the media process
+			reply (bool): indicate whether to wait for the results of the
+				calls
+		"""
+
+		self.__media_process__ = media_process
+		self.__target__ = target
+		self.__reply__ = reply
+
+
+	def __getattr__(self, method):
+
+		"""
+		Return function calling the method of the remote object
+
+		Args:
+			method (str): name of the method
+
+		Returns:
+			function: function calling the method
+		"""
+
+		media_process = self.__media_process__
+		target = self.__target__
+		reply = self.__reply__
+
+		def call(*args):
+			return media_process.call(target, method, args, reply)
+
+		return call
+
+
+class MediaProcess(Server):
 
 	"""
-	Servers
+	Media Process supervising the process running the pipeline of a single
+	camera. The process is restarted when it exits unexpectedly.
 	"""
 
-	def __init__(self, servers):
+	TIMEOUT = 30
+
+
+	def __init__(self, args):
 
 		"""
-		Initialize servers
+		Initialize Media Process
 
 		Args:
-			servers (list): list of servers
+			args (Namespace): command line arguments of the camera
+		"""
+
+		self.__args__ = args
+		self.__label__ = "Camera"
+		if args.camera_id is not None:
+			self.__label__ += " '" + args.camera_id + "'"
+		# NOTE: Media process must not inherit GLib and GStreamer state.
+		self.__context__ = multiprocessing.get_context('spawn')
+		self.__lock__ = threading.Lock()
+		self.__stop_event__ = threading.Event()
+		self.__channel__ = None
+		self.__process__ = None
+		self.__running__ = False
+		self.__request_id__ = 0
+		self.__pending__ = {}
+		self.__proxies__ = {}
+		for target in ControlChannel.TARGETS:
+			# request latency is recorded without waiting for the media
+			# process
+			self.__proxies__[target] = RemoteObject(
+				self, target, target != 'metrics')
+
+
+	def get_proxy(self, target):
+
 		"""
+		Return proxy of the object in the media process
 
-		self.__servers__ = servers
-		self.__threads__ = []
+		Args:
+			target (str): 'camera', 'history', 'watchdog', 'metrics' or
+				'profiler'
+
+		Returns:
+			RemoteObject: proxy
+		"""
+
+		return self.__proxies__[target]
+
+
+	def call(self, target, method, args, reply=True):
+
+		"""
+		Call method of the object in the media process
+
+		Args:
+			target (str): name of the object
+			method (str): name of the method
+			args (tuple): arguments
+			reply (bool): indicate whether to wait for the result
+
+		Returns:
+			any: result of the method or None if reply is not expected
+		"""
+
+		with self.__lock__:
+			if self.__channel__ is None:
+				raise RuntimeError(self.__label__ + " not available")
+			if not reply:
+				self.__channel__.send_request(0, target, method, args, False)
+				return None
+			self.__request_id__ = self.__request_id__ % 0xFFFFFFFF + 1
+			request_id = self.__request_id__
+			pending = [threading.Event(), None]
+			self.__pending__[request_id] = pending
+			try:
+				self.__channel__.send_request(
+					request_id, target, method, args, True)
+			except Exception:
+				del self.__pending__[request_id]
+				raise
+		if not pending[0].wait(self.TIMEOUT):
+			# NOTE: Late reply is dropped by the receiver, so it is never
+			# taken for the reply to another request.
+			with self.__lock__:
+				self.__pending__.pop(request_id, None)
+			raise TimeoutError(self.__label__ + " not responding")
+		ok, result = pending[1]
+		if not ok:
+			raise RuntimeError(result)
+		return result
+
+
+	def __receive__(self, channel):
+
+		"""
+		Receive replies of the media process and pass them to the callers
+		waiting for them
+
+		Args:
+			channel (ControlChannel): channel to the media process
+		"""
+
+		while True:
+			try:
+				request_id, ok, result = channel.recv_reply()
+			except (EOFError, OSError):
+				break
+			with self.__lock__:
+				pending = self.__pending__.pop(request_id, None)
+			if pending is None:
+				logging.warning(
+					self.__label__ + " late reply to request " +
+					str(request_id) + " dropped")
+				continue
+			pending[1] = (ok, result)
+			pending[0].set()
+		with self.__lock__:
+			pendings = list(self.__pending__.values())
+			self.__pending__.clear()
+		for pending in pendings:
+			pending[1] = (False, self.__label__ + " not available")
+			pending[0].set()
 
 
 	def start(self):
 
 		"""
-		Starts servers
+		Start Media Process
 		"""
 
-		for server in self.__servers__:
-			thread = threading.Thread(
-				name=name(server) + ' Thread', target=server.start, args=())
-			thread.deamon = True
-			thread.start()
-			self.__threads__.append(thread)
+		logging.info(name(self) + " started")
+		self.__running__ = True
+		self.__stop_event__.clear()
+		while self.__running__:
+			connection, child_connection = self.__context__.Pipe()
+			process = self.__context__.Process(
+				name=self.__label__, target=run_media,
+				args=(self.__args__, child_connection))
+			process.start()
+			child_connection.close()
+			channel = ControlChannel(connection)
+			receiver = threading.Thread(
+				name=name(self) + ' Receiver Thread', target=self.__receive__,
+				args=(channel,))
+			receiver.start()
+			with self.__lock__:
+				self.__channel__ = channel
+				self.__process__ = process
+			process.join()
+			with self.__lock__:
+				self.__channel__ = None
+			receiver.join()
+			connection.close()
+			if not self.__running__:
+				break
+			logging.error(
+				self.__label__ + " exited with code " + str(process.exitcode) +
+				", restarting")
+			self.__stop_event__.wait(5)
 
 
 	def stop(self):
 
 		"""
-		Stop servers
+		Stop Media Process
 		"""
 
-		for server in self.__servers__:
-			server.stop()
-		for thread in self.__threads__:
-			thread.join()
+		self.__running__ = False
+		self.__stop_event__.set()
+		with self.__lock__:
+			process = self.__process__
+			if self.__channel__ is not None:
+				try:
+					self.__channel__.send_stop()
+				except (OSError, ValueError):
+					pass
+		if process is not None:
+			process.join(self.TIMEOUT)
+			if process.is_alive():
+				process.terminate()
+		logging.info(name(self) + " stopped")
+
+
+def camera_spec(spec):
+
+	"""
+	Parse camera specification
+
+	Args:
+		spec (str): camera specification ID:MODEL[:NUMBER]
+
+	Returns:
+		tuple: camera id, model and number of the camera
+
+	Raises:
+		ArgumentTypeError: if specification is invalid
+	"""
+
+	fields = spec.split(':')
+	if (
+		len(fields) < 2 or len(fields) > 3 or not fields[0].isalnum() or
+		fields[1] not in MODELS or 
+		(len(fields) == 3 and not fields[2].isdigit())
+	):
+		raise ArgumentTypeError(
+			"invalid camera '" + spec + "', expected ID:MODEL[:NUMBER]")
+	number = 0
+	if len(fields) == 3:
+		number = int(fields[2])
+	return fields[0], fields[1], number
 
 
 class CameraService:
@@ -3241,6 +8463,69 @@ class CameraService:
 		parser.add_argument(
 			'-t', '--throughput', type=int, nargs='?', const=1, default=1,
 			help="set camera timeout (1 MiB by default)")
+		# NOTE: Credentials are taken from the environment so that they do not
+		# show up on the process list.
+		parser.add_argument(
+			'-u', '--upload_url', type=str, default=None,
+			help="upload closed recording fragments to the S3 compatible "
+			"storage at scheme://host[:port]/bucket[/prefix] with credentials "
+			"from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY (disabled by "
+			"default)")
+		parser.add_argument(
+			'-b', '--upload_bandwidth', type=int, default=0,
+			help="set upload bandwidth cap in KiB/s (unlimited by default)")
+		parser.add_argument(
+			'-w', '--watchdog_deadline', type=float, default=5,
+			help="recover pipeline when no frames flow through a branch for "
+			"the specified number of seconds, 0 disables recovery (5 s by "
+			"default)")
+		parser.add_argument(
+			'-m', '--model', type=str, default=None, choices=MODELS,
+			help="skip camera detection and use the specified camera model "
+			"(detected by default)")
+		parser.add_argument(
+			'-n', '--camera_number', type=int, default=0,
+			help="select CSI port on Compute Module or /dev/videoN for v4l2 "
+			"camera (0 by default)")
+		parser.add_argument(
+			'-p', '--port_offset', type=int, default=0,
+			help="offset RTP, RTSP and recording ports, e.g. to run several "
+			"services side by side (0 by default)")
+		# NOTE: Every camera runs its own pipeline in its own process pinned
+		# to its own core, so that cameras do not share the interpreter.
+		parser.add_argument(
+			'-C', '--camera', type=camera_spec, action='append', default=None,
+			help="run camera ID:MODEL[:NUMBER] in a separate process, may be "
+			"repeated; camera ID selects the camera in the control API, the "
+			"RTSP mount point and the recording directory (single camera by "
+			"default)")
+		# NOTE: HTTPS requests, TLS handshakes and JSON serialization run in a
+		# separate process by default, so that they do not compete with the
+		# GStreamer callbacks for the interpreter.
+		parser.add_argument(
+			'-s', '--single_process', action='store_true',
+			help="run the control plane and the pipeline of a single camera in "
+			"one process (separate processes by default)")
+		parser.add_argument(
+			'-z', '--zero_copy', action='store_true',
+			help="pass raw frames to the encoder as dmabuf where drivers "
+			"support it (disabled by default)")
+		parser.add_argument(
+			'-e', '--encoder', type=str, default='auto',
+			choices=('auto',) + EncoderSelector.CANDIDATES,
+			help="encode raw frames with the specified encoder (encoder "
+			"sustaining the resolution and framerate at the lowest CPU cost "
+			"by default)")
+		parser.add_argument(
+			'-T', '--tracemalloc', type=int, nargs='?', const=1, default=0,
+			help="trace Python allocations with the specified number of frames "
+			"per traceback and report them at /admin/heap (disabled by "
+			"default)")
+		parser.add_argument(
+			'-B', '--broker', type=str, default='/run/camera/broker.sock',
+			help="set and save clock and query firmware through the broker "
+			"listening on the unix socket, fall back to sudo when it is not "
+			"running (/run/camera/broker.sock by default)")
 		return parser
 
 
@@ -3250,18 +8535,116 @@ class CameraService:
 		Start servers
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraService.start'
+		TRACER.begin(span)
 		logging.info(name(self) + " started")
-		Gst.init(None)
-		camera_server = CameraServer(args)
-		self.__servers__ = Servers(
-			[HTTPSServer(camera_server), camera_server, 
-			RTSPServer(camera_server)])
+		if args.camera:
+			servers = self.__create_cameras__(args)
+		elif args.single_process:
+			servers = self.__create_camera__(args)
+		else:
+			servers = self.__create_media__(args)
+		self.__servers__ = Servers(servers)
 		self.__servers__.start()
+		TIMELINE.mark("servers started")
 		self.__running__ = True
-		logging.debug(function_name + ": exit")
+		TRACER.end(span)
+
+
+	def __create_camera__(self, args):
+
+		"""
+		Create servers of a single camera running in this process
+
+		Args:
+			args (Namespace): command line arguments
+
+		Returns:
+			list: servers
+		"""
+
+		Gst.init(None)
+		TIMELINE.mark("GStreamer initialized")
+		# NOTE: Plugins are loaded in the background while the rest of the
+		# servers is created.
+		prewarm = threading.Thread(
+			name='Registry Thread', target=prewarm_registry, args=(args.model,))
+		prewarm.start()
+		camera_server, metrics, history, watchdog, profiler, servers = \
+			create_media(args)
+		prewarm.join()
+		TIMELINE.mark("pipeline created")
+		# camera server goes first so that the pipeline starts in parallel
+		# with the HTTPS server
+		servers.insert(1, HTTPSServer(
+			camera_server, metrics=metrics, history=history, watchdog=watchdog,
+			profiler=profiler))
+		return servers
+
+
+	def __create_media__(self, args):
+
+		"""
+		Create media process of a single camera and the control plane
+		running in this process
+
+		Args:
+			args (Namespace): command line arguments
+
+		Returns:
+			list: servers
+		"""
+
+		media = MediaProcess(args)
+		# NOTE: Flow is checked and recovered in the media process, here it is
+		# only reported to systemd.
+		return [
+			media,
+			HTTPSServer(
+				media.get_proxy('camera'), metrics=media.get_proxy('metrics'),
+				history=media.get_proxy('history'),
+				watchdog=media.get_proxy('watchdog'),
+				profiler=media.get_proxy('profiler')),
+			FlowWatchdog(media.get_proxy('camera'), None, 0)]
+
+
+	def __create_cameras__(self, args):
+
+		"""
+		Create media processes of the cameras and the control plane addressing
+		them by camera id
+
+		Args:
+			args (Namespace): command line arguments
+
+		Returns:
+			list: servers
+		"""
+
+		cameras = {}
+		servers = []
+		for port_offset, (camera_id, model, number) in enumerate(args.camera):
+			if camera_id in cameras:
+				raise ArgumentTypeError("duplicate camera '" + camera_id + "'")
+			camera_args = copy.copy(args)
+			camera_args.camera = None
+			camera_args.camera_id = camera_id
+			camera_args.model = model
+			camera_args.camera_number = number
+			camera_args.port_offset = args.port_offset + port_offset
+			media = MediaProcess(camera_args)
+			cameras[camera_id] = media
+			servers.append(media)
+			# NOTE: Flow is checked and recovered in the media process, here
+			# it is only reported to systemd.
+			servers.append(FlowWatchdog(media.get_proxy('camera'), None, 0))
+		default = cameras[args.camera[0][0]]
+		servers.append(HTTPSServer(
+			default.get_proxy('camera'), metrics=default.get_proxy('metrics'),
+			history=default.get_proxy('history'),
+			watchdog=default.get_proxy('watchdog'), cameras=cameras,
+			profiler=default.get_proxy('profiler')))
+		return servers
 
 
 	def stop(self, signum=None, frame=None):
@@ -3270,14 +8653,13 @@ class CameraService:
 		Stop servers
 		"""
 
-		function_name = "'" + threading.currentThread().name + "'." + \
-			type(self).__name__ + '.' + inspect.currentframe().f_code.co_name
-		logging.debug(function_name + ": entry")
+		span = 'CameraService.stop'
+		TRACER.begin(span)
 		if self.__running__:
 			self.__running__ = False
 			self.__servers__.stop()
 		logging.info(name(self) + " stopped")		
-		logging.debug(function_name + ": exit")
+		TRACER.end(span)
 	
 
 if __name__ == '__main__':
@@ -3295,13 +8677,15 @@ if __name__ == '__main__':
 			format="%(asctime)s %(levelname)s: %(message)s",
 			level=getattr(logging, args.debug.upper()))
 
-	try:
-		with picamera.PiCamera() as camera:
-			logging.info("'" + camera.revision + "' camera detected")
-	except:
-		if camera_revision() != "ov9281":
+	TIMELINE.mark("modules imported")
+	args.camera_id = None
+	# model of cameras given with --camera is part of their specification
+	if not args.camera and args.model is None:
+		args.model = detect_camera()
+		if args.model is None:
 			logging.critical("Unable to acquire camera")
 			exit(-1)
+	TIMELINE.mark("camera detected")
 
 	camera_service.start(args)
 
@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+
+"""
+MIT License
+
+Copyright (c) 2021-2022 Marcin Sielski <marcin.sielski@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import collections
+import http.client
+import json
+import logging
+import random
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+
+def percentile(values, fraction):
+
+	"""
+	Return percentile of the sorted values
+
+	Args:
+		values (list): sorted values
+		fraction (float): percentile as a fraction
+
+	Returns:
+		float: percentile, None if there are no values
+	"""
+
+	if not values:
+		return None
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class StreamMonitor(object):
+
+	"""
+	Stream Monitor receiving the stream over RTSP with RTP interleaved in the
+	TCP connection and recording when frames and keyframes arrive, so that
+	disruptions of the RTP output can be measured without GStreamer
+	"""
+
+	KEEPALIVE = 30
+
+
+	def __init__(self, url, gap=0.25):
+
+		"""
+		Initialize Stream Monitor
+
+		Args:
+			url (str): RTSP URL, e.g. rtsp://localhost:8000/pi
+			gap (float): time without frames in seconds regarded as a
+				disruption
+		"""
+
+		self.__url__ = url
+		self.__gap__ = gap
+		self.__socket__ = None
+		self.__file__ = None
+		self.__cseq__ = 0
+		self.__session__ = None
+		self.__thread__ = None
+		self.__running__ = False
+		self.__condition__ = threading.Condition()
+		self.__frames__ = collections.deque(maxlen=100000)
+		self.__keyframes__ = collections.deque(maxlen=10000)
+		self.__disruptions__ = []
+		self.__packets__ = 0
+		self.__lost__ = 0
+		self.__sequence__ = None
+		self.__keyframe__ = False
+
+
+	def __request__(self, method, url, headers=None):
+
+		"""
+		Send RTSP request and return the response
+
+		Args:
+			method (str): RTSP method
+			url (str): URL
+			headers (dict): additional headers
+
+		Returns:
+			tuple: headers and body of the response
+
+		Raises:
+			OSError: if the request failed
+		"""
+
+		self.__cseq__ += 1
+		request = method + ' ' + url + ' RTSP/1.0\r\nCSeq: ' + \
+			str(self.__cseq__) + '\r\nUser-Agent: StreamMonitor\r\n'
+		if self.__session__ is not None:
+			request += 'Session: ' + self.__session__ + '\r\n'
+		for name, value in (headers or {}).items():
+			request += name + ': ' + value + '\r\n'
+		self.__socket__.sendall((request + '\r\n').encode())
+		headers, body = self.__response__(self.__file__.readline())
+		if not headers['status'].startswith('200'):
+			raise OSError(method + " failed: " + headers['status'])
+		return headers, body
+
+
+	def __response__(self, status):
+
+		"""
+		Read RTSP response following the status line
+
+		Args:
+			status (bytes): status line
+
+		Returns:
+			tuple: headers and body of the response
+		"""
+
+		headers = {'status': status.decode().split(' ', 1)[-1].strip()}
+		while True:
+			line = self.__file__.readline().decode().strip()
+			if not line:
+				break
+			name, value = line.split(':', 1)
+			headers[name.strip().lower()] = value.strip()
+		body = self.__file__.read(int(headers.get('content-length', 0)))
+		return headers, body.decode()
+
+
+	def __control__(self, base, sdp):
+
+		"""
+		Return control URL of the video media
+
+		Args:
+			base (str): base URL
+			sdp (str): session description
+
+		Returns:
+			str: control URL
+		"""
+
+		control = None
+		video = False
+		for line in sdp.splitlines():
+			if line.startswith('m='):
+				video = line.startswith('m=video')
+			if video and line.startswith('a=control:'):
+				control = line[len('a=control:'):].strip()
+				break
+		if control is None or control == '*':
+			return base
+		if control.startswith('rtsp://'):
+			return control
+		return base.rstrip('/') + '/' + control
+
+
+	def start(self):
+
+		"""
+		Connect to the RTSP server and start receiving the stream
+
+		Raises:
+			OSError: if the stream is not available
+		"""
+
+		url = urllib.parse.urlsplit(self.__url__)
+		self.__socket__ = socket.create_connection(
+			(url.hostname, url.port or 554), timeout=5)
+		self.__file__ = self.__socket__.makefile('rb')
+		self.__request__('OPTIONS', self.__url__)
+		headers, sdp = self.__request__(
+			'DESCRIBE', self.__url__, {'Accept': 'application/sdp'})
+		base = headers.get('content-base', self.__url__)
+		headers, _ = self.__request__(
+			'SETUP', self.__control__(base, sdp),
+			{'Transport': 'RTP/AVP/TCP;unicast;interleaved=0-1'})
+		self.__session__ = headers['session'].split(';')[0]
+		self.__request__('PLAY', base, {'Range': 'npt=0.000-'})
+		self.__socket__.settimeout(None)
+		self.__running__ = True
+		self.__thread__ = threading.Thread(
+			name='Stream Monitor Thread', target=self.__run__)
+		self.__thread__.daemon = True
+		self.__thread__.start()
+		logging.info("Monitoring " + self.__url__)
+
+
+	def stop(self):
+
+		"""
+		Stop receiving the stream
+		"""
+
+		self.__running__ = False
+		if self.__socket__ is not None:
+			try:
+				self.__socket__.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			self.__socket__.close()
+		if self.__thread__ is not None:
+			self.__thread__.join()
+			self.__thread__ = None
+
+
+	def __run__(self):
+
+		"""
+		Stream Monitor Thread entry method
+		"""
+
+		keepalive = time.monotonic()
+		while self.__running__:
+			try:
+				marker = self.__file__.read(1)
+				if not marker:
+					break
+				if marker != b'$':
+					# response to the keep alive request
+					self.__response__(marker + self.__file__.readline())
+					continue
+				channel, length = struct.unpack('!BH', self.__file__.read(3))
+				packet = self.__file__.read(length)
+				if channel == 0:
+					self.__on_packet__(packet, time.monotonic())
+				# NOTE: Session times out unless kept alive. Response is read
+				# together with the interleaved packets.
+				if time.monotonic() - keepalive > self.KEEPALIVE:
+					keepalive = time.monotonic()
+					self.__cseq__ += 1
+					self.__socket__.sendall((
+						'GET_PARAMETER ' + self.__url__ + ' RTSP/1.0\r\n' +
+						'CSeq: ' + str(self.__cseq__) + '\r\n' +
+						'Session: ' + self.__session__ + '\r\n\r\n').encode())
+			except (OSError, ValueError, struct.error):
+				break
+		if self.__running__:
+			logging.error("Stream " + self.__url__ + " closed")
+			self.__on_gap__(time.monotonic())
+
+
+	def __on_packet__(self, packet, now):
+
+		"""
+		Account RTP packet
+
+		Args:
+			packet (bytes): RTP packet
+			now (float): arrival time
+		"""
+
+		if len(packet) < 12:
+			return
+		first, second, sequence = struct.unpack_from('!BBH', packet)
+		offset = 12 + 4 * (first & 0x0f)
+		if first & 0x10:
+			offset += 4 + 4 * struct.unpack_from('!H', packet, offset + 2)[0]
+		self.__packets__ += 1
+		if self.__sequence__ is not None:
+			self.__lost__ += (sequence - self.__sequence__ - 1) & 0xffff
+		self.__sequence__ = sequence
+		if offset < len(packet):
+			nal = packet[offset] & 0x1f
+			# FU-A fragment starting the NAL unit
+			if nal == 28 and offset + 1 < len(packet):
+				if packet[offset + 1] & 0x80:
+					nal = packet[offset + 1] & 0x1f
+			# STAP-A aggregating SPS, PPS and possibly IDR
+			if nal == 24:
+				index = offset + 1
+				while index + 2 < len(packet):
+					size = struct.unpack_from('!H', packet, index)[0]
+					if packet[index + 2] & 0x1f == 5:
+						nal = 5
+					index += 2 + size
+			if nal == 5:
+				self.__keyframe__ = True
+		# marker bit indicates the last packet of the frame
+		if second & 0x80:
+			with self.__condition__:
+				if self.__frames__ and now - self.__frames__[-1] > self.__gap__:
+					self.__disruptions__.append(
+						(self.__frames__[-1], now - self.__frames__[-1]))
+				self.__frames__.append(now)
+				if self.__keyframe__:
+					self.__keyframes__.append(now)
+					self.__keyframe__ = False
+				self.__condition__.notify_all()
+
+
+	def __on_gap__(self, now):
+
+		"""
+		Account disruption lasting until the end of the measurement
+
+		Args:
+			now (float): time the stream closed
+		"""
+
+		with self.__condition__:
+			if self.__frames__:
+				self.__disruptions__.append(
+					(self.__frames__[-1], now - self.__frames__[-1]))
+			self.__condition__.notify_all()
+
+
+	def wait_for_frame(self, since, timeout, keyframe=False):
+
+		"""
+		Wait for the frame completed after the specified time
+
+		Args:
+			since (float): monotonic time
+			timeout (float): timeout in seconds
+			keyframe (bool): True to wait for the keyframe
+
+		Returns:
+			float: arrival time of the frame, None on timeout
+		"""
+
+		deadline = time.monotonic() + timeout
+		frames = self.__keyframes__ if keyframe else self.__frames__
+		with self.__condition__:
+			while True:
+				first = None
+				for arrival in reversed(frames):
+					if arrival <= since:
+						break
+					first = arrival
+				if first is not None:
+					return first
+				remaining = deadline - time.monotonic()
+				if remaining <= 0 or not self.__running__:
+					return None
+				self.__condition__.wait(remaining)
+
+
+	def get_statistics(self, since=0):
+
+		"""
+		Return statistics of the stream
+
+		Args:
+			since (float): monotonic time to account disruptions from
+
+		Returns:
+			dict: frames, keyframes, lost packets and disruptions
+		"""
+
+		with self.__condition__:
+			frames = [arrival for arrival in self.__frames__ if arrival > since]
+			keyframes = len(
+				[arrival for arrival in self.__keyframes__ if arrival > since])
+			disruptions = [
+				duration for start, duration in self.__disruptions__
+				if start >= since]
+		return {
+			'frames': len(frames), 'keyframes': keyframes,
+			'packets': self.__packets__, 'lost_packets': self.__lost__,
+			'disruptions': len(disruptions),
+			'disruption_seconds': round(sum(disruptions), 3),
+			'max_gap_seconds': round(max(disruptions, default=0), 3)}
+
+
+class Client(threading.Thread):
+
+	"""
+	Client issuing requests of the scenario over its own TLS connection, like
+	a browser with the web UI open
+	"""
+
+	def __init__(self, index, options, scenario, deadline):
+
+		"""
+		Initialize Client
+
+		Args:
+			index (int): index of the client
+			options (Namespace): command line arguments
+			scenario (dict): scenario
+			deadline (float): monotonic time to stop at
+		"""
+
+		super().__init__(name='Client ' + str(index))
+		self.__options__ = options
+		self.__scenario__ = scenario
+		self.__deadline__ = deadline
+		self.__random__ = random.Random(scenario.get('seed', 0) + index)
+		self.__context__ = ssl.create_default_context()
+		# NOTE: The service uses self-signed certificate.
+		self.__context__.check_hostname = False
+		self.__context__.verify_mode = ssl.CERT_NONE
+		self.__connection__ = None
+		self.__steps__ = collections.Counter()
+		self.results = collections.defaultdict(list)
+		self.errors = collections.Counter()
+
+
+	def __query__(self, request):
+
+		"""
+		Return query of the next request of the kind, list values are cycled
+		through like a slider being dragged
+
+		Args:
+			request (dict): request of the scenario
+
+		Returns:
+			str: query
+		"""
+
+		step = self.__steps__[request['name']]
+		self.__steps__[request['name']] += 1
+		params = {}
+		for name, value in request.get('params', {}).items():
+			if isinstance(value, list):
+				value = value[step % len(value)]
+			params[name] = str(value)
+		if self.__options__.camera is not None:
+			params['camera'] = self.__options__.camera
+		return urllib.parse.urlencode(params)
+
+
+	def __get__(self, query):
+
+		"""
+		Issue GET request
+
+		Args:
+			query (str): query
+
+		Returns:
+			int: HTTP status
+		"""
+
+		if self.__connection__ is None:
+			self.__connection__ = http.client.HTTPSConnection(
+				self.__options__.host, self.__options__.port,
+				timeout=self.__options__.timeout, context=self.__context__)
+		try:
+			self.__connection__.request('GET', '/?' + query)
+			response = self.__connection__.getresponse()
+			response.read()
+		except Exception:
+			self.__connection__.close()
+			self.__connection__ = None
+			raise
+		if not self.__scenario__.get('keepalive', True):
+			self.__connection__.close()
+			self.__connection__ = None
+		return response.status
+
+
+	def run(self):
+
+		"""
+		Client Thread entry method
+		"""
+
+		requests = self.__scenario__['requests']
+		weights = [request.get('weight', 1) for request in requests]
+		interval = 0
+		if self.__scenario__.get('rate', 0) > 0:
+			interval = 1 / self.__scenario__['rate']
+		while time.monotonic() < self.__deadline__:
+			request = self.__random__.choices(requests, weights)[0]
+			start = time.monotonic()
+			try:
+				status = self.__get__(self.__query__(request))
+				if status != 200:
+					self.errors[request['name'] + ':' + str(status)] += 1
+			except Exception as e:
+				self.errors[request['name'] + ':' + type(e).__name__] += 1
+			else:
+				self.results[request['name']].append(time.monotonic() - start)
+			if interval > 0:
+				# NOTE: Requests are spread with jitter, so that clients do not
+				# synchronize.
+				delay = self.__random__.expovariate(1 / interval)
+				time.sleep(
+					max(0, min(delay, self.__deadline__ - time.monotonic())))
+		if self.__connection__ is not None:
+			self.__connection__.close()
+
+
+def run_scenario(options, scenario):
+
+	"""
+	Run the scenario
+
+	Args:
+		options (Namespace): command line arguments
+		scenario (dict): scenario
+
+	Returns:
+		dict: report of the scenario
+	"""
+
+	clients = options.clients or scenario.get('clients', 1)
+	duration = options.duration or scenario.get('duration', 60)
+	monitor = None
+	if options.rtsp_url:
+		monitor = StreamMonitor(options.rtsp_url, options.gap)
+		monitor.start()
+		time.sleep(options.settle)
+	start = time.monotonic()
+	deadline = start + duration
+	threads = [
+		Client(index, options, scenario, deadline) for index in range(clients)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.monotonic() - start
+	latencies = collections.defaultdict(list)
+	errors = collections.Counter()
+	for thread in threads:
+		for name, values in thread.results.items():
+			latencies[name].extend(values)
+		errors.update(thread.errors)
+	requests = {}
+	total = []
+	for name, values in sorted(latencies.items()):
+		values.sort()
+		total.extend(values)
+		requests[name] = {
+			'count': len(values),
+			'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+			'p99_ms': round(percentile(values, 0.99) * 1000, 2)}
+	total.sort()
+	report = {
+		'scenario': scenario.get('name'), 'clients': clients,
+		'duration': round(elapsed, 3),
+		'throughput_rps': round(len(total) / elapsed, 2),
+		'p50_ms': None, 'p99_ms': None, 'requests': requests,
+		'errors': dict(errors), 'stream': None}
+	if total:
+		report['p50_ms'] = round(percentile(total, 0.5) * 1000, 2)
+		report['p99_ms'] = round(percentile(total, 0.99) * 1000, 2)
+	if monitor is not None:
+		report['stream'] = monitor.get_statistics(start)
+		monitor.stop()
+	return report
+
+
+def get_parser():
+
+	"""
+	Parse input arguments
+
+	Returns:
+		parser (ArgumentParser): argument parser
+	"""
+
+	parser = argparse.ArgumentParser(
+		description="Load the HTTPS API of the camera with the scenarios and "
+		"measure disruption of the stream")
+	parser.add_argument(
+		'scenario', type=str, nargs='+', help="scenario file")
+	parser.add_argument(
+		'-a', '--host', type=str, default='localhost',
+		help="set address of the camera (localhost by default)")
+	parser.add_argument(
+		'-p', '--port', type=int, default=8888,
+		help="set port of the HTTPS API (8888 by default)")
+	parser.add_argument(
+		'-C', '--camera', type=str, default=None,
+		help="select camera by camera id (default camera by default)")
+	parser.add_argument(
+		'-c', '--clients', type=int, default=None,
+		help="override number of concurrent clients of the scenario")
+	parser.add_argument(
+		'-s', '--duration', type=float, default=None,
+		help="override duration of the scenario in seconds")
+	parser.add_argument(
+		'-t', '--timeout', type=float, default=30,
+		help="set request timeout in seconds (30 s by default)")
+	parser.add_argument(
+		'-r', '--rtsp_url', type=str, default='rtsp://localhost:8000/pi',
+		help="monitor the stream at RTSP URL, requires streaming over RTSP "
+		"to be enabled, empty to disable (rtsp://localhost:8000/pi by "
+		"default)")
+	parser.add_argument(
+		'-g', '--gap', type=float, default=0.25,
+		help="regard time without frames as a disruption in seconds (0.25 s "
+		"by default)")
+	parser.add_argument(
+		'-w', '--settle', type=float, default=3,
+		help="wait for the stream to settle before loading in seconds (3 s "
+		"by default)")
+	parser.add_argument(
+		'-o', '--output', type=str, default=None,
+		help="write reports to the file (standard output by default)")
+	return parser
+
+
+def main():
+
+	"""
+	Load test entry method
+	"""
+
+	options = get_parser().parse_args()
+	logging.basicConfig(
+		format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+	reports = []
+	for path in options.scenario:
+		with open(path, 'r') as scenario:
+			scenario = json.load(scenario)
+		logging.info("Running scenario '" + scenario.get('name', path) + "'")
+		report = run_scenario(options, scenario)
+		logging.info(json.dumps(report, sort_keys=True))
+		reports.append(report)
+	output = json.dumps(reports, indent=4)
+	if options.output is None:
+		print(output)
+	else:
+		with open(options.output, 'w') as report:
+			report.write(output + '\n')
+	return any(report['errors'] for report in reports)
+
+
+if __name__ == '__main__':
+
+	sys.exit(1 if main() else 0)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+"""
+MIT License
+
+Copyright (c) 2021-2022 Marcin Sielski <marcin.sielski@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from loadtest import StreamMonitor, percentile
+import argparse
+import http.client
+import json
+import logging
+import os
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+
+
+IMX = ('imx219', 'imx477')
+OV = ('ov9281',)
+ALL = IMX + OV
+# NOTE: Every change is applied in both directions, the second parameters
+# bring the camera back.
+CHANGES = (
+	('brightness', {'brightness': 60}, {'brightness': 50}, IMX),
+	('contrast', {'contrast': 20}, {'contrast': 0}, IMX),
+	('saturation', {'saturation': 20}, {'saturation': 0}, IMX),
+	('sharpness', {'sharpness': 20}, {'sharpness': 0}, IMX),
+	('drc', {'drc': 1}, {'drc': 0}, IMX),
+	('image_effect', {'image_effect': 1}, {'image_effect': 0}, IMX),
+	('awb_mode', {'awb_mode': 2}, {'awb_mode': 1}, IMX),
+	('awb_mode off', {'awb_mode': 0}, {'awb_mode': 1}, IMX),
+	('exposure_mode', {'exposure_mode': 2}, {'exposure_mode': 1}, IMX),
+	('exposure_mode off', {'exposure_mode': 0}, {'exposure_mode': 1}, IMX),
+	(
+		'exposure_compensation', {'exposure_compensation': 5},
+		{'exposure_compensation': 0}, IMX),
+	('metering_mode', {'metering_mode': 1}, {'metering_mode': 0}, IMX),
+	('iso', {'iso': 400}, {'iso': 0}, IMX),
+	('shutter_speed', {'shutter_speed': 10000}, {'shutter_speed': 0}, ALL),
+	(
+		'video_stabilisation', {'video_stabilisation': 1},
+		{'video_stabilisation': 0}, IMX),
+	('gain', {'gain': 2}, {'gain': 1}, OV),
+	('rotation', {'rotation': 180}, {'rotation': 0}, IMX),
+	('hflip', {'hflip': 1}, {'hflip': 0}, ALL),
+	('vflip', {'vflip': 1}, {'vflip': 0}, ALL),
+	('stats', {'stats': '0x0000065d'}, {'stats': '0x00000000'}, ALL),
+	('bitrate', {'bitrate': 2000000}, {'bitrate': 3000000}, ALL),
+	('framerate', {'framerate': 25}, {'framerate': 30}, ALL),
+	(
+		'resolution', {'width': 1280, 'height': 720},
+		{'width': 800, 'height': 608}, IMX),
+	(
+		'resolution', {'width': 640, 'height': 400},
+		{'width': 1280, 'height': 800}, OV))
+
+
+class Camera(object):
+
+	"""
+	Camera controlled over the HTTPS API
+	"""
+
+	def __init__(self, host, port, camera_id=None, timeout=60):
+
+		"""
+		Initialize Camera
+
+		Args:
+			host (str): address of the camera
+			port (int): port of the HTTPS API
+			camera_id (str): camera id, None for the default camera
+			timeout (float): request timeout in seconds
+		"""
+
+		self.__camera_id__ = camera_id
+		context = ssl.create_default_context()
+		# NOTE: The service uses self-signed certificate.
+		context.check_hostname = False
+		context.verify_mode = ssl.CERT_NONE
+		self.__connection__ = http.client.HTTPSConnection(
+			host, port, timeout=timeout, context=context)
+
+
+	def get(self, params=None, path='/'):
+
+		"""
+		Apply parameters and return parameters of the camera
+
+		Args:
+			params (dict): parameters to apply
+			path (str): path of the resource
+
+		Returns:
+			dict: parameters of the camera
+
+		Raises:
+			OSError: if the request failed
+		"""
+
+		params = dict(params or {})
+		if self.__camera_id__ is not None:
+			params['camera'] = self.__camera_id__
+		try:
+			self.__connection__.request(
+				'GET', path + '?' + urllib.parse.urlencode(params))
+			response = self.__connection__.getresponse()
+			body = response.read()
+		except (OSError, http.client.HTTPException) as e:
+			self.__connection__.close()
+			raise OSError("Request " + str(params) + " failed: " + str(e))
+		if response.status != 200:
+			raise OSError(
+				"Request " + str(params) + " failed: " + str(response.status))
+		return json.loads(body)
+
+
+class RecordingMonitor(object):
+
+	"""
+	Recording Monitor detecting when bytes land in the recording
+	"""
+
+	def __init__(self, directory):
+
+		"""
+		Initialize Recording Monitor
+
+		Args:
+			directory (str): recording directory
+		"""
+
+		self.__directory__ = directory
+
+
+	def snapshot(self):
+
+		"""
+		Return sizes of the recordings
+
+		Returns:
+			dict: size by recording name
+		"""
+
+		sizes = {}
+		for entry in os.scandir(self.__directory__):
+			if entry.name.endswith('.mkv') or entry.name.endswith('.mp4'):
+				try:
+					sizes[entry.name] = entry.stat().st_size
+				except OSError:
+					pass
+		return sizes
+
+
+	def wait_for_bytes(self, sizes, timeout, interval=0.005):
+
+		"""
+		Wait for the recording to grow
+
+		Args:
+			sizes (dict): sizes of the recordings to compare with
+			timeout (float): timeout in seconds
+			interval (float): polling interval in seconds
+
+		Returns:
+			float: monotonic time the recording grew, None on timeout
+		"""
+
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			for name, size in self.snapshot().items():
+				if size > sizes.get(name, 0):
+					return time.monotonic()
+			time.sleep(interval)
+		return None
+
+
+def measure(camera, monitor, recording, params, options):
+
+	"""
+	Apply parameters and measure how long the outputs are disrupted
+
+	Args:
+		camera (Camera): camera
+		monitor (StreamMonitor): stream monitor
+		recording (RecordingMonitor): recording monitor, None if not recording
+		params (dict): parameters to apply
+		options (Namespace): command line arguments
+
+	Returns:
+		dict: request, first frame, keyframe and recording times and the
+			longest gap in milliseconds
+	"""
+
+	start = time.monotonic()
+	camera.get(params)
+	# NOTE: Setters return once the change is applied, frames and bytes
+	# before that still come from the previous configuration. All times are
+	# measured from the request though, as this is what operators see.
+	applied = time.monotonic()
+	result = {'request': applied - start, 'record': None}
+	landed = []
+	waiter = None
+	if recording is not None:
+		# recording is watched while waiting for the stream
+		waiter = threading.Thread(
+			name='Recording Thread', target=lambda sizes: landed.append(
+				recording.wait_for_bytes(sizes, options.timeout)),
+			args=(recording.snapshot(),))
+		waiter.start()
+	frame = monitor.wait_for_frame(applied, options.timeout)
+	keyframe = monitor.wait_for_frame(applied, options.timeout, keyframe=True)
+	result['frame'] = None if frame is None else frame - start
+	result['keyframe'] = None if keyframe is None else keyframe - start
+	if waiter is not None:
+		waiter.join()
+		if landed[0] is not None:
+			result['record'] = landed[0] - start
+	time.sleep(options.settle)
+	result['gap'] = monitor.get_statistics(start)['max_gap_seconds']
+	for name, value in result.items():
+		if value is not None:
+			result[name] = round(value * 1000, 1)
+	return result
+
+
+def summarize(samples):
+
+	"""
+	Summarize samples of the change
+
+	Args:
+		samples (list): samples returned by measure()
+
+	Returns:
+		dict: median and maximum of the measurements
+	"""
+
+	summary = {}
+	for name in ('request', 'frame', 'keyframe', 'record', 'gap'):
+		values = sorted(
+			sample[name] for sample in samples if sample[name] is not None)
+		missing = len(samples) - len(values)
+		summary[name + '_p50_ms'] = percentile(values, 0.5)
+		summary[name + '_max_ms'] = values[-1] if values else None
+		if missing:
+			summary[name + '_timeouts'] = missing
+	return summary
+
+
+def get_parser():
+
+	"""
+	Parse input arguments
+
+	Returns:
+		parser (ArgumentParser): argument parser
+	"""
+
+	parser = argparse.ArgumentParser(
+		description="Measure how long each parameter change disrupts the "
+		"stream and the recording")
+	parser.add_argument(
+		'-a', '--host', type=str, default='localhost',
+		help="set address of the camera (localhost by default)")
+	parser.add_argument(
+		'-p', '--port', type=int, default=8888,
+		help="set port of the HTTPS API (8888 by default)")
+	parser.add_argument(
+		'-C', '--camera', type=str, default=None,
+		help="select camera by camera id (default camera by default)")
+	parser.add_argument(
+		'-r', '--rtsp_url', type=str, default='rtsp://localhost:8000/pi',
+		help="monitor the stream at RTSP URL (rtsp://localhost:8000/pi by "
+		"default)")
+	parser.add_argument(
+		'-m', '--media_dir', type=str, default=None,
+		help="measure time until bytes land in recordings in the directory, "
+		"requires recording to be enabled (not measured by default)")
+	parser.add_argument(
+		'-n', '--repeat', type=int, default=3,
+		help="repeat every change in both directions (3 times by default)")
+	parser.add_argument(
+		'-s', '--settle', type=float, default=2,
+		help="wait after every change in seconds (2 s by default)")
+	parser.add_argument(
+		'-t', '--timeout', type=float, default=30,
+		help="give up waiting for frames after seconds (30 s by default)")
+	parser.add_argument(
+		'-g', '--gap', type=float, default=0.25,
+		help="regard time without frames as a disruption in seconds (0.25 s "
+		"by default)")
+	parser.add_argument(
+		'-c', '--change', type=str, action='append', default=None,
+		help="measure only the change, may be repeated (all by default)")
+	parser.add_argument(
+		'-o', '--output', type=str, default=None,
+		help="write cost table to the file (standard output by default)")
+	return parser
+
+
+def main():
+
+	"""
+	Reconfiguration benchmark entry method
+	"""
+
+	options = get_parser().parse_args()
+	logging.basicConfig(
+		format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+	camera = Camera(options.host, options.port, options.camera, options.timeout)
+	parameters = camera.get()
+	model = parameters['model']
+	if not parameters['rtsp']:
+		logging.error("Streaming over RTSP must be enabled")
+		return True
+	recording = None
+	if options.media_dir is not None:
+		if not parameters['record']:
+			logging.error("Recording must be enabled")
+			return True
+		recording = RecordingMonitor(options.media_dir)
+	monitor = StreamMonitor(options.rtsp_url, options.gap)
+	monitor.start()
+	time.sleep(options.settle)
+	costs = {}
+	try:
+		for name, change, restore, models in CHANGES:
+			if model not in models:
+				continue
+			if options.change is not None and name not in options.change:
+				continue
+			logging.info("Measuring '" + name + "'")
+			samples = []
+			camera.get(restore)
+			time.sleep(options.settle)
+			for _ in range(options.repeat):
+				samples.append(measure(
+					camera, monitor, recording, change, options))
+				samples.append(measure(
+					camera, monitor, recording, restore, options))
+			costs[name] = summarize(samples)
+			costs[name]['disruptive'] = (
+				costs[name]['gap_max_ms'] is None or
+				costs[name]['gap_max_ms'] > options.gap * 1000)
+			logging.info(name + ": " + json.dumps(costs[name], sort_keys=True))
+	finally:
+		# bring back parameters the camera was measured with
+		restore = {}
+		for _, change, _, models in CHANGES:
+			if model in models:
+				for key in change:
+					restore[key] = parameters[key]
+		camera.get(restore)
+		monitor.stop()
+	output = json.dumps(
+		{'model': model, 'record': recording is not None, 'costs': costs},
+		indent=4, sort_keys=True)
+	if options.output is None:
+		print(output)
+	else:
+		with open(options.output, 'w') as report:
+			report.write(output + '\n')
+	return False
+
+
+if __name__ == '__main__':
+
+	sys.exit(1 if main() else 0)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+MIT License
+
+Copyright (c) 2021-2022 Marcin Sielski <marcin.sielski@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from loadtest import StreamMonitor
+from reconfigure import Camera
+import argparse
+import collections
+import json
+import logging
+import sys
+import time
+
+
+# NOTE: Cycles exercise the paths that allocate and release pipeline
+# elements, buffers and RTSP sessions.
+CYCLES = ('restart', 'record', 'client')
+FIELDS = ('rss', 'python', 'gst_objects')
+
+
+def slope(samples, field):
+
+	"""
+	Return least squares slope of the field over time
+
+	Args:
+		samples (list): heap samples
+		field (str): field of the samples
+
+	Returns:
+		float: growth per hour, None if there are not enough samples
+	"""
+
+	points = [
+		(sample['time'], sample[field]) for sample in samples
+		if sample.get(field) is not None]
+	if len(points) < 3:
+		return None
+	mean_time = sum(point[0] for point in points) / len(points)
+	mean_value = sum(point[1] for point in points) / len(points)
+	variance = sum((point[0] - mean_time) ** 2 for point in points)
+	if variance == 0:
+		return None
+	covariance = sum(
+		(point[0] - mean_time) * (point[1] - mean_value) for point in points)
+	return covariance / variance * 3600
+
+
+def detect_growth(samples, thresholds):
+
+	"""
+	Detect sustained growth, i.e. growth over the whole soak that does not
+	level off in its second half
+
+	Args:
+		samples (list): heap samples taken after warmup
+		thresholds (dict): maximum growth per hour by field
+
+	Returns:
+		dict: growth per hour over the whole soak and its second half and
+			indication of sustained growth by field
+	"""
+
+	growth = {}
+	recent = samples[len(samples) // 2:]
+	for field in FIELDS:
+		total = slope(samples, field)
+		second_half = slope(recent, field)
+		growth[field] = {
+			'per_hour': None if total is None else round(total, 1),
+			'second_half_per_hour':
+				None if second_half is None else round(second_half, 1),
+			'threshold_per_hour': thresholds[field],
+			'sustained':
+				total is not None and second_half is not None and
+				total > thresholds[field] and second_half > thresholds[field]}
+	return growth
+
+
+class Soak(object):
+
+	"""
+	Soak cycling restarts, recording and RTSP clients while sampling heap
+	usage of the camera
+	"""
+
+	def __init__(self, options):
+
+		"""
+		Initialize Soak
+
+		Args:
+			options (Namespace): command line arguments
+		"""
+
+		self.__options__ = options
+		self.__camera__ = Camera(
+			options.host, options.port, options.camera, options.timeout)
+		self.__monitor__ = StreamMonitor(options.rtsp_url, options.gap)
+		self.__record__ = False
+		self.__cycles__ = collections.Counter()
+		self.__errors__ = collections.Counter()
+		self.__stalls__ = 0
+		self.__samples__ = []
+		self.__heap__ = None
+
+
+	def sample(self, start, baseline=False):
+
+		"""
+		Sample heap usage of the camera
+
+		Args:
+			start (float): monotonic time the soak started at
+			baseline (bool): indicate whether to take the new baseline
+				snapshot
+		"""
+
+		self.__heap__ = self.__camera__.get(
+			{'limit': self.__options__.limit, 'baseline': int(baseline)},
+			'/admin/heap')
+		sample = {'time': round(time.monotonic() - start, 1)}
+		for field in FIELDS:
+			sample[field] = self.__heap__.get(field)
+		self.__samples__.append(sample)
+		logging.info("Heap: " + json.dumps(sample, sort_keys=True))
+
+
+	def cycle(self, kind):
+
+		"""
+		Run the cycle and check that frames keep flowing afterwards
+
+		Args:
+			kind (str): 'restart', 'record' or 'client'
+		"""
+
+		options = self.__options__
+		start = time.monotonic()
+		if kind == 'restart':
+			self.__camera__.get({'restart': 1})
+		elif kind == 'record':
+			self.__record__ = not self.__record__
+			self.__camera__.get({'record': int(self.__record__)})
+		else:
+			client = StreamMonitor(options.rtsp_url, options.gap)
+			client.start()
+			try:
+				if client.wait_for_frame(start, options.timeout) is None:
+					raise OSError("no frames received by the client")
+			finally:
+				client.stop()
+		self.__cycles__[kind] += 1
+		if self.__monitor__.wait_for_frame(start, options.timeout) is None:
+			self.__stalls__ += 1
+			logging.warning("Stream stalled after " + kind)
+
+
+	def run(self):
+
+		"""
+		Run the soak
+
+		Returns:
+			dict: report of the soak
+		"""
+
+		options = self.__options__
+		parameters = self.__camera__.get()
+		if not parameters['rtsp']:
+			raise OSError("Streaming over RTSP must be enabled")
+		self.__record__ = bool(parameters['record'])
+		self.__monitor__.start()
+		start = time.monotonic()
+		deadline = start + options.duration
+		warmup = start + options.warmup
+		sampled = 0
+		baseline = None
+		index = 0
+		try:
+			while time.monotonic() < deadline:
+				kind = CYCLES[index % len(CYCLES)]
+				index += 1
+				try:
+					self.cycle(kind)
+				except Exception as e:
+					self.__errors__[kind + ':' + type(e).__name__] += 1
+					logging.error(kind + " failed: " + str(e))
+				now = time.monotonic()
+				if now - sampled >= options.sample_interval:
+					sampled = now
+					# NOTE: Caches and pools fill up during warmup, heap
+					# differences are reported against the snapshot taken
+					# right after.
+					if baseline is None and now >= warmup:
+						baseline = len(self.__samples__)
+						self.sample(start, True)
+					else:
+						self.sample(start)
+				time.sleep(max(0, min(
+					options.interval, deadline - time.monotonic())))
+			self.sample(start)
+		finally:
+			# bring back recording the camera was soaked with
+			self.__camera__.get({'record': int(parameters['record'])})
+			statistics = self.__monitor__.get_statistics(start)
+			self.__monitor__.stop()
+		thresholds = {
+			'rss': options.rss, 'python': options.python,
+			'gst_objects': options.gst_objects}
+		growth = detect_growth(self.__samples__[baseline or 0:], thresholds)
+		return {
+			'duration': round(time.monotonic() - start, 1),
+			'cycles': dict(self.__cycles__), 'errors': dict(self.__errors__),
+			'stalls': self.__stalls__, 'stream': statistics,
+			'growth': growth, 'top': self.__heap__.get('top'),
+			'samples': self.__samples__,
+			'failed': any(field['sustained'] for field in growth.values())}
+
+
+def get_parser():
+
+	"""
+	Parse input arguments
+
+	Returns:
+		parser (ArgumentParser): argument parser
+	"""
+
+	parser = argparse.ArgumentParser(
+		description="Cycle restarts, recording and RTSP clients for hours and "
+		"fail on sustained memory growth, requires the camera to run with "
+		"--tracemalloc to report Python heap")
+	parser.add_argument(
+		'-a', '--host', type=str, default='localhost',
+		help="set address of the camera (localhost by default)")
+	parser.add_argument(
+		'-p', '--port', type=int, default=8888,
+		help="set port of the HTTPS API (8888 by default)")
+	parser.add_argument(
+		'-C', '--camera', type=str, default=None,
+		help="select camera by camera id (default camera by default)")
+	parser.add_argument(
+		'-r', '--rtsp_url', type=str, default='rtsp://localhost:8000/pi',
+		help="monitor the stream at RTSP URL (rtsp://localhost:8000/pi by "
+		"default)")
+	parser.add_argument(
+		'-s', '--duration', type=float, default=4 * 3600,
+		help="set duration of the soak in seconds (4 h by default)")
+	parser.add_argument(
+		'-w', '--warmup', type=float, default=600,
+		help="exclude the beginning of the soak from growth detection in "
+		"seconds (10 min by default)")
+	parser.add_argument(
+		'-i', '--interval', type=float, default=10,
+		help="wait between cycles in seconds (10 s by default)")
+	parser.add_argument(
+		'-S', '--sample_interval', type=float, default=60,
+		help="sample heap usage every seconds (60 s by default)")
+	parser.add_argument(
+		'-t', '--timeout', type=float, default=60,
+		help="give up waiting for requests and frames after seconds (60 s by "
+		"default)")
+	parser.add_argument(
+		'-g', '--gap', type=float, default=0.25,
+		help="regard time without frames as a disruption in seconds (0.25 s "
+		"by default)")
+	parser.add_argument(
+		'-l', '--limit', type=int, default=10,
+		help="report top heap differences (10 by default)")
+	parser.add_argument(
+		'--rss', type=float, default=1024,
+		help="fail when resident set size grows faster in KiB per hour "
+		"(1024 by default)")
+	parser.add_argument(
+		'--python', type=float, default=256,
+		help="fail when Python heap grows faster in KiB per hour (256 by "
+		"default)")
+	parser.add_argument(
+		'--gst_objects', type=float, default=10,
+		help="fail when number of GStreamer objects grows faster per hour "
+		"(10 by default)")
+	parser.add_argument(
+		'-o', '--output', type=str, default=None,
+		help="write report to the file (standard output by default)")
+	return parser
+
+
+def main():
+
+	"""
+	Soak entry method
+	"""
+
+	options = get_parser().parse_args()
+	logging.basicConfig(
+		format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+	report = Soak(options).run()
+	output = json.dumps(report, indent=4, sort_keys=True)
+	if options.output is None:
+		print(output)
+	else:
+		with open(options.output, 'w') as file:
+			file.write(output + '\n')
+	if report['failed']:
+		logging.error("Sustained memory growth detected")
+	return report['failed']
+
+
+if __name__ == '__main__':
+
+	sys.exit(1 if main() else 0)